@@ -5,18 +5,50 @@ from flask import Flask
 # from flask_api import FlaskAPI
 
 from app.api import configure_api
+from app.db_routing import configure_db_routing
 from app.external_apis import configure_external_apis
+from app.http_client import configure_http_client
+from app.instrumentation import configure_instrumentation
 from app.models import db
-from config import Env, configure_app, configure_db
+from app.registry import configure_registry
+from config import ServerMode, configure_app, configure_db
 
 
 def create_app(config_name):
     """
     Returns a new Flask app with all proper configurations ready.
+
+    Optional subsystems are only imported when enabled by its configuration, so processes don't load what they don't
+    use.
     """
     app = Flask(__name__)
     configure_app(app, config_name)
     configure_db(app, db)
+    configure_registry(app)
+    configure_http_client(app)
+    app.extensions['carrier_simulator'] = None
+    if app.config['CARRIER_SIMULATOR_ENABLED']:
+        from app.simulator import configure_carrier_simulator
+        configure_carrier_simulator(app)
+    configure_instrumentation(app)
+    configure_db_routing(app)
     configure_api(app)
     configure_external_apis(app)
+    app.extensions['profile_store'] = app.extensions['slow_request_log'] = None
+    if app.config['PROFILING_ENABLED']:
+        from app.profiling import configure_profiling
+        configure_profiling(app)
+    return app
+
+
+def create_server_app(config_name):
+    """
+    Returns a new app ready to be served, either the Flask app itself (WSGI) or an asyncio-native wrapper around it
+    (ASGI), depending on its configured server mode.
+    """
+    app = create_app(config_name)
+    if app.config['SERVER_MODE'] is ServerMode.ASGI:
+        # Only imported when needed, so WSGI workers don't pay for it
+        from app.asgi import ShippingASGIApp
+        return ShippingASGIApp(app)
     return app
@@ -0,0 +1,163 @@
+# coding=utf-8
+
+
+import random
+from collections import namedtuple
+from time import sleep, time
+
+from flask import current_app
+
+from app.http_client import OutboundRequestError, get_http_client
+
+# Quote given by a carrier: the HTTP-like status code of the carrier's answer (e.g. 200, 500, 504), its cost (-1 if
+# there's none) and its costs by shipment method (e.g. {'cheap': 10, 'express': 25}), if given
+Quote = namedtuple('Quote', ('status_code', 'cost', 'costs'))
+Quote.__new__.__defaults__ = (None,)
+
+
+class Shipment(namedtuple('Shipment', ('address', 'weight', 'priority', 'box_type', 'test_mode'))):
+    """
+    Shipment to get quotes for, as already validated by our API.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(**{field_name: data.get(field_name) for field_name in cls._fields})
+
+
+class CarrierAdapter(object):
+    """
+    Interface to get quotes from a given carrier, whatever the way to reach it is.
+    """
+
+    def __init__(self, carrier):
+        self.carrier = carrier
+
+    def quote(self, shipment):
+        """
+        Returns the Quote given by the carrier for the given Shipment, with the costs of all its shipment methods (all
+        of them in a single call).
+        """
+        raise NotImplementedError
+
+
+def _build_fakejson_request_data(response_code, original_data, shipment_methods=()):
+    """
+    Returns a dict with valid data to use in fakeJSON queries: one cost overall, and one per shipment method.
+    """
+    return_success = response_code == 200
+    request_data = {
+        'token': current_app.config['FAKEJSON_API_TOKEN'],
+        'data': {
+            'error_code': 0 if return_success else response_code,
+            'reason': 'OK' if return_success else 'Error {}'.format(response_code),
+            'timestamp': 'timeNow',
+            'request_data': original_data,
+        }
+    }
+    if return_success:
+        request_data['data']['cost'] = 'numberInt'
+        for shipment_method in shipment_methods:
+            request_data['data']['cost_' + shipment_method] = 'numberInt'
+    return request_data
+
+
+class MockCarrierAdapter(CarrierAdapter):
+    """
+    Adapter that mocks interactions with any carrier using fakeJSON.
+    """
+
+    def quote(self, shipment):
+        # Choosing randomly if our request will succeed or not (90% chance of success)
+        response_code = 200 if shipment.test_mode else random.choices((200, 500), weights=(0.9, 0.1), k=1)[0]
+
+        # Hitting fakeJSON's API
+        request_data = _build_fakejson_request_data(response_code, shipment._asdict(), self.carrier.shipment_methods)
+        try:
+            response = get_http_client().post(
+                current_app.config['FAKEJSON_API_ENDPOINT'], json=request_data, params={'x': time()}
+            )
+        except OutboundRequestError as e:
+            return Quote(status_code=504 if e.timed_out else 502, cost=-1)
+        if response.text.startswith('Error'):
+            # fakeJSON issues (most likely we ran out of daily credits with them)
+            return Quote(  # Dummy response
+                status_code=response_code, cost=123, costs={method: 123 for method in self.carrier.shipment_methods}
+            )
+        try:
+            response_data = response.json()
+            costs = {method: response_data.get('cost_' + method, -1) for method in self.carrier.shipment_methods}
+        except (ValueError, AttributeError):
+            return Quote(status_code=502, cost=-1)  # Malformed response, e.g. an HTML error page
+        return Quote(
+            status_code=response_code,
+            # Just like real carriers, the main cost is the one of the default shipment method
+            cost=costs.get(current_app.config['DEFAULT_SHIPMENT_METHOD'], response_data.get('cost', -1)),
+            costs=costs,
+        )
+
+
+class HTTPCarrierAdapter(CarrierAdapter):
+    """
+    Adapter for carriers' APIs reachable over HTTP, which are expected to take the shipment as JSON (along with the
+    carrier's codes of all shipment methods to quote) and to answer with a JSON object that has its cost, and its costs
+    by shipment method (optional: if missing, the cost is taken as the one of the default shipment method).
+    """
+
+    def quote(self, shipment):
+        try:
+            response = get_http_client().post(
+                self.carrier.api_endpoint_url,
+                json=dict(shipment._asdict(), shipment_methods=self.carrier.shipment_methods),
+                headers={'X-App-Id': self.carrier.app_id, 'X-App-Token': self.carrier.app_token},
+            )
+        except OutboundRequestError as e:
+            return Quote(status_code=504 if e.timed_out else 502, cost=-1)
+        if response.status_code != 200:
+            return Quote(status_code=response.status_code, cost=-1)
+        try:
+            response_data = response.json()
+            costs = response_data.get('costs')
+            if costs is None and response_data['cost'] >= 0:
+                costs = {current_app.config['DEFAULT_SHIPMENT_METHOD']: response_data['cost']}
+            return Quote(status_code=200, cost=response_data['cost'], costs=costs)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return Quote(status_code=502, cost=-1)  # Malformed response, e.g. an HTML error page
+
+
+class SimulatorCarrierAdapter(CarrierAdapter):
+    """
+    Adapter that simulates any carrier in-process, using the app's carrier simulator (see CarrierSimulator). Just like
+    HTTP carriers, simulated carriers slower than the outbound read timeout time out.
+    """
+
+    def quote(self, shipment):
+        simulated_quote = current_app.extensions['carrier_simulator'].simulate(
+            self.carrier.code, shipment._asdict(), self.carrier.shipment_methods
+        )
+        read_timeout = current_app.config['OUTBOUND_HTTP_READ_TIMEOUT']
+        if simulated_quote.latency > read_timeout:
+            sleep(read_timeout)
+            return Quote(status_code=504, cost=-1)
+        sleep(simulated_quote.latency + simulated_quote.drip)
+        return Quote(status_code=simulated_quote.status_code, cost=simulated_quote.cost, costs=simulated_quote.costs)
+
+
+def get_mock_carrier_adapter(carrier, app=None):
+    """
+    Returns the adapter to use to mock the given carrier: the carrier simulator if enabled, fakeJSON otherwise.
+    """
+    if (app or current_app).extensions['carrier_simulator'] is not None:
+        return SimulatorCarrierAdapter(carrier)
+    return MockCarrierAdapter(carrier)
+
+
+def get_carrier_adapter(carrier, app=None):
+    """
+    Returns the adapter to use to get quotes from the given carrier (within the given Flask app, by default the current
+    one).
+    """
+    if carrier.api_endpoint_url.startswith('/mock/'):
+        return get_mock_carrier_adapter(carrier, app)
+    return HTTPCarrierAdapter(carrier)
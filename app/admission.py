@@ -0,0 +1,131 @@
+# coding=utf-8
+
+
+from functools import wraps
+from threading import Condition
+
+from flask import Response, current_app
+
+from app.instrumentation import get_instrumentation
+
+
+class AdmissionController(object):
+    """
+    Caps how many requests are handled at the same time: up to `max_concurrency` of them, with up to `max_queue` more
+    waiting for a slot for up to `queue_timeout` secs. Any other request is rejected right away (i.e. load is shed), so
+    an overloaded process answers fast instead of piling up requests that would time out anyway.
+    """
+
+    def __init__(self, max_concurrency, max_queue, queue_timeout):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self._condition = Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Returns whether the request was admitted, waiting for a slot for up to the given timeout (by default, the queue
+        timeout). Admitted requests must be released once they're done.
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        with self._condition:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                return True
+            if timeout <= 0 or self.queued >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            try:
+                is_admitted = self._condition.wait_for(lambda: self.active < self.max_concurrency, timeout)
+            finally:
+                self.queued -= 1
+            if not is_admitted:
+                self.rejected += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'rejected': self.rejected,
+        }
+
+
+def admission_controlled(func):
+    """
+    Decorator for endpoints' methods that only handles requests admitted by the app's admission controller, answering
+    with HTTP 503 otherwise. Streamed responses keep their slot until they're fully sent.
+    """
+    @wraps(func)
+    def _wrapper(*args, **kwargs):
+        admission_controller = current_app.extensions['admission_controller']
+        if admission_controller is None:
+            return func(*args, **kwargs)
+        if not admission_controller.acquire():
+            return build_overloaded_response(current_app.config)
+
+        try:
+            response = func(*args, **kwargs)
+        except BaseException:
+            admission_controller.release()
+            raise
+        if isinstance(response, Response):
+            response.call_on_close(admission_controller.release)
+        else:
+            admission_controller.release()
+        return response
+
+    return _wrapper
+
+
+def build_overloaded_response(config):
+    """
+    Returns the (Flask-RESTful) response to requests that were not admitted.
+    """
+    return (
+        {'message': 'Too many requests right now, try again later'},
+        503,
+        {'Retry-After': str(config['ADMISSION_RETRY_AFTER'])},
+    )
+
+
+def configure_admission_control(app):
+    """
+    Attaches an admission controller for shipping costs requests to the given Flask app, along with its metrics, using
+    its configuration.
+    """
+    admission_controller = asgi_admission_controller = None
+    if app.config['ADMISSION_CONTROL_ENABLED']:
+        admission_controller = AdmissionController(
+            max_concurrency=app.config['ADMISSION_MAX_CONCURRENCY'],
+            max_queue=app.config['ADMISSION_MAX_QUEUE'],
+            queue_timeout=app.config['ADMISSION_QUEUE_TIMEOUT'],
+        )
+        # Native requests of the ASGI app don't tie up a thread while they wait for carriers, so they have their own
+        # (higher) limit, and they're never queued
+        asgi_admission_controller = AdmissionController(
+            max_concurrency=app.config['ADMISSION_ASGI_MAX_CONCURRENCY'], max_queue=0, queue_timeout=0
+        )
+    app.extensions['admission_controller'] = admission_controller
+    app.extensions['asgi_admission_controller'] = asgi_admission_controller
+
+    instrumentation = get_instrumentation(app)
+    if admission_controller is not None and instrumentation is not None:
+        def _collect_admission_metrics(metrics):
+            for stat_name, value in admission_controller.stats().items():
+                metrics.set_gauge('admission_requests', value, kind=stat_name)
+            for stat_name, value in asgi_admission_controller.stats().items():
+                metrics.set_gauge('asgi_admission_requests', value, kind=stat_name)
+
+        instrumentation.metrics.add_collector(_collect_admission_metrics)
@@ -1,71 +1,419 @@
 # coding=utf-8
 
 
-import os
+import json
 import random
+from itertools import count
+from time import monotonic, time
 
-import requests
-from flask import current_app
-from flask_restful import fields, reqparse, Api, Resource, abort, marshal_with
+from flask import Response, current_app, request, stream_with_context
+from flask_restful import reqparse, Api, Resource, abort
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
 
-from app.enums import BoxType, Priority
-from app.models import Carrier
-from config import Env
+from app.adapters import Quote, Shipment, get_carrier_adapter
+from app.admission import admission_controlled, configure_admission_control
+from app.circuit_breaker import configure_circuit_breakers
+from app.enums import BoxType, Priority, ShipmentSelection
+from app.fanout import configure_fanout
+from app.hedging import configure_quote_hedger
+from app.instrumentation import get_current_trace, get_instrumentation, span
+from app.quote_cache import configure_quote_cache, normalize_shipment
+from app.rate_limiting import configure_rate_limiting
+from app.serialization import CARRIER_SERIALIZER, configure_serialization, get_json_backend, output_json
+from app.singleflight import configure_single_flight
+from app.registry import get_carrier_registry
+from config import QuoteMode
+
+
+def _build_shipment_request_parser():
+    """
+    Returns a new request parser that validates a shipment's data (i.e. address, weight, priority and box type).
+    """
+    request_parser = reqparse.RequestParser(bundle_errors=True)
+    request_parser.add_argument('address', type=str, required=True, help='Destination to calculate shipment costs for')
+    request_parser.add_argument('weight', type=int, required=True, help='Weight of the package in lb')
+    request_parser.add_argument(
+        'priority', type=int, required=True, choices=Priority.choices(), help='Valid values: 1 (top) to 5 (least)'
+    )
+    request_parser.add_argument(
+        'box_type', type=str, required=True, choices=BoxType.choices(), help='Valid values: small, medium, big'
+    )
+    # To get only the cheapest or fastest shipment method across all carriers, instead of all carriers' costs
+    request_parser.add_argument(
+        'select', type=str, choices=ShipmentSelection.choices(), help='Valid values: cheapest, fastest'
+    )
+    # To disable ShippingCostsEndpoint._verify_data()'s randomness so HTTP 400 is not raised
+    request_parser.add_argument('test_mode', type=bool, default=False)
+    return request_parser
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+EVENT_STREAM_MIMETYPE = 'text/event-stream'
+# Headers of streamed responses, so neither clients nor proxies hold them back
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+def get_stream_mimetype(accept_mimetypes):
+    """
+    Returns the streaming format (i.e. its mimetype) that best matches the given (parsed) Accept header, or None if
+    a regular JSON response is preferred.
+    """
+    best_match = accept_mimetypes.best_match(('application/json', EVENT_STREAM_MIMETYPE, NDJSON_MIMETYPE))
+    return best_match if best_match in (EVENT_STREAM_MIMETYPE, NDJSON_MIMETYPE) else None
+
+
+def format_stream_record(mimetype, record, is_summary=False):
+    """
+    Returns the given record formatted for the given streaming format: as a Server-Sent Event (either a 'quote' or a
+    'summary' event), or as a line of NDJSON (summaries being given as `{"summary": ...}`).
+    """
+    if mimetype == EVENT_STREAM_MIMETYPE:
+        return 'event: {}\ndata: {}\n\n'.format('summary' if is_summary else 'quote', json.dumps(record))
+    return json.dumps({'summary': record} if is_summary else record) + '\n'
+
+
+# Built only once, at import time: Flask-RESTful instantiates resources on every request, so adding arguments there
+# would make this (shared) parser grow forever
+SHIPMENT_REQUEST_PARSER = _build_shipment_request_parser()
+
+
+class _ShipmentPayload(object):
+    """
+    Minimal request-like object, so shipments not coming as the whole request body can still be validated with
+    SHIPMENT_REQUEST_PARSER.
+    """
+
+    def __init__(self, data):
+        self.json = data
+        self.values = MultiDict()
+
+
+def verify_account(account_id):
+    """
+    Aborts with HTTP 404 if the given account (if any, the master list always exists) has no carriers at all.
+    """
+    if account_id is not None and not get_carrier_registry().get_all(account_id):
+        abort(404, message='Unknown account: {}'.format(account_id))
+
+
+def get_rendered_carriers(account_id=None):
+    """
+    Returns a tuple with the JSON body (bytes) listing all carriers of the given account (by default, the master list)
+    and its ETag, only rendered again when the carriers change.
+    """
+    json_backend = get_json_backend()
+    return current_app.extensions['prerendered_responses'].get(
+        ('carriers', account_id),
+        get_carrier_registry().get_all(account_id),
+        lambda carriers: json_backend.dumps(CARRIER_SERIALIZER.serialize_many(carriers)),
+    )
 
 
 class CarriersEndpoint(Resource):
     """
     API endpoint to get all supported carriers.
+
+    Responses are prerendered (see get_rendered_carriers()) and have an ETag, so clients can just revalidate them
+    (`If-None-Match`) and get an HTTP 304 while carriers don't change.
+    """
+
+    def get(self, account_id=None):
+        verify_account(account_id)
+        body, etag = get_rendered_carriers(account_id)
+        response = Response(body, mimetype='application/json', headers={'Cache-Control': 'no-cache'})
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+
+class CarriersHealthEndpoint(Resource):
+    """
+    API endpoint to get the health of all supported carriers: their circuit breakers' state and stats, how many hedged
+    requests and retries they needed, and their rate limits and quota usage.
     """
-    _RESPONSE_FIELDS = {
-        'code': fields.String(attribute='code'),
-        'name': fields.String,
-        'shipment_methods': fields.Raw,
-        'enabled': fields.Boolean,
-    }
 
-    @marshal_with(_RESPONSE_FIELDS)
     def get(self):
-        return Carrier.get_all()
+        circuit_breakers = current_app.extensions['circuit_breakers']
+        quote_hedger = current_app.extensions['quote_hedger']
+        rate_limiters = current_app.extensions['carrier_rate_limiters']
+        carriers_health = []
+        for carrier in get_carrier_registry().get_all():
+            carrier_health = {'carrier': carrier.code}
+            if circuit_breakers is not None:
+                carrier_health.update(circuit_breakers.get(carrier.code).get_health())
+            if quote_hedger is not None:
+                carrier_health.update(quote_hedger.get_stats(carrier.code))
+            if rate_limiters is not None:
+                carrier_health.update(rate_limiters.get(carrier).get_stats())
+            carriers_health.append(carrier_health)
+        return carriers_health
 
 
 class ShippingCostsEndpoint(Resource):
     """
-    API endpoint to get the shipping cost of a given package (as described by its address, weight, priority anf box 
+    API endpoint to get the shipping cost of a given package (as described by its address, weight, priority anf box
     type) for all available carriers.
+
+    Responses can also be streamed, as Server-Sent Events or NDJSON (depending on the Accept header): each carrier's
+    response is sent as soon as it's ready, followed by a summary of all of them.
+
+    Requests are subject to admission control: when there are too many of them at the same time, they're answered with
+    HTTP 503 (and a Retry-After header) right away.
     """
-    request_parser = reqparse.RequestParser(bundle_errors=True)
+    request_parser = SHIPMENT_REQUEST_PARSER
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.request_parser.add_argument(
-            'address', type=str, required=True, help='Destination to calculate shipment costs for'
-        )
-        self.request_parser.add_argument('weight', type=int, required=True, help='Weight of the package in lb')
-        self.request_parser.add_argument(
-            'priority', type=int, required=True, choices=Priority.choices(), help='Valid values: 1 (top) to 5 (least)'
-        )
-        self.request_parser.add_argument(
-            'box_type', type=str, required=True, choices=BoxType.choices(), help='Valid values: small, medium, big'
+    @admission_controlled
+    def post(self, account_id=None):
+        verify_account(account_id)
+        with span('parse'):
+            request_data = self.request_parser.parse_args()
+        with span('verify'):
+            self._verify_data(request_data)
+
+        stream_mimetype = get_stream_mimetype(request.accept_mimetypes)
+        if stream_mimetype is not None:
+            return Response(
+                stream_with_context(self._generate_stream(request_data, account_id, stream_mimetype)),
+                mimetype=stream_mimetype,
+                headers=STREAM_HEADERS,
+            )
+        carrier_responses = self._quote_shipments([request_data], account_id)[0]
+        return self._select_carrier_responses(carrier_responses, request_data['select']), 200
+
+    def _generate_stream(self, shipment, account_id, mimetype):
+        """
+        Yields the response of each carrier for the given shipment as soon as it's ready, and then their summary, in the
+        given streaming format.
+        """
+        started_at = monotonic()
+        with span('carriers'):
+            carriers = get_carrier_registry().get_all_enabled(account_id)
+        carrier_responses = []
+        for _, carrier_response in self._iter_carrier_responses(carriers, [shipment]):
+            carrier_responses.append(carrier_response)
+            yield format_stream_record(mimetype, carrier_response)
+        summary = self._build_summary(carrier_responses, shipment['select'], monotonic() - started_at)
+        yield format_stream_record(mimetype, summary, is_summary=True)
+
+    def _build_summary(self, carrier_responses, selection, duration):
+        """
+        Returns a dict that sums up the given carrier responses (given in the given duration, in secs) for a streamed
+        response, with the selected shipment method (if asked to, see `_select_carrier_responses()`).
+        """
+        summary = {
+            'carriers': len(carrier_responses),
+            'errors': sum(1 for carrier_response in carrier_responses if carrier_response['error']),
+            'duration_ms': round(duration * 1000, 1),
+        }
+        if selection is not None:
+            summary['selected'] = self._select_carrier_responses(carrier_responses, selection)
+        return summary
+
+    def _quote_shipments(self, shipments, account_id=None):
+        """
+        Returns, for each one of the given shipments, a list with the responses from all enabled carriers of the given
+        account (by default, the master list).
+        """
+        with span('carriers'):
+            carriers = get_carrier_registry().get_all_enabled(account_id)
+        carrier_responses = dict(self._iter_carrier_responses(carriers, shipments))
+        return [
+            [carrier_responses[shipment_index, carrier_index] for carrier_index in range(len(carriers))]
+            for shipment_index in range(len(shipments))
+        ]
+
+    def _iter_carrier_responses(self, carriers, shipments):
+        """
+        Yields a tuple with the (shipment index, carrier index) and the response of each one of the given carriers for
+        each one of the given shipments, as soon as it's ready.
+
+        In table-first quote mode, carriers' rate tables are used whenever possible (and those responses come first).
+        Any other carrier is queried, all of them at the same time, for all shipments. All responses are kept in the
+        quote history.
+        """
+        app = current_app._get_current_object()
+        trace = get_current_trace()
+        started_at = monotonic()
+        table_responses = {}
+        if app.config['QUOTE_MODE'] is QuoteMode.TABLE_FIRST:
+            with span('rate_tables', trace):
+                table_responses = self._quote_from_rate_tables(app, carriers, shipments)
+
+        def _request_carrier(shipment_and_carrier):
+            shipment, carrier = shipment_and_carrier
+            return self._request_carrier(app, carrier, shipment, trace)
+
+        def _handle_carrier_timeout(shipment_and_carrier):
+            return self._handle_carrier_response(shipment_and_carrier[1], Quote(status_code=504, cost=-1))
+
+        def _handle_carrier_failure(shipment_and_carrier):
+            return self._handle_carrier_response(shipment_and_carrier[1], Quote(status_code=502, cost=-1))
+
+        live_keys = [
+            (shipment_index, carrier_index)
+            for shipment_index in range(len(shipments)) for carrier_index in range(len(carriers))
+            if (shipment_index, carrier_index) not in table_responses
+        ]
+        for (shipment_index, carrier_index), carrier_response in table_responses.items():
+            self._record_quote(
+                app, carriers[carrier_index], shipments[shipment_index], carrier_response, monotonic() - started_at
+            )
+            yield (shipment_index, carrier_index), carrier_response
+
+        fanout = app.extensions['carrier_fanout']
+        started_at = monotonic()
+        with span('fanout', trace):
+            for live_index, carrier_response in fanout.iter_completed(
+                [(shipments[shipment_index], carriers[carrier_index]) for shipment_index, carrier_index in live_keys],
+                _request_carrier,
+                _handle_carrier_timeout,
+                _handle_carrier_failure,
+            ):
+                shipment_index, carrier_index = live_keys[live_index]
+                self._record_quote(
+                    app, carriers[carrier_index], shipments[shipment_index], carrier_response, monotonic() - started_at
+                )
+                yield live_keys[live_index], carrier_response
+
+    def _record_quote(self, app, carrier, shipment, carrier_response, latency):
+        """
+        Adds the given carrier response for the given shipment (that took the given latency, in secs) to the quote
+        history, without waiting for it to be written.
+        """
+        quote_history = app.extensions['quote_history']
+        if quote_history is not None:
+            # Imported here since the quote history is optional (see configure_api())
+            from app.quote_history import build_quote_record
+            quote_history.add(build_quote_record(carrier, shipment, carrier_response, latency))
+
+    def _quote_from_rate_tables(self, app, carriers, shipments):
+        """
+        Returns a dict with the responses computed from carriers' rate tables (all shipments at once for each carrier),
+        by (shipment index, carrier index). Carriers or shipments with no (fresh) rates are just left out.
+        """
+        rate_tables = app.extensions['rate_tables']
+        table_responses = {}
+        for carrier_index, carrier in enumerate(carriers):
+            shipments_costs = rate_tables.quote_many(carrier, shipments)
+            for shipment_index, costs in enumerate(shipments_costs or ()):
+                if costs is not None:
+                    cost = costs.get(app.config['DEFAULT_SHIPMENT_METHOD'], min(costs.values()))
+                    table_responses[shipment_index, carrier_index] = self._handle_carrier_response(
+                        carrier, Quote(status_code=200, cost=cost, costs=costs)
+                    )
+        return table_responses
+
+    def _request_carrier(self, app, carrier, shipment, trace=None):
+        """
+        Returns the response of the given carrier for the given shipment, using cached quotes whenever possible (stale
+        ones are refreshed in the background).
+
+        Since it's meant to be run in its own thread, it takes care of the app context itself (and it's given the
+        request's trace, if any).
+        """
+        quote_cache = app.extensions['quote_cache']
+        if quote_cache is not None:
+            cached_quote = quote_cache.get_cached_quote(carrier.code, shipment, carrier.account_id)
+            if cached_quote is not None:
+                quote_revalidator = app.extensions['quote_revalidator']
+                if cached_quote.fresh_until <= time() and quote_revalidator is not None:
+                    quote_revalidator.revalidate(
+                        (carrier.account_id, carrier.code) + normalize_shipment(shipment),
+                        lambda: self._fetch_carrier(app, carrier, shipment, cache_errors=False),
+                    )
+                return cached_quote.quote
+        return self._fetch_carrier(app, carrier, shipment, trace)
+
+    def _fetch_carrier(self, app, carrier, shipment, trace=None, **call_options):
+        """
+        Same as `_call_carrier()`, but identical calls in flight (e.g. bursts of the same request) share a single call
+        to the carrier.
+        """
+        single_flight = app.extensions['single_flight']
+        if single_flight is None:
+            return self._call_carrier(app, carrier, shipment, trace, **call_options)
+        return single_flight.do(
+            (carrier.account_id, carrier.code) + normalize_shipment(shipment),
+            lambda: self._call_carrier(app, carrier, shipment, trace, **call_options),
         )
-        # To disable self._verify_data()'s randomness so HTTP 400 is not raised
-        self.request_parser.add_argument('test_mode', type=bool, default=False)
 
-    def post(self):
-        response_data = []
-        request_data = self.request_parser.parse_args()
-        self._verify_data(request_data)
+    def _call_carrier(self, app, carrier, shipment, trace=None, cache_errors=True, warmed=False):
+        """
+        Returns the response of the given carrier for the given shipment, actually calling it (unless it's known to be
+        failing, or it's over its rate limit or quota), and caches it: errors only if asked to (refreshes shouldn't
+        replace a good stale quote with an error), and as warmed if it's the warming worker calling.
+        """
+        quote_cache = app.extensions['quote_cache']
+        circuit_breaker = None
+        if app.extensions['circuit_breakers'] is not None:
+            circuit_breaker = app.extensions['circuit_breakers'].get(carrier.code)
+            if not circuit_breaker.allow_request():
+                # Carrier known to be failing, no need to wait for it to fail again (nor to spend its quota)
+                return self._handle_carrier_response(carrier, Quote(status_code=503, cost=-1))
+        rate_limiter = None
+        if app.extensions['carrier_rate_limiters'] is not None:
+            rate_limiter = app.extensions['carrier_rate_limiters'].get(carrier)
+            rejection_reason = rate_limiter.acquire()
+            if rejection_reason is not None:
+                # Better to answer right away than to get throttled (or run out of credits) with the carrier
+                if circuit_breaker is not None:
+                    circuit_breaker.cancel_request()
+                instrumentation = get_instrumentation(app)
+                if instrumentation is not None:
+                    instrumentation.metrics.increment(
+                        'carrier_requests_rejected_total', carrier=carrier.code, reason=rejection_reason
+                    )
+                return self._handle_carrier_response(carrier, Quote(status_code=429, cost=-1))
+
+        carrier_adapter = get_carrier_adapter(carrier, app)
+        carrier_shipment = Shipment.from_data(shipment)
+        calls_count = count()
 
-        # Querying all carriers available
-        for carrier in Carrier.get_all_enabled():
-            carrier_api_endpoint_url = carrier.api_endpoint_url
+        def _quote():
+            if next(calls_count) and rate_limiter is not None:
+                # The first call was counted against the quota when acquired, hedged requests and retries count too
+                rate_limiter.record_call()
+            with app.app_context():
+                return carrier_adapter.quote(carrier_shipment)
 
-            # Small hack: using Flask's test client for our mocked carrier APIs, thus making requests from localhost and
-            # test cases succeed. Best approach is pointing to real APIs and mocking responses in test cases.
-            response = current_app.test_client().post(carrier.api_endpoint_url, json=request_data)
-            response_data.append(self._handle_carrier_response(carrier, response))
+        started_at = monotonic()
+        try:
+            with span('carrier.' + carrier.code, trace):
+                quote_hedger = app.extensions['quote_hedger']
+                if quote_hedger is not None:
+                    quote = quote_hedger.call(carrier.code, _quote, lambda quote: quote.status_code >= 500)
+                else:
+                    quote = _quote()
+        except Exception:
+            if circuit_breaker is not None:
+                # Counted as a failure (e.g. an adapter bug), otherwise a half-open circuit would keep waiting for it
+                circuit_breaker.record(False, monotonic() - started_at)
+            raise
+        duration = monotonic() - started_at
+        if circuit_breaker is not None:
+            circuit_breaker.record(not self._is_carrier_error(quote), duration)
+        instrumentation = get_instrumentation(app)
+        if instrumentation is not None:
+            instrumentation.record_carrier_call(carrier.code, quote.status_code, duration)
+        carrier_response = self._handle_carrier_response(carrier, quote)
+        if quote_cache is not None and (cache_errors or quote.status_code == 200):
+            quote_cache.set(
+                carrier.code, shipment, carrier_response, quote.status_code, carrier.account_id, warmed=warmed
+            )
+        return carrier_response
 
-        return response_data, 200
+    def _validate_shipment(self, shipment_data):
+        """
+        Returns a tuple with the parsed shipment (given as a dict) and an error message, only one of them being set.
+        """
+        if not isinstance(shipment_data, dict):
+            return None, 'Each shipment must be a valid JSON object'
+        try:
+            shipment = self.request_parser.parse_args(req=_ShipmentPayload(shipment_data))
+            self._verify_data(shipment)
+        except HTTPException as e:
+            return None, getattr(e, 'data', {}).get('message', e.description)
+        return shipment, None
 
     def _verify_data(self, data):
         """
@@ -78,22 +426,30 @@ class ShippingCostsEndpoint(Resource):
         if not data['test_mode'] and not random.choices((0, 1), weights=(0.3, 0.7), k=1)[0]:
             abort(400, message='Shame on you, check your input! https://i.imgur.com/NAJE0d0.png')
 
-    def _handle_carrier_response(self, carrier, response):
+    def _handle_carrier_response(self, carrier, quote):
         """
-        Method that takes the raw response from carriers' APIs and returns a dict with proper data to our API users.
+        Method that takes the quote given by a carrier's adapter and returns a dict with proper data to our API users.
 
-        Note that response is a Flask's Response object.
+        Note that carriers that timed out are given as an HTTP 504 quote, and the ones over their rate limit or quota
+        (either ours or the carrier's) as an HTTP 429 quote.
         """
         error_message = ''
         carrier_cost = -1
-        if response.status_code == 200:
-            # We're assuming their response is consistent
-            carrier_cost = response.get_json()['cost']
+        carrier_costs = {shipment_method: -1 for shipment_method in carrier.shipment_methods}
+        if quote.status_code == 200:
+            carrier_cost = quote.cost
+            carrier_costs.update(
+                (shipment_method, cost) for shipment_method, cost in (quote.costs or {}).items()
+                if shipment_method in carrier_costs
+            )
 
         # Error from carrier API
-        elif response.status_code == 404 or response.status_code >= 500:
+        elif self._is_carrier_error(quote):
             # In here, we would handle the carriers' API response accordingly (e.g. logging, email notification, ...)
             error_message = 'Blame {}! https://memegenerator.net/img/instances/44786501.jpg'.format(carrier.name)
+        # Too many requests to the carrier
+        elif quote.status_code == 429:
+            error_message = '{} is busy right now, try again later'.format(carrier.name)
         # Unexpected error
         else:
             error_message = "Whoops, our mistake! https://i.imgur.com/NAJE0d0.png"
@@ -102,13 +458,161 @@ class ShippingCostsEndpoint(Resource):
             'carrier': carrier.code,
             'error': error_message,
             'cost': carrier_cost,
+            'costs': carrier_costs,
         }
 
+    def _select_carrier_responses(self, carrier_responses, selection):
+        """
+        Returns the given carrier responses as they are, or, if a selection is given (see ShipmentSelection), a list
+        with only the response of the carrier with the cheapest/fastest shipment method (i.e. only with its cost), if
+        any carrier has a cost for it.
+        """
+        if selection is None:
+            return carrier_responses
+
+        methods_by_speed = current_app.config['SHIPMENT_METHODS_BY_SPEED']
+
+        def _get_rank(method, cost):
+            if selection == ShipmentSelection.CHEAPEST.value:
+                return cost
+            # Methods of unknown speed are taken as the slowest ones
+            return methods_by_speed.index(method) if method in methods_by_speed else len(methods_by_speed), cost
+
+        candidates = [
+            (_get_rank(method, cost), carrier_index, method, cost)
+            for carrier_index, carrier_response in enumerate(carrier_responses)
+            for method, cost in carrier_response['costs'].items() if cost >= 0
+        ]
+        if not candidates:
+            return []
+        _, carrier_index, method, cost = min(candidates)
+        return [dict(carrier_responses[carrier_index], cost=cost, costs={method: cost})]
+
+    def _is_carrier_error(self, quote):
+        return quote.status_code == 404 or quote.status_code >= 500
+
+
+class BatchShippingCostsEndpoint(ShippingCostsEndpoint):
+    """
+    API endpoint to get the shipping costs of many packages at once, given either as a JSON array of shipments or as
+    NDJSON (one shipment per line, using the 'application/x-ndjson' content type).
+
+    Each shipment is validated just like in ShippingCostsEndpoint, identical shipments are only quoted once, and results
+    are streamed back in the same order and format shipments were given, one record per shipment: either
+    `{"index": ..., "quotes": [{"carrier": ..., "cost": ..., "costs": ..., "error": ...}, ...]}` or
+    `{"index": ..., "message": ...}` for invalid shipments.
+    """
+    _NDJSON_MIMETYPE = NDJSON_MIMETYPE
+
+    @admission_controlled
+    def post(self, account_id=None):
+        verify_account(account_id)
+        is_ndjson = request.mimetype == self._NDJSON_MIMETYPE
+        shipments = self._load_shipments(is_ndjson)
+        max_shipments = current_app.config['SHIPPING_COSTS_BATCH_MAX_SHIPMENTS']
+        if len(shipments) > max_shipments:
+            abort(413, message='Up to {} shipments are allowed per batch'.format(max_shipments))
+
+        records = self._generate_records(shipments, account_id)
+        json_backend = get_json_backend()
+        if is_ndjson:
+            return Response(
+                stream_with_context(json_backend.dumps(record) + b'\n' for record in records),
+                mimetype=self._NDJSON_MIMETYPE,
+            )
+        return Response(
+            stream_with_context(self._generate_json_array(records, json_backend)), mimetype='application/json'
+        )
+
+    def _load_shipments(self, is_ndjson):
+        """
+        Returns the list of shipments given in the request, aborting with HTTP 400 if there's none.
+        """
+        if not is_ndjson:
+            shipments = request.get_json(silent=True)
+            if not isinstance(shipments, list):
+                abort(400, message='A JSON array of shipments is expected')
+            return shipments
+
+        shipments = []
+        for line in request.get_data(as_text=True).splitlines():
+            if line.strip():
+                try:
+                    shipments.append(json.loads(line))
+                except ValueError:
+                    shipments.append(None)  # Reported later on as an invalid shipment
+        return shipments
+
+    def _generate_records(self, shipments, account_id=None):
+        """
+        Yields the record for each one of the given shipments, in order, quoting them in chunks.
+        """
+        chunk_size = current_app.config['SHIPPING_COSTS_BATCH_CHUNK_SIZE']
+        quotes_by_shipment = {}
+        for chunk_start in range(0, len(shipments), chunk_size):
+            chunk = shipments[chunk_start:chunk_start + chunk_size]
+            validated_shipments = [self._validate_shipment(shipment_data) for shipment_data in chunk]
+            # Only shipments that weren't quoted yet (in this chunk or in previous ones)
+            shipments_to_quote = {}
+            for shipment, _ in validated_shipments:
+                if shipment is not None:
+                    shipment_key = normalize_shipment(shipment)
+                    if shipment_key not in quotes_by_shipment:
+                        shipments_to_quote.setdefault(shipment_key, shipment)
+            quotes = self._quote_shipments(list(shipments_to_quote.values()), account_id)
+            quotes_by_shipment.update(zip(shipments_to_quote, quotes))
+
+            for index, (shipment, error_message) in enumerate(validated_shipments, chunk_start):
+                if shipment is None:
+                    yield {'index': index, 'message': error_message}
+                else:
+                    carrier_responses = quotes_by_shipment[normalize_shipment(shipment)]
+                    yield {
+                        'index': index,
+                        'quotes': self._select_carrier_responses(carrier_responses, shipment['select']),
+                    }
+
+    def _generate_json_array(self, records, json_backend):
+        yield b'['
+        for i, record in enumerate(records):
+            yield (b',' if i else b'') + json_backend.dumps(record)
+        yield b']'
+
 
 def configure_api(app):
     """
     Attaches an API to the given Flask app.
+
+    Optional subsystems are only imported when enabled by the app's configuration, so processes don't load what they
+    don't use.
     """
+    configure_serialization(app)
+    configure_fanout(app)
+    configure_quote_cache(app)
+    app.extensions['quote_revalidator'] = None
+    if app.extensions['quote_cache'] is not None and app.config['QUOTE_CACHE_STALE_TTL'] > 0:
+        from app.quote_warming import configure_quote_revalidation
+        configure_quote_revalidation(app)
+    configure_single_flight(app)
+    configure_circuit_breakers(app)
+    configure_quote_hedger(app)
+    app.extensions['rate_tables'] = None
+    if app.config['QUOTE_MODE'] is QuoteMode.TABLE_FIRST:
+        from app.rate_tables import configure_rate_tables
+        configure_rate_tables(app)
+    configure_rate_limiting(app)
+    configure_admission_control(app)
+    app.extensions['quote_history'] = None
+    if app.config['QUOTE_HISTORY_ENABLED']:
+        from app.quote_history import configure_quote_history
+        configure_quote_history(app)
     api = Api(app)
-    api.add_resource(CarriersEndpoint, '/api/shipping/carriers')
-    api.add_resource(ShippingCostsEndpoint, '/api/shipping/costs')
+    api.representation('application/json')(output_json)
+    api.add_resource(CarriersEndpoint, '/api/shipping/carriers', '/api/accounts/<string:account_id>/shipping/carriers')
+    api.add_resource(CarriersHealthEndpoint, '/api/shipping/carriers/health')
+    api.add_resource(ShippingCostsEndpoint, '/api/shipping/costs', '/api/accounts/<string:account_id>/shipping/costs')
+    api.add_resource(
+        BatchShippingCostsEndpoint,
+        '/api/shipping/costs/batch',
+        '/api/accounts/<string:account_id>/shipping/costs/batch',
+    )
@@ -0,0 +1,387 @@
+# coding=utf-8
+
+
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import perf_counter
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+
+from app.adapters import Quote
+from app.admission import build_overloaded_response
+from app.api import (
+    STREAM_HEADERS, ShippingCostsEndpoint, format_stream_record, get_rendered_carriers, get_stream_mimetype,
+)
+from app.instrumentation import Trace, get_instrumentation, span
+from app.registry import get_carrier_registry
+from app.serialization import get_json_backend
+from config import QuoteMode
+
+
+class ShippingASGIApp(object):
+    """
+    asyncio-native ASGI app that serves our shipping API next to the regular Flask (WSGI) app.
+
+    `/api/shipping/carriers` and `/api/shipping/costs` are handled natively, with the same validations and response
+    schemas as their Flask-RESTful counterparts: a request waiting for carriers just awaits them, without tying up a
+    worker (carrier calls are offloaded to a shared thread pool of ASGI_MAX_WORKERS threads, so that's how many carrier
+    calls can be in flight at the same time), and streamed responses are sent as carriers answer.
+    Any other request is handed over to the Flask app, also in that thread pool (note that its responses are buffered,
+    not streamed).
+
+    Shipping costs requests are subject to admission control too, with their own concurrency limit
+    (ADMISSION_ASGI_MAX_CONCURRENCY, as they're cheap to hold in here) and never queued: requests over it are just
+    rejected. Native requests are instrumented just like
+    Flask's ones (metrics, sampled traces and slow requests), timed up to the start of their response.
+    """
+    _METHOD_NOT_ALLOWED_MESSAGE = 'The method is not allowed for the requested URL.'
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self._executor = ThreadPoolExecutor(
+            max_workers=flask_app.config['ASGI_MAX_WORKERS'], thread_name_prefix='asgi'
+        )
+        self._routes = {
+            '/api/shipping/carriers': ('GET', self._get_carriers),
+            '/api/shipping/costs': ('POST', self._post_shipping_costs),
+        }
+        self._slow_request_routes = set(flask_app.config['SLOW_REQUEST_ROUTES'])
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._handle_lifespan(receive, send)
+            return
+
+        route = self._routes.get(scope['path'])
+        if route is None:
+            await self._call_flask_app(scope, receive, send)
+            return
+        await self._handle_instrumented(scope, receive, send, *route)
+
+    def run(self, host='127.0.0.1', port=5000):
+        """
+        Runs this app in a local development server.
+        """
+        # Optional dependency, only needed to serve the app in ASGI mode
+        import uvicorn
+        uvicorn.run(self, host=host, port=port)
+
+    async def _handle_instrumented(self, scope, receive, send, method, handler):
+        """
+        Handles the given request with the given handler (if it's for the given method), recording it just like Flask's
+        request hooks do: its metrics, its Trace (if sampled, also given as a Server-Timing header) and whether it was
+        slow, all of them when its response starts.
+        """
+        instrumentation = get_instrumentation(self.flask_app)
+        slow_request_log = self.flask_app.extensions['slow_request_log']
+        if slow_request_log is not None and scope['path'] not in self._slow_request_routes:
+            slow_request_log = None
+        trace = instrumentation.start_trace() if instrumentation is not None else None
+        if trace is None and slow_request_log is not None:
+            # All their stages are timed (not only the sampled ones), in case they turn out to be slow
+            trace = Trace(sampled=False)
+        started_at = perf_counter()
+        request_body = []
+
+        async def _receive():
+            message = await receive()
+            request_body.append(message.get('body', b''))
+            return message
+
+        async def _send(message):
+            if message['type'] == 'http.response.start':
+                duration = perf_counter() - started_at
+                if instrumentation is not None:
+                    server_timing = instrumentation.record_request(
+                        scope['path'], scope['method'], message['status'], duration, trace
+                    )
+                    if server_timing is not None:
+                        message = dict(message, headers=list(message['headers']) + [
+                            (b'server-timing', server_timing.encode('latin-1')),
+                        ])
+                if slow_request_log is not None:
+                    slow_request_log.add(
+                        scope['method'], scope['path'], message['status'], duration, trace, b''.join(request_body)
+                    )
+            await send(message)
+
+        if scope['method'] != method:
+            allow_header = (b'allow', method.encode())
+            await self._send_json(_send, 405, {'message': self._METHOD_NOT_ALLOWED_MESSAGE}, [allow_header])
+            return
+        await handler(scope, _receive, _send, trace)
+
+    async def _get_carriers(self, scope, receive, send, trace):
+        body, etag = await self._run_in_app_context(get_rendered_carriers)
+        headers = [(b'etag', quote_etag(etag).encode()), (b'cache-control', b'no-cache')]
+        if_none_match = dict(scope.get('headers', [])).get(b'if-none-match', b'').decode('latin-1')
+        if parse_etags(if_none_match).contains(etag):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        await self._send_body(send, 200, body, headers)
+
+    async def _post_shipping_costs(self, scope, receive, send, trace):
+        admission_controller = self.flask_app.extensions['asgi_admission_controller']
+        if admission_controller is not None and not admission_controller.acquire(timeout=0):
+            response_data, status, headers = build_overloaded_response(self.flask_app.config)
+            headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+            await self._send_json(send, status, response_data, headers)
+            return
+        try:
+            await self._quote_shipping_costs(scope, receive, send, trace)
+        finally:
+            if admission_controller is not None:
+                admission_controller.release()
+
+    async def _quote_shipping_costs(self, scope, receive, send, trace):
+        with span('parse', trace):
+            body = await self._read_body(receive)
+            try:
+                shipment_data = json.loads(body.decode('utf-8')) if body else {}
+            except ValueError:
+                shipment_data = None
+        if shipment_data is None:
+            await self._send_json(send, 400, {'message': 'Failed to decode JSON object'})
+            return
+
+        endpoint = ShippingCostsEndpoint()
+        with span('verify', trace):
+            shipment, error_message = await self._run_in_app_context(endpoint._validate_shipment, shipment_data)
+        if error_message is not None:
+            await self._send_json(send, 400, {'message': error_message})
+            return
+
+        with span('carriers', trace):
+            carriers = await self._run_in_app_context(lambda: get_carrier_registry().get_all_enabled())
+        carrier_responses = self._iter_carrier_responses(endpoint, carriers, shipment, trace)
+        accept_header = dict(scope.get('headers', [])).get(b'accept', b'').decode('latin-1')
+        stream_mimetype = get_stream_mimetype(parse_accept_header(accept_header, MIMEAccept))
+        if stream_mimetype is not None:
+            await self._send_stream(send, stream_mimetype, endpoint, shipment, carrier_responses)
+            return
+
+        response_data = [None] * len(carriers)
+        with span('fanout', trace):
+            async for carrier_index, carrier_response in carrier_responses:
+                response_data[carrier_index] = carrier_response
+        response_data = await self._run_in_app_context(
+            endpoint._select_carrier_responses, response_data, shipment['select']
+        )
+        await self._send_json(send, 200, response_data)
+
+    async def _iter_carrier_responses(self, endpoint, carriers, shipment, trace=None):
+        """
+        Yields a tuple with the index of each one of the given carriers and its response for the given shipment, as
+        soon as it's ready: first the ones quoted from their rate tables, then the others (all of them queried at the
+        same time) as they answer. All responses are kept in the quote history.
+        """
+        config = self.flask_app.config
+        loop = asyncio.get_event_loop()
+        started_at = loop.time()
+        table_responses = {}
+        if config['QUOTE_MODE'] is QuoteMode.TABLE_FIRST:
+            with span('rate_tables', trace):
+                table_responses = await self._run_in_app_context(
+                    endpoint._quote_from_rate_tables, self.flask_app, carriers, [shipment]
+                )
+
+        def _record(carrier_index, carrier_response):
+            endpoint._record_quote(
+                self.flask_app, carriers[carrier_index], shipment, carrier_response, loop.time() - started_at
+            )
+            return carrier_index, carrier_response
+
+        for (_, carrier_index), carrier_response in table_responses.items():
+            yield _record(carrier_index, carrier_response)
+
+        started_at = loop.time()
+        carrier_tasks = {
+            asyncio.ensure_future(self._request_carrier(endpoint, carrier, shipment, trace)): carrier_index
+            for carrier_index, carrier in enumerate(carriers) if (0, carrier_index) not in table_responses
+        }
+        deadline_at = loop.time() + config['SHIPPING_COSTS_DEADLINE']
+        pending = set(carrier_tasks)
+        try:
+            while pending and loop.time() < deadline_at:
+                done, pending = await asyncio.wait(
+                    pending, timeout=deadline_at - loop.time(), return_when=asyncio.FIRST_COMPLETED
+                )
+                for carrier_task in sorted(done, key=carrier_tasks.get):
+                    carrier_index = carrier_tasks[carrier_task]
+                    if carrier_task.exception() is None:
+                        yield _record(carrier_index, carrier_task.result())
+                    else:
+                        # Timed out, or failed: either way, it only fails this carrier's quote
+                        timed_out = isinstance(carrier_task.exception(), asyncio.TimeoutError)
+                        yield _record(carrier_index, endpoint._handle_carrier_response(
+                            carriers[carrier_index], Quote(status_code=504 if timed_out else 502, cost=-1)
+                        ))
+        finally:
+            for carrier_task in pending:
+                carrier_task.cancel()
+        # Carriers that missed the deadline
+        for carrier_task in sorted(pending, key=carrier_tasks.get):
+            carrier_index = carrier_tasks[carrier_task]
+            yield _record(carrier_index, endpoint._handle_carrier_response(
+                carriers[carrier_index], Quote(status_code=504, cost=-1)
+            ))
+
+    async def _request_carrier(self, endpoint, carrier, shipment, trace=None):
+        """
+        Returns the response of the given carrier for the given shipment, requested in the thread pool. Just like in
+        CarrierFanout, its timeout is counted from the moment the call actually starts running (not while it's queued
+        for a thread), raising asyncio.TimeoutError once it's over.
+        """
+        loop = asyncio.get_event_loop()
+        carrier_timeout = self.flask_app.config['CARRIER_TIMEOUT']
+        started_at = []
+
+        def _request():
+            started_at.append(loop.time())
+            return endpoint._request_carrier(self.flask_app, carrier, shipment, trace)
+
+        future = loop.run_in_executor(self._executor, _request)
+        try:
+            while True:
+                # Until the call starts, it's waited for as if it had just started
+                timeout = started_at[0] + carrier_timeout - loop.time() if started_at else carrier_timeout
+                if timeout <= 0:
+                    raise asyncio.TimeoutError()
+                done, _ = await asyncio.wait([future], timeout=timeout)
+                if done:
+                    return future.result()
+        finally:
+            future.cancel()  # Only possible for calls still queued, running ones are left to finish on their own
+
+    async def _send_stream(self, send, mimetype, endpoint, shipment, carrier_responses):
+        """
+        Sends the given carrier responses as soon as they're ready, and then their summary, in the given streaming
+        format.
+        """
+        started_at = asyncio.get_event_loop().time()
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', mimetype.encode())] + [
+                (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in STREAM_HEADERS.items()
+            ],
+        })
+        sent_responses = []
+        async for _, carrier_response in carrier_responses:
+            sent_responses.append(carrier_response)
+            body = format_stream_record(mimetype, carrier_response).encode('utf-8')
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        summary = await self._run_in_app_context(
+            endpoint._build_summary,
+            sent_responses,
+            shipment['select'],
+            asyncio.get_event_loop().time() - started_at,
+        )
+        body = format_stream_record(mimetype, summary, is_summary=True).encode('utf-8')
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _run_in_app_context(self, func, *args):
+        """
+        Runs the given function in the thread pool, within the Flask app context.
+        """
+        def _run():
+            with self.flask_app.app_context():
+                return func(*args)
+        return await asyncio.get_event_loop().run_in_executor(self._executor, _run)
+
+    async def _call_flask_app(self, scope, receive, send):
+        """
+        Handles the given request using the Flask app, as a WSGI server would.
+        """
+        environ = self._build_wsgi_environ(scope, await self._read_body(receive))
+        response_start = {}
+
+        def _start_response(status, headers, exc_info=None):
+            response_start['status'] = int(status.split(' ', 1)[0])
+            response_start['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers
+            ]
+
+        def _run_flask_app():
+            response = self.flask_app(environ, _start_response)
+            try:
+                return b''.join(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+
+        body = await asyncio.get_event_loop().run_in_executor(self._executor, _run_flask_app)
+        await send({
+            'type': 'http.response.start', 'status': response_start['status'], 'headers': response_start['headers'],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    def _build_wsgi_environ(self, scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = 'HTTP_' + name
+                environ[key] = '{},{}'.format(environ[key], value) if key in environ else value
+        return environ
+
+    async def _read_body(self, receive):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        return body
+
+    async def _send_json(self, send, status, data, headers=()):
+        await self._send_body(send, status, get_json_backend(self.flask_app).dumps(data), headers)
+
+    async def _send_body(self, send, status, body, headers=()):
+        """
+        Sends the given JSON body (bytes) as a whole.
+        """
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())
+            ] + list(headers),
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
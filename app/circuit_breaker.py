@@ -0,0 +1,209 @@
+# coding=utf-8
+
+
+import json
+from threading import Lock
+from time import time
+
+from app.enums import CircuitState
+from app.shared_store import connect_shared_store
+
+
+class LocalCircuitStateStore(object):
+    """
+    Keeps circuit breakers' states in this process' memory.
+    """
+
+    def __init__(self):
+        self._states = {}
+
+    def get(self, carrier_code):
+        return self._states.get(carrier_code)
+
+    def set(self, carrier_code, state):
+        self._states[carrier_code] = state
+
+
+class SharedCircuitStateStore(object):
+    """
+    Keeps circuit breakers' states in a store shared by all processes (e.g. Redis), so all workers agree on carriers'
+    health. The given client must have a Redis-like interface: `get(key)` and `set(key, value)`.
+
+    Concurrent updates from different processes are last-writer-wins, which is good enough to track health.
+    """
+
+    def __init__(self, client, key_prefix='shiphero:circuits:'):
+        self.client = client
+        self.key_prefix = key_prefix
+
+    def get(self, carrier_code):
+        raw_state = self.client.get(self.key_prefix + carrier_code)
+        return json.loads(raw_state) if raw_state is not None else None
+
+    def set(self, carrier_code, state):
+        self.client.set(self.key_prefix + carrier_code, json.dumps(state))
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for a single carrier, driven by its error rate and its latency over a rolling window.
+
+    - Closed: all requests go through. If too many of them fail or are too slow, the circuit opens
+    - Open: all requests fail fast. After a while, the circuit becomes half-open
+    - Half-open: only a few probe requests go through. The circuit closes if they succeed, or opens again otherwise.
+      Probes whose outcome never gets recorded (e.g. hung calls) are given up after the open duration, so more probes
+      can go through
+    """
+
+    def __init__(self, carrier_code, store, window, min_requests, error_rate_threshold, slow_call_duration,
+                 slow_call_rate_threshold, open_duration, half_open_probes):
+        self.carrier_code = carrier_code
+        self.store = store
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate_threshold = error_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_duration = open_duration
+        self.half_open_probes = half_open_probes
+        self._lock = Lock()
+
+    def allow_request(self):
+        """
+        Returns whether a request to the carrier should be done right now or not (i.e. fail fast).
+        """
+        with self._lock:
+            state = self._load_state()
+            if state['state'] == CircuitState.CLOSED.value:
+                return True
+            if state['state'] == CircuitState.OPEN.value:
+                if time() - state['opened_at'] < self.open_duration:
+                    return False
+                state.update(state=CircuitState.HALF_OPEN.value, probes=0, half_opened_at=time())
+            if state['probes'] >= self.half_open_probes:
+                if time() - state.get('half_opened_at', 0) < self.open_duration:
+                    return False
+                state.update(probes=0, half_opened_at=time())  # In-flight probes given up
+            state['probes'] += 1
+            self.store.set(self.carrier_code, state)
+            return True
+
+    def cancel_request(self):
+        """
+        Takes back a request allowed by `allow_request()` that wasn't done after all (e.g. it was rate limited), so a
+        half-open circuit doesn't wait for its outcome.
+        """
+        with self._lock:
+            state = self._load_state()
+            if state['state'] == CircuitState.HALF_OPEN.value and state['probes'] > 0:
+                state['probes'] -= 1
+                self.store.set(self.carrier_code, state)
+
+    def record(self, success, latency):
+        """
+        Records the outcome of a request to the carrier (and its latency, in secs).
+        """
+        with self._lock:
+            state = self._load_state()
+            is_slow = latency >= self.slow_call_duration
+            if state['state'] == CircuitState.HALF_OPEN.value:
+                if success and not is_slow:
+                    state.update(state=CircuitState.CLOSED.value, buckets=[])
+                else:
+                    state.update(state=CircuitState.OPEN.value, opened_at=time())
+            else:
+                self._add_to_window(state, success, is_slow, latency)
+                if state['state'] == CircuitState.CLOSED.value and self._should_open(state):
+                    state.update(state=CircuitState.OPEN.value, opened_at=time())
+            self.store.set(self.carrier_code, state)
+
+    def get_health(self):
+        """
+        Returns a dict with the current state of the circuit and its stats over the rolling window.
+        """
+        state = self._load_state()
+        requests_count, failures_count, slow_calls_count, latency_sum = self._sum_window(state)
+        return {
+            'carrier': self.carrier_code,
+            'state': state['state'],
+            'requests': requests_count,
+            'error_rate': failures_count / requests_count if requests_count else 0.0,
+            'slow_call_rate': slow_calls_count / requests_count if requests_count else 0.0,
+            'average_latency': latency_sum / requests_count if requests_count else 0.0,
+        }
+
+    def _load_state(self):
+        state = self.store.get(self.carrier_code)
+        if state is None:
+            state = {'state': CircuitState.CLOSED.value, 'opened_at': 0, 'probes': 0, 'buckets': []}
+        return state
+
+    def _add_to_window(self, state, success, is_slow, latency):
+        """
+        Adds the given outcome to the rolling window, which is made of 1-sec buckets:
+        [second, requests count, failures count, slow calls count, latency sum].
+        """
+        now = int(time())
+        buckets = [bucket for bucket in state['buckets'] if now - bucket[0] < self.window]
+        if not buckets or buckets[-1][0] != now:
+            buckets.append([now, 0, 0, 0, 0.0])
+        buckets[-1][1] += 1
+        buckets[-1][2] += 0 if success else 1
+        buckets[-1][3] += 1 if is_slow else 0
+        buckets[-1][4] += latency
+        state['buckets'] = buckets
+
+    def _sum_window(self, state):
+        now = int(time())
+        buckets = [bucket for bucket in state['buckets'] if now - bucket[0] < self.window]
+        return tuple(sum(bucket[i] for bucket in buckets) for i in range(1, 5))
+
+    def _should_open(self, state):
+        requests_count, failures_count, slow_calls_count, _ = self._sum_window(state)
+        if requests_count < self.min_requests:
+            return False
+        return failures_count / requests_count >= self.error_rate_threshold or \
+            slow_calls_count / requests_count >= self.slow_call_rate_threshold
+
+
+class CircuitBreakers(object):
+    """
+    All carriers' circuit breakers, created on demand and sharing the same settings.
+    """
+
+    def __init__(self, store, **settings):
+        self.store = store
+        self.settings = settings
+        self._breakers = {}
+        self._lock = Lock()
+
+    def get(self, carrier_code):
+        breaker = self._breakers.get(carrier_code)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    carrier_code, CircuitBreaker(carrier_code, self.store, **self.settings)
+                )
+        return breaker
+
+
+def configure_circuit_breakers(app):
+    """
+    Attaches carriers' circuit breakers to the given Flask app, using its configuration.
+    """
+    circuit_breakers = None
+    if app.config['CIRCUIT_BREAKER_ENABLED']:
+        store = LocalCircuitStateStore()
+        if app.config['CIRCUIT_BREAKER_SHARED_STORE_URL']:
+            store = SharedCircuitStateStore(connect_shared_store(app.config['CIRCUIT_BREAKER_SHARED_STORE_URL']))
+        circuit_breakers = CircuitBreakers(
+            store=store,
+            window=app.config['CIRCUIT_BREAKER_WINDOW'],
+            min_requests=app.config['CIRCUIT_BREAKER_MIN_REQUESTS'],
+            error_rate_threshold=app.config['CIRCUIT_BREAKER_ERROR_RATE'],
+            slow_call_duration=app.config['CIRCUIT_BREAKER_SLOW_CALL_DURATION'],
+            slow_call_rate_threshold=app.config['CIRCUIT_BREAKER_SLOW_CALL_RATE'],
+            open_duration=app.config['CIRCUIT_BREAKER_OPEN_DURATION'],
+            half_open_probes=app.config['CIRCUIT_BREAKER_HALF_OPEN_PROBES'],
+        )
+    app.extensions['circuit_breakers'] = circuit_breakers
@@ -0,0 +1,116 @@
+# coding=utf-8
+
+
+import random
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker
+
+from app.instrumentation import get_instrumentation
+
+
+def build_engine_options(config, database_url):
+    """
+    Returns the options of the engine (i.e. its connection pool) to connect to the given DB, using the given config.
+
+    Pool sizes and statement timeouts are only set for DBs supporting them, so SQLite can still be used as a stand-in.
+    """
+    engine_options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+    backend_name = make_url(database_url).get_backend_name() if database_url else None
+    if backend_name != 'sqlite':
+        engine_options.update(
+            pool_size=config['DB_POOL_SIZE'],
+            max_overflow=config['DB_MAX_OVERFLOW'],
+            pool_timeout=config['DB_POOL_TIMEOUT'],
+            pool_recycle=config['DB_POOL_RECYCLE'],
+        )
+    if backend_name in ('postgresql', 'postgres') and config['DB_STATEMENT_TIMEOUT']:
+        engine_options['connect_args'] = {'options': '-c statement_timeout={}'.format(config['DB_STATEMENT_TIMEOUT'])}
+    return engine_options
+
+
+def get_pool_stats(engine):
+    """
+    Returns a dict with the current usage of the given engine's connection pool (only what its pool type supports).
+    """
+    pool = engine.pool
+    pool_stats = {}
+    for stat_name, method_name in (
+        ('size', 'size'), ('checked_in', 'checkedin'), ('checked_out', 'checkedout'), ('overflow', 'overflow'),
+    ):
+        method = getattr(pool, method_name, None)
+        if method is not None:
+            pool_stats[stat_name] = method()
+    return pool_stats
+
+
+class ReadReplicas(object):
+    """
+    Engines to read from DB replicas, one of them picked at random for every read session.
+
+    Replicas may lag behind the primary DB, so they're meant for reads that can tolerate it (e.g. carriers, that are
+    cached anyway). Any write must go through the primary DB (i.e. `db.session`).
+    """
+
+    def __init__(self, urls, engine_options):
+        self.engines = [create_engine(url, **engine_options) for url in urls]
+        self._session_factory = sessionmaker()
+
+    @contextmanager
+    def session(self):
+        session = self._session_factory(bind=random.choice(self.engines))
+        try:
+            yield session
+        finally:
+            session.close()
+
+
+@contextmanager
+def read_session(use_replica=True):
+    """
+    Context manager that gives a session to read from the DB: from one of its replicas if there's any (and it's asked
+    to), or from the primary DB otherwise.
+
+    Objects loaded from replicas are detached from their session, but can still be added to `db.session` to be saved.
+    """
+    # Imported here since models read through this very function
+    from app.models import db
+
+    replicas = current_app.extensions['db_replicas']
+    if not use_replica or replicas is None:
+        yield db.session
+        return
+    with replicas.session() as session:
+        yield session
+
+
+def configure_db_routing(app):
+    """
+    Attaches the DB replicas (if any) to the given Flask app, along with its pools' metrics, using its configuration.
+    """
+    # Imported here since models read through this module
+    from app.models import db
+
+    replicas = None
+    if app.config['DB_REPLICA_URLS']:
+        replicas = ReadReplicas(
+            app.config['DB_REPLICA_URLS'],
+            build_engine_options(app.config, app.config['DB_REPLICA_URLS'][0]),
+        )
+    app.extensions['db_replicas'] = replicas
+
+    instrumentation = get_instrumentation(app)
+    if instrumentation is not None:
+        def _collect_pool_metrics(metrics):
+            engines = [('primary', db.engine)]  # Only created (not connected) on first use, within the app context
+            replicas = app.extensions['db_replicas']
+            if replicas is not None:
+                engines.extend(('replica_{}'.format(i), engine) for i, engine in enumerate(replicas.engines))
+            for db_name, engine in engines:
+                for stat_name, value in get_pool_stats(engine).items():
+                    metrics.set_gauge('db_pool_connections', value, db=db_name, state=stat_name)
+
+        instrumentation.metrics.add_collector(_collect_pool_metrics)
@@ -29,4 +29,25 @@ class BoxType(Enum):
 
     @classmethod
     def choices(cls):
-        return [e.value for e in cls]
\ No newline at end of file
+        return [e.value for e in cls]
+
+
+class CircuitState(Enum):
+    """
+    Enum that represents all possible states of a carrier's circuit breaker.
+    """
+    CLOSED = 'closed'  # Carrier is healthy, all requests go through
+    OPEN = 'open'  # Carrier is failing, all requests fail fast
+    HALF_OPEN = 'half_open'  # Carrier might have recovered, only a few probe requests go through
+
+
+class ShipmentSelection(Enum):
+    """
+    Enum that represents all possible ways to select a single shipment method across all carriers.
+    """
+    CHEAPEST = 'cheapest'
+    FASTEST = 'fastest'
+
+    @classmethod
+    def choices(cls):
+        return [e.value for e in cls]
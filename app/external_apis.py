@@ -1,58 +1,44 @@
 # coding=utf-8
 
 
-import os
-import random
-from time import time
-
-import requests
 from flask import current_app
-from flask_restful import reqparse, abort, Api, Resource
+from flask_restful import abort, Api
 
-from app import api, enums
+from app import api
+from app.adapters import Shipment, get_mock_carrier_adapter
+from app.quote_cache import normalize_shipment
+from app.registry import get_carrier_registry
 
 # _FAKEJSON_API_ENDPOINT = 'https://app.fakejson.com/q'
 # _FAKEJSON_API_TOKEN = 'tQPCEIEG76UMGolsVx6paQ'
 
 
-def _build_fakejson_request_data(response_code, original_data):
-    """
-    Returns a dict with valid data to use in fakeJSON queries.
-    """
-    return_success = response_code == 200
-    request_data = {
-        'token': current_app.config['FAKEJSON_API_TOKEN'],
-        'data': {
-            'error_code': 0 if return_success else response_code,
-            'reason': 'OK' if return_success else 'Error {}'.format(response_code),
-            'timestamp': 'timeNow',
-            'request_data': original_data,
-        }
-    }
-    if return_success:
-        request_data['data']['cost'] = 'numberInt'
-    return request_data
-
-
 class CarriersMockEndpoint(api.ShippingCostsEndpoint):
     """
-    API endpoint logic to mock interactions with any carrier using fakeJSON.
+    API endpoint to mock interactions with any carrier over HTTP.
+
+    It's just a thin wrapper around the adapter our API uses internally for mocked carriers: the carrier simulator if
+    enabled, MockCarrierAdapter (fakeJSON) otherwise.
     """
 
     def post(self, carrier_code):
         # Since we already verified the data, we assume is clean and complies to carrier's API
-        original_data = self.request_parser.parse_args()
-
-        # Choosing randomly if our request will succeed or not (90% chance of success)
-        response_code = 200 if original_data['test_mode'] else random.choices((200, 500), weights=(0.9, 0.1), k=1)[0]
-
-        # Hitting fakeJSON's API
-        request_data = _build_fakejson_request_data(response_code, original_data)
-        response = requests.post(current_app.config['FAKEJSON_API_ENDPOINT'], json=request_data, params={'x': time()})
-        if response.text.startswith('Error'):
-            # fakeJSON issues (most likely we ran out of daily credits with them
-            return {'cost': 123}, response_code  # Dummy response
-        return response.json(), response_code
+        request_data = self.request_parser.parse_args()
+        shipment = Shipment.from_data(request_data)
+        carrier = get_carrier_registry().get_by_code(carrier_code)
+        if carrier is None:
+            abort(404, message='Unknown carrier: {}'.format(carrier_code))
+
+        def _quote():
+            return dict(get_mock_carrier_adapter(carrier).quote(shipment)._asdict())
+
+        single_flight = current_app.extensions['single_flight']
+        if single_flight is None:
+            quote = _quote()
+        else:
+            # Identical requests in flight share a single outbound call
+            quote = single_flight.do(('mock', carrier_code) + normalize_shipment(request_data), _quote)
+        return {'cost': quote['cost'], 'costs': quote['costs']}, quote['status_code']
 
 
 def configure_external_apis(app):
@@ -0,0 +1,101 @@
+# coding=utf-8
+
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic
+
+
+class CarrierFanout(object):
+    """
+    Calls all given carriers concurrently using a bounded thread pool.
+
+    Every carrier call has its own timeout (counted from the moment it actually starts running) and the whole fan-out
+    has an overall deadline, so the response time tracks the slowest carrier instead of the sum of all of them. A call
+    that raises only fails its own carrier, never the whole fan-out.
+    """
+
+    def __init__(self, max_workers, carrier_timeout, deadline):
+        self.carrier_timeout = carrier_timeout
+        self.deadline = deadline
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='carrier-fanout')
+
+    def run(self, carriers, call, on_timeout, on_error=None):
+        """
+        Returns a list with the result of `call(carrier)` for each carrier, in the same order as `carriers`.
+
+        Carriers that miss their timeout or the overall deadline get `on_timeout(carrier)` instead, without waiting for
+        them to finish, and the ones whose call raises get `on_error(carrier)` (by default, the same as a timeout).
+        """
+        results = [None] * len(carriers)
+        for index, result in self.iter_completed(carriers, call, on_timeout, on_error):
+            results[index] = result
+        return results
+
+    def iter_completed(self, carriers, call, on_timeout, on_error=None):
+        """
+        Same as `run()`, but yields a tuple with the index of each carrier and its result as soon as its call completes
+        (carriers that miss their timeout or the deadline coming last).
+
+        Carriers still queued are cancelled if the generator is closed before it's exhausted.
+        """
+        started_at = {}
+        on_error = on_error or on_timeout
+
+        def _timed_call(index, carrier):
+            started_at[index] = monotonic()
+            try:
+                return call(carrier)
+            except Exception:
+                return on_error(carrier)
+
+        futures = [self._executor.submit(_timed_call, index, carrier) for index, carrier in enumerate(carriers)]
+        indexes = {future: index for index, future in enumerate(futures)}
+        deadline_at = monotonic() + self.deadline
+        pending = set(futures)
+
+        try:
+            while pending:
+                now = monotonic()
+                # Carriers still queued in the pool haven't started their own timeout yet
+                carrier_deadlines = [
+                    started_at[indexes[f]] + self.carrier_timeout for f in pending if indexes[f] in started_at
+                ]
+                wake_up_at = min([deadline_at] + carrier_deadlines)
+                if wake_up_at <= now:
+                    if now >= deadline_at:
+                        break
+                    pending = {f for f in pending if indexes[f] not in started_at or
+                               started_at[indexes[f]] + self.carrier_timeout > now}
+                    continue
+                done, pending = wait(pending, timeout=wake_up_at - now, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=indexes.get):
+                    yield indexes[future], future.result()
+                    futures[indexes[future]] = None
+
+            for index, (carrier, future) in enumerate(zip(carriers, futures)):
+                if future is None:
+                    continue  # Already yielded
+                if future.done() and not future.cancelled():
+                    yield index, future.result()
+                else:
+                    # Only possible for calls still queued, running ones are left to finish on their own
+                    future.cancel()
+                    yield index, on_timeout(carrier)
+        finally:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def configure_fanout(app):
+    """
+    Attaches a carrier fan-out engine to the given Flask app, using its configuration.
+    """
+    app.extensions['carrier_fanout'] = CarrierFanout(
+        max_workers=app.config['CARRIER_FANOUT_MAX_WORKERS'],
+        carrier_timeout=app.config['CARRIER_TIMEOUT'],
+        deadline=app.config['SHIPPING_COSTS_DEADLINE'],
+    )
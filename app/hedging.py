@@ -0,0 +1,173 @@
+# coding=utf-8
+
+
+import math
+import random
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock
+from time import monotonic, sleep
+
+
+class LatencyTracker(object):
+    """
+    Keeps the latest latencies (in secs) observed for a carrier, to know what "too slow" means for it.
+    """
+
+    def __init__(self, sample_size, min_samples):
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=sample_size)
+
+    def record(self, latency):
+        self._latencies.append(latency)
+
+    def get_percentile(self, percentile):
+        """
+        Returns the given percentile (e.g. 0.95) of the observed latencies, or None if there aren't enough of them.
+        """
+        latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[max(0, int(math.ceil(percentile * len(latencies))) - 1)]
+
+
+class RetryBudget(object):
+    """
+    Caps the extra load caused by hedged requests and retries to a ratio of the regular requests (e.g. 10%), so they
+    don't amplify an outage.
+
+    Every regular request deposits `ratio` tokens (up to `max_tokens`, which is also the initial balance) and every
+    extra request withdraws a whole one.
+    """
+
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class QuoteHedger(object):
+    """
+    Runs carriers' quote calls with hedging and retries, both capped by a global retry budget.
+
+    - Hedging: if a carrier hasn't answered within its observed latency percentile (e.g. p95), one duplicate request is
+      sent and whichever returns first is used
+    - Retries: failed calls are retried (they're idempotent) after a jittered exponential backoff
+    """
+
+    def __init__(self, max_workers, percentile, sample_size, min_samples, max_retries, retry_backoff, budget):
+        self.percentile = percentile
+        self.sample_size = sample_size
+        self.min_samples = min_samples
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.budget = budget
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='quote-hedger')
+        self._latency_trackers = {}
+        self._counters = {}
+        self._lock = Lock()
+
+    def call(self, carrier_code, quote_func, is_retryable):
+        """
+        Returns the result of `quote_func()`, calling it as many times as needed (and allowed) for the given carrier.
+
+        `is_retryable(result)` tells whether a result is a failure worth retrying or not.
+        """
+        self.budget.deposit()
+        retries_count = 0
+        while True:
+            result = self._call_hedged(carrier_code, quote_func)
+            if not is_retryable(result) or retries_count >= self.max_retries:
+                return result
+            if not self.budget.try_withdraw():
+                self._count(carrier_code, 'budget_denials')
+                return result
+            retries_count += 1
+            self._count(carrier_code, 'retries')
+            sleep(random.uniform(0, self.retry_backoff * 2 ** (retries_count - 1)))  # "Full jitter" backoff
+
+    def get_stats(self, carrier_code):
+        """
+        Returns a dict with the hedging/retry counters of the given carrier.
+        """
+        counters = self._counters.get(carrier_code, Counter())
+        return {
+            'hedge_delay': self._get_latency_tracker(carrier_code).get_percentile(self.percentile),
+            'hedges': counters['hedges'],
+            'hedge_wins': counters['hedge_wins'],
+            'retries': counters['retries'],
+            'budget_denials': counters['budget_denials'],
+        }
+
+    def _call_hedged(self, carrier_code, quote_func):
+        hedge_delay = self._get_latency_tracker(carrier_code).get_percentile(self.percentile)
+        primary_call = self._submit(carrier_code, quote_func)
+        if hedge_delay is None or wait([primary_call], timeout=hedge_delay).done:
+            return primary_call.result()
+        if not self.budget.try_withdraw():
+            self._count(carrier_code, 'budget_denials')
+            return primary_call.result()
+
+        self._count(carrier_code, 'hedges')
+        hedged_call = self._submit(carrier_code, quote_func)
+        done, _ = wait([primary_call, hedged_call], return_when=FIRST_COMPLETED)
+        if primary_call in done:
+            return primary_call.result()
+        self._count(carrier_code, 'hedge_wins')
+        return hedged_call.result()
+
+    def _submit(self, carrier_code, quote_func):
+        latency_tracker = self._get_latency_tracker(carrier_code)
+
+        def _timed_quote_func():
+            started_at = monotonic()
+            result = quote_func()
+            latency_tracker.record(monotonic() - started_at)
+            return result
+
+        return self._executor.submit(_timed_quote_func)
+
+    def _get_latency_tracker(self, carrier_code):
+        latency_tracker = self._latency_trackers.get(carrier_code)
+        if latency_tracker is None:
+            with self._lock:
+                latency_tracker = self._latency_trackers.setdefault(
+                    carrier_code, LatencyTracker(sample_size=self.sample_size, min_samples=self.min_samples)
+                )
+        return latency_tracker
+
+    def _count(self, carrier_code, counter_name):
+        with self._lock:
+            self._counters.setdefault(carrier_code, Counter())[counter_name] += 1
+
+
+def configure_quote_hedger(app):
+    """
+    Attaches a quote hedger to the given Flask app, using its configuration.
+    """
+    quote_hedger = None
+    if app.config['HEDGING_ENABLED']:
+        quote_hedger = QuoteHedger(
+            max_workers=app.config['HEDGING_MAX_WORKERS'],
+            percentile=app.config['HEDGING_PERCENTILE'],
+            sample_size=app.config['HEDGING_SAMPLE_SIZE'],
+            min_samples=app.config['HEDGING_MIN_SAMPLES'],
+            max_retries=app.config['QUOTE_MAX_RETRIES'],
+            retry_backoff=app.config['QUOTE_RETRY_BACKOFF'],
+            budget=RetryBudget(
+                ratio=app.config['RETRY_BUDGET_RATIO'], max_tokens=app.config['RETRY_BUDGET_MAX_TOKENS']
+            ),
+        )
+    app.extensions['quote_hedger'] = quote_hedger
@@ -0,0 +1,152 @@
+# coding=utf-8
+
+
+from collections import defaultdict
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+
+class OutboundRequestError(Exception):
+    """
+    Raised when an outbound request couldn't be completed (e.g. connection errors, timeouts).
+    """
+
+    def __init__(self, message, timed_out=False):
+        super().__init__(message)
+        self.timed_out = timed_out
+
+
+class _InstrumentedHTTPAdapter(HTTPAdapter):
+    """
+    requests' HTTP adapter that also keeps track of how its connection pools are used.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.requests_count = 0
+        self.waits_count = 0
+        self._in_use_by_host = defaultdict(int)
+        self._metrics_lock = Lock()
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        host = urlsplit(request.url).netloc
+        with self._metrics_lock:
+            self.requests_count += 1
+            self._in_use_by_host[host] += 1
+            # All connections to this host are busy, so this one has to wait (or open a non-pooled connection)
+            if self._in_use_by_host[host] > self._pool_maxsize:
+                self.waits_count += 1
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            with self._metrics_lock:
+                self._in_use_by_host[host] -= 1
+
+    def get_metrics(self):
+        pools = self.poolmanager.pools
+        pools = [pools[key] for key in pools.keys()]
+        connections_count = sum(pool.num_connections for pool in pools)
+        pooled_requests_count = sum(pool.num_requests for pool in pools)
+        return {
+            'requests': self.requests_count,
+            'connections': connections_count,
+            'in_use': sum(self._in_use_by_host.values()),
+            'waits': self.waits_count,
+            'reuse_ratio': 1 - connections_count / pooled_requests_count if pooled_requests_count else 0.0,
+        }
+
+
+class OutboundHTTPClient(object):
+    """
+    HTTP client to be shared by all outbound calls (e.g. carriers' APIs) in this process.
+
+    It keeps a pool of keep-alive connections per host (so TLS handshakes are not paid on every call) and always sets
+    connect/read timeouts (so a hung upstream can't pin a worker forever). HTTP/2 is supported through the optional
+    `httpx` library.
+    """
+
+    def __init__(self, pool_connections, pool_maxsize, pool_block, connect_timeout, read_timeout, http2=False):
+        self.timeout = (connect_timeout, read_timeout)
+        self.http2 = http2
+        if http2:
+            # Optional dependency, only needed when HTTP/2 is enabled
+            import httpx
+            self._httpx = httpx
+            self._session = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            )
+            self._requests_count = 0
+        else:
+            self._adapter = _InstrumentedHTTPAdapter(
+                pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block
+            )
+            self._session = requests.Session()
+            self._session.mount('http://', self._adapter)
+            self._session.mount('https://', self._adapter)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request, raising OutboundRequestError if it can't be completed.
+
+        Any extra argument is given as is to requests (or httpx, when HTTP/2 is enabled).
+        """
+        if self.http2:
+            self._requests_count += 1
+            try:
+                return self._session.request(method, url, **kwargs)
+            except self._httpx.TimeoutException as e:
+                raise OutboundRequestError(str(e), timed_out=True)
+            except self._httpx.HTTPError as e:
+                raise OutboundRequestError(str(e))
+
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            return self._session.request(method, url, **kwargs)
+        except requests.Timeout as e:
+            raise OutboundRequestError(str(e), timed_out=True)
+        except requests.RequestException as e:
+            raise OutboundRequestError(str(e))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_metrics(self):
+        """
+        Returns a dict with usage metrics of the connection pools.
+        """
+        if self.http2:
+            return {'requests': self._requests_count}
+        return self._adapter.get_metrics()
+
+    def close(self):
+        self._session.close()
+
+
+def get_http_client():
+    """
+    Returns the outbound HTTP client of the current Flask app.
+    """
+    return current_app.extensions['http_client']
+
+
+def configure_http_client(app):
+    """
+    Attaches an outbound HTTP client to the given Flask app, using its configuration.
+    """
+    app.extensions['http_client'] = OutboundHTTPClient(
+        pool_connections=app.config['OUTBOUND_HTTP_POOL_CONNECTIONS'],
+        pool_maxsize=app.config['OUTBOUND_HTTP_POOL_MAXSIZE'],
+        pool_block=app.config['OUTBOUND_HTTP_POOL_BLOCK'],
+        connect_timeout=app.config['OUTBOUND_HTTP_CONNECT_TIMEOUT'],
+        read_timeout=app.config['OUTBOUND_HTTP_READ_TIMEOUT'],
+        http2=app.config['OUTBOUND_HTTP2'],
+    )
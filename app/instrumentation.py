@@ -0,0 +1,244 @@
+# coding=utf-8
+
+
+import random
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+from flask import Response, current_app, g, has_app_context, request
+
+
+class _Histogram(object):
+    """
+    Prometheus-style histogram: observations counted by bucket (upper bounds), plus their count and sum.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # The last one being +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """
+    In-process latency histograms, counters and gauges, by name and labels, that can be rendered in Prometheus' text
+    format.
+
+    Gauges are meant to be set by collectors: functions called with these metrics right before rendering them.
+    """
+
+    def __init__(self, latency_buckets):
+        self.latency_buckets = tuple(sorted(latency_buckets))
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._collectors = []
+        self._lock = Lock()
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.latency_buckets)
+            histogram.observe(value)
+
+    def increment(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus' text exposition format.
+        """
+        for collector in self._collectors:
+            collector(self)
+        lines = []
+        with self._lock:
+            for name, metric_type in self._get_names():
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                if metric_type in ('counter', 'gauge'):
+                    series = self._counters if metric_type == 'counter' else self._gauges
+                    for (_, labels), value in self._get_series(series, name):
+                        lines.append('{}{} {}'.format(name, self._format_labels(labels), value))
+                    continue
+                for (_, labels), histogram in self._get_series(self._histograms, name):
+                    cumulative_count = 0
+                    for upper_bound, bucket_count in zip(self.latency_buckets + ('+Inf',), histogram.bucket_counts):
+                        cumulative_count += bucket_count
+                        bucket_labels = self._format_labels(labels + (('le', str(upper_bound)),))
+                        lines.append('{}_bucket{} {}'.format(name, bucket_labels, cumulative_count))
+                    lines.append('{}_sum{} {}'.format(name, self._format_labels(labels), histogram.sum))
+                    lines.append('{}_count{} {}'.format(name, self._format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def _get_names(self):
+        names = {name: 'counter' for name, _ in self._counters}
+        names.update((name, 'gauge') for name, _ in self._gauges)
+        names.update((name, 'histogram') for name, _ in self._histograms)
+        return sorted(names.items())
+
+    def _get_series(self, series, name):
+        return sorted((key, value) for key, value in series.items() if key[0] == name)
+
+    def _format_labels(self, labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + '}'
+
+
+class Trace(object):
+    """
+    Time spent by a single (sampled) request in each one of its stages, e.g. parsing, querying carriers.
+
+    Spans with the same name (e.g. the same carrier quoted for many shipments) are added up. Traces of requests that
+    aren't sampled (e.g. traced only in case they're slow, see SlowRequestLog) aren't reported.
+    """
+
+    def __init__(self, sampled=True):
+        self.sampled = sampled
+        self.spans = OrderedDict()
+        self._lock = Lock()  # Carriers are quoted from other threads
+
+    def add_span(self, name, duration):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + duration
+
+    def get_spans(self):
+        """
+        Returns a list of (name, duration in secs) tuples, since carriers that timed out may still be adding spans.
+        """
+        with self._lock:
+            return list(self.spans.items())
+
+    def get_server_timing(self):
+        """
+        Returns the spans as a Server-Timing header value (durations in ms).
+        """
+        return ', '.join('{};dur={:.2f}'.format(name, 1000 * duration) for name, duration in self.get_spans())
+
+
+class Instrumentation(object):
+    """
+    Lightweight instrumentation of our requests.
+
+    Latencies and counts of all requests (and carrier calls) are tracked as metrics, while only a sample of requests
+    is traced by stage, so its overhead is negligible under full load.
+    """
+
+    def __init__(self, metrics, sample_rate):
+        self.metrics = metrics
+        self.sample_rate = sample_rate
+
+    def start_trace(self):
+        """
+        Returns a new Trace if the current request is sampled, None otherwise.
+        """
+        return Trace() if random.random() < self.sample_rate else None
+
+    def record_carrier_call(self, carrier_code, status_code, duration):
+        self.metrics.observe('carrier_request_duration_seconds', duration, carrier=carrier_code)
+        self.metrics.increment('carrier_requests_total', carrier=carrier_code, status=status_code)
+
+    def _before_request(self):
+        g.request_started_at = perf_counter()
+        g.trace = self.start_trace()
+
+    def record_request(self, route, method, status_code, duration, trace=None):
+        """
+        Records a request to the given route that took the given secs (along with its stages, if its Trace is sampled).
+        Returns the value of its Server-Timing header, or None if it's not sampled.
+        """
+        self.metrics.observe('http_request_duration_seconds', duration, route=route, method=method)
+        self.metrics.increment('http_requests_total', route=route, method=method, status=status_code)
+        if trace is None or not trace.sampled:
+            return None
+        for name, span_duration in trace.get_spans():
+            self.metrics.observe('http_request_stage_duration_seconds', span_duration, route=route, stage=name)
+        trace.add_span('total', duration)
+        return trace.get_server_timing()
+
+    def _after_request(self, response):
+        if 'request_started_at' not in g:
+            return response  # e.g. an earlier before_request hook aborted
+        server_timing = self.record_request(
+            request.url_rule.rule if request.url_rule is not None else 'unmatched',
+            request.method,
+            response.status_code,
+            perf_counter() - g.request_started_at,
+            g.trace,
+        )
+        if server_timing is not None:
+            response.headers['Server-Timing'] = server_timing
+        return response
+
+    def _get_metrics(self):
+        return Response(self.metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def get_current_trace():
+    """
+    Returns the Trace of the current request, or None if it's not sampled (or there's no request at all).
+
+    Note that it's bound to the request's thread: code running in other threads must be given the trace explicitly.
+    """
+    return g.get('trace') if has_app_context() else None
+
+
+@contextmanager
+def span(name, trace=None):
+    """
+    Context manager that adds the time spent in it to the given trace (by default, the current request's one) as a
+    span with the given name. It does nothing if there's no trace.
+    """
+    trace = trace if trace is not None else get_current_trace()
+    if trace is None:
+        yield
+        return
+    started_at = perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, perf_counter() - started_at)
+
+
+def get_instrumentation(app=None):
+    """
+    Returns the instrumentation of the given Flask app (by default, the current one), or None if it's disabled.
+    """
+    return (app or current_app).extensions['instrumentation']
+
+
+def configure_instrumentation(app):
+    """
+    Attaches the instrumentation to the given Flask app (i.e. its request hooks and the /metrics endpoint), using its
+    configuration.
+    """
+    instrumentation = None
+    if app.config['INSTRUMENTATION_ENABLED']:
+        instrumentation = Instrumentation(
+            metrics=Metrics(app.config['INSTRUMENTATION_LATENCY_BUCKETS']),
+            sample_rate=app.config['INSTRUMENTATION_SAMPLE_RATE'],
+        )
+        app.before_request(instrumentation._before_request)
+        app.after_request(instrumentation._after_request)
+        app.add_url_rule('/metrics', 'metrics', instrumentation._get_metrics)
+    app.extensions['instrumentation'] = instrumentation
@@ -1,21 +1,30 @@
 # coding=utf-8
 
 
+import json
+
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.dialects.postgresql import JSON
 
+from app.db_routing import read_session
+
 db = SQLAlchemy()
 
 
 class Carrier(db.Model):
     """
     Class that represents a carrier.
-    
-    This is in case we want to potentially manage multiple lists instead of a master list.
+
+    Carriers belong either to the master list (no account) or to a given merchant account's list, each account having
+    its own carriers, credentials and enabled flags.
     """
     __tablename__ = 'carriers'
+    __table_args__ = (
+        db.Index('ix_carriers_account_id_enabled', 'account_id', 'enabled'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.String(64), nullable=True)  # None for the master list
     name = db.Column(db.String(255))
     app_id = db.Column(db.String(255))
     app_token = db.Column(db.String(255))
@@ -23,25 +32,36 @@ class Carrier(db.Model):
     # Additional fields to make the model friendlier
     enabled = db.Column(db.Boolean, default=True)
     api_endpoint_url = db.Column(db.String(255))
+    # Limits of the carrier's API, if any: calls per sec (with bursts of up to `rate_limit_burst` calls) and per day
+    rate_limit = db.Column(db.Float, nullable=True)
+    rate_limit_burst = db.Column(db.Integer, nullable=True)
+    daily_quota = db.Column(db.Integer, nullable=True)
     created = db.Column(db.DateTime, default=db.func.current_timestamp())
     modified = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
 
-    def __init__(self, name, app_id, app_token, shipment_methods, api_endpoint_url):
+    def __init__(self, name, app_id, app_token, shipment_methods, api_endpoint_url, account_id=None, rate_limit=None,
+                 rate_limit_burst=None, daily_quota=None):
+        self.account_id = account_id
         self.name = name
         self.app_id = app_id
         self.app_token = app_token
         self.shipment_methods = shipment_methods
         self.api_endpoint_url = api_endpoint_url
+        self.rate_limit = rate_limit
+        self.rate_limit_burst = rate_limit_burst
+        self.daily_quota = daily_quota
 
     def __repr__(self):
         return '<Carrier: {}>'.format(self.name)
 
     def save(self):
         db.session.add(self)
+        CarrierListVersion.bump()
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        CarrierListVersion.bump()
         db.session.commit()
 
     @property
@@ -49,10 +69,110 @@ class Carrier(db.Model):
         return self.name.strip().lower()
 
     @classmethod
-    def get_all(cls):
-        return cls.query.all()
+    def get_all(cls, account_id=None, use_replica=True):
+        """
+        Returns all carriers of the given account (by default, the master list).
+        """
+        with read_session(use_replica) as session:
+            return session.query(cls).filter_by(account_id=account_id).all()
 
     @classmethod
-    def get_all_enabled(cls):
-        return cls.query.filter_by(enabled=True).all()
+    def get_all_enabled(cls, account_id=None, use_replica=True):
+        with read_session(use_replica) as session:
+            return session.query(cls).filter_by(account_id=account_id, enabled=True).all()
+
+
+class CarrierListVersion(db.Model):
+    """
+    Class that represents the current version of the carriers list.
+
+    It's bumped every time a carrier is saved or deleted, so all processes caching carriers know when to reload them.
+    """
+    __tablename__ = 'carrier_list_versions'
 
+    _ROW_ID = 1
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    # Bumps done by this very process, so its own caches can be invalidated right away without querying the DB
+    local_bumps = 0
+
+    def __repr__(self):
+        return '<CarrierListVersion: {}>'.format(self.version)
+
+    @classmethod
+    def get_current(cls, use_replica=False):
+        with read_session(use_replica) as session:
+            return session.query(cls.version).filter_by(id=cls._ROW_ID).scalar() or 0
+
+    @classmethod
+    def bump(cls):
+        """
+        Bumps the version as part of the current transaction (i.e. it's up to the caller to commit it).
+        """
+        cls.local_bumps += 1
+        if not cls.query.filter_by(id=cls._ROW_ID).update({cls.version: cls.version + 1}):
+            db.session.add(cls(id=cls._ROW_ID, version=1))
+
+
+class QuoteRecord(db.Model):
+    """
+    Class that represents a quote served to our API users (i.e. a carrier's response for a shipment), kept for billing
+    reconciliation and carriers' SLA analysis. Quotes are written in bulk, see QuoteHistory.
+
+    In PostgreSQL, the table is partitioned by day (on `created`), which is thus part of its actual primary key (see its
+    migration). The model only declares `id`, which is unique anyway, so `db.create_all()` can still build it on SQLite.
+    """
+    __tablename__ = 'quotes'
+    __table_args__ = (
+        db.Index('ix_quotes_carrier_code_created', 'carrier_code', 'created'),
+        db.Index('ix_quotes_account_id_created', 'account_id', 'created'),
+    )
+
+    # SQLite only autoincrements INTEGER primary keys
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    created = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+    account_id = db.Column(db.String(64), nullable=True)  # None for the master list
+    carrier_code = db.Column(db.String(255), nullable=False)
+    shipment = db.Column(JSON)  # Normalized shipment data (address, weight, priority and box type)
+    cost = db.Column(db.Integer, nullable=False)
+    costs = db.Column(JSON)
+    error = db.Column(db.String(255), nullable=False, default='')
+    latency_ms = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return '<QuoteRecord: {} {}>'.format(self.carrier_code, self.created)
+
+    @classmethod
+    def get_top_shipments(cls, since, limit, use_replica=True):
+        """
+        Returns a list of (account ID, shipment data) tuples with the given number of shipments most quoted (by
+        account) since the given time, the most quoted ones first.
+        """
+        # JSON values can't be compared, their text can (it's always written in the same format, see QuoteHistory)
+        shipment_text = db.cast(cls.shipment, db.Text)
+        with read_session(use_replica) as session:
+            top_shipments = session.query(cls.account_id, shipment_text).filter(cls.created >= since).group_by(
+                cls.account_id, shipment_text
+            ).order_by(db.func.count(cls.id).desc()).limit(limit).all()
+        return [(account_id, json.loads(shipment)) for account_id, shipment in top_shipments]
+
+    @classmethod
+    def get_latency_percentiles(cls, since, until=None, percentile=0.95, use_replica=True):
+        """
+        Returns a list of (carrier code, hour, latency percentile in ms, quotes count, errors count) tuples for all
+        quotes served in the given time range (PostgreSQL only).
+        """
+        hour = db.func.date_trunc('hour', cls.created).label('hour')
+        with read_session(use_replica) as session:
+            query = session.query(
+                cls.carrier_code,
+                hour,
+                db.func.percentile_cont(percentile).within_group(cls.latency_ms.asc()),
+                db.func.count(cls.id),
+                db.func.count(cls.id).filter(cls.error != ''),
+            ).filter(cls.created >= since)
+            if until is not None:
+                query = query.filter(cls.created < until)
+            return query.group_by(cls.carrier_code, hour).order_by(cls.carrier_code, hour).all()
@@ -0,0 +1,269 @@
+# coding=utf-8
+
+
+import hmac
+import os
+import re
+import sys
+import threading
+from collections import Counter, deque
+from datetime import datetime
+from functools import wraps
+from time import monotonic, perf_counter, sleep
+
+from flask import Response, current_app, g, request
+from flask_restful import Api, Resource, abort
+
+from app.instrumentation import Trace
+
+
+class SamplingProfiler(object):
+    """
+    Wall-clock sampling profiler of this process: every `interval` secs it takes the stacks of all its threads, so
+    requests can be profiled live (with a negligible overhead) without restarting anything.
+
+    Profiles are counts of collapsed stacks (thread name first, then its frames from the outermost one), which is the
+    input format of flamegraph.pl, speedscope, etc.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def profile(self, duration):
+        """
+        Samples all threads (but the calling one) for the given secs, returning a Counter of their collapsed stacks.
+        """
+        stacks = Counter()
+        own_thread_id = threading.get_ident()
+        stop_at = monotonic() + duration
+        while monotonic() < stop_at:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread_id:
+                    stacks[self._collapse(thread_names.get(thread_id, str(thread_id)), frame)] += 1
+            sleep(self.interval)
+        return stacks
+
+    def _collapse(self, thread_name, frame):
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            labels.append('{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        labels.append(thread_name)
+        return ';'.join(label.replace(';', ':') for label in reversed(labels))
+
+
+def format_collapsed_stacks(stacks):
+    """
+    Returns the given Counter of collapsed stacks in the collapsed (folded) format: a line with each stack and its
+    count, the most frequent ones first.
+    """
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+
+class ProfileStore(object):
+    """
+    Profiles taken in the background, saved as collapsed stacks files in a directory: any process on this host (e.g.
+    another gunicorn worker) can then serve them. Only one profile is taken at a time, and only the latest
+    `max_profiles` ones are kept.
+    """
+    _PROFILE_ID_PATTERN = re.compile(r'^[\w-]+$')
+
+    def __init__(self, profiler, directory, max_profiles):
+        self.profiler = profiler
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._running = threading.Lock()
+
+    def start(self, duration):
+        """
+        Starts profiling this process in the background for the given secs, returning the ID of the profile, or None if
+        there's another profile running.
+        """
+        if not self._running.acquire(blocking=False):
+            return None
+        profile_id = '{:%Y%m%d%H%M%S%f}-{}'.format(datetime.utcnow(), os.getpid())
+        threading.Thread(target=self._profile, args=(profile_id, duration), name='profiler', daemon=True).start()
+        return profile_id
+
+    def get(self, profile_id):
+        """
+        Returns the given profile in the collapsed format, or None if it's unknown (or not finished yet).
+        """
+        if not self._PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        try:
+            with open(self._get_path(profile_id)) as profile_file:
+                return profile_file.read()
+        except FileNotFoundError:
+            return None
+
+    def _profile(self, profile_id, duration):
+        try:
+            stacks = self.profiler.profile(duration)
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = self._get_path(profile_id) + '.tmp'
+            with open(temp_path, 'w') as temp_file:
+                temp_file.write(format_collapsed_stacks(stacks))
+            os.replace(temp_path, self._get_path(profile_id))  # Atomically, so it's never read half-written
+            self._remove_old_profiles()
+        finally:
+            self._running.release()
+
+    def _remove_old_profiles(self):
+        profile_names = sorted(name for name in os.listdir(self.directory) if name.endswith('.folded'))
+        for profile_name in profile_names[:-self.max_profiles]:
+            try:
+                os.remove(os.path.join(self.directory, profile_name))
+            except FileNotFoundError:
+                pass  # Removed by another process
+
+    def _get_path(self, profile_id):
+        return os.path.join(self.directory, profile_id + '.folded')
+
+
+class SlowRequestLog(object):
+    """
+    Ring buffer (in-process) of the latest requests slower than `threshold` secs: their stage timings and payload
+    (truncated to `max_payload_size` bytes), to find out why they were slow. Streamed responses are timed up to their
+    first byte.
+    """
+
+    def __init__(self, threshold, max_entries, max_payload_size):
+        self.threshold = threshold
+        self.max_payload_size = max_payload_size
+        self._entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+
+    def add(self, method, path, status_code, duration, trace, payload):
+        """
+        Adds the given request (that took the given secs, and whose stages are in the given Trace) if it was slow.
+        Returns whether it was.
+        """
+        if duration < self.threshold:
+            return False
+        entry = {
+            'created': datetime.utcnow().isoformat(),
+            'method': method,
+            'path': path,
+            'status': status_code,
+            'duration_ms': round(1000 * duration, 3),
+            'stages_ms': {name: round(1000 * span_duration, 3) for name, span_duration in trace.get_spans()},
+            'payload': payload[:self.max_payload_size].decode('utf-8', 'replace'),
+            'payload_truncated': len(payload) > self.max_payload_size,
+        }
+        with self._lock:
+            self._entries.append(entry)
+        return True
+
+    def get_entries(self):
+        """
+        Returns the slow requests, the latest ones first.
+        """
+        with self._lock:
+            return list(reversed(self._entries))
+
+
+def admin_required(func):
+    """
+    Decorator of views only meant for admins, i.e. requests with an `Authorization: Bearer <ADMIN_TOKEN>` header (any
+    request is forbidden if there's no admin token set).
+    """
+    @wraps(func)
+    def _wrapper(*args, **kwargs):
+        admin_token = current_app.config['ADMIN_TOKEN']
+        authorization = request.headers.get('Authorization', '')
+        if not admin_token or not hmac.compare_digest(
+            authorization.encode('utf-8'), 'Bearer {}'.format(admin_token).encode('utf-8')
+        ):
+            abort(403, message='Admins only')
+        return func(*args, **kwargs)
+    return _wrapper
+
+
+class ProfilesEndpoint(Resource):
+    """
+    API endpoint to profile the process (e.g. the gunicorn worker) serving the request in the background.
+    """
+    method_decorators = [admin_required]
+
+    def post(self):
+        config = current_app.config
+        seconds = request.args.get('seconds', 10, type=float)
+        if not 0 < seconds <= config['PROFILING_MAX_SECONDS']:
+            abort(400, message='Profiles must last up to {} secs'.format(config['PROFILING_MAX_SECONDS']))
+        profile_id = current_app.extensions['profile_store'].start(seconds)
+        if profile_id is None:
+            abort(409, message='This process is already being profiled')
+        return {'id': profile_id, 'pid': os.getpid(), 'seconds': seconds}, 202
+
+
+class ProfileEndpoint(Resource):
+    """
+    API endpoint to get a profile, as collapsed stacks (e.g. `flamegraph.pl profile.folded > profile.svg`).
+    """
+    method_decorators = [admin_required]
+
+    def get(self, profile_id):
+        profile = current_app.extensions['profile_store'].get(profile_id)
+        if profile is None:
+            abort(404, message='Unknown profile (or not finished yet): {}'.format(profile_id))
+        return Response(profile, content_type='text/plain; charset=utf-8')
+
+
+class SlowRequestsEndpoint(Resource):
+    """
+    API endpoint to get the latest slow requests served by this process.
+    """
+    method_decorators = [admin_required]
+
+    def get(self):
+        return current_app.extensions['slow_request_log'].get_entries()
+
+
+def configure_profiling(app):
+    """
+    Attaches the (admin only) profiling endpoints to the given Flask app, along with the capture of slow requests, using
+    its configuration.
+    """
+    if not app.config['PROFILING_ENABLED']:
+        app.extensions['profile_store'] = app.extensions['slow_request_log'] = None
+        return
+    app.extensions['profile_store'] = ProfileStore(
+        profiler=SamplingProfiler(interval=app.config['PROFILING_SAMPLE_INTERVAL']),
+        directory=app.config['PROFILING_DIR'],
+        max_profiles=app.config['PROFILING_MAX_PROFILES'],
+    )
+    slow_request_log = app.extensions['slow_request_log'] = SlowRequestLog(
+        threshold=app.config['SLOW_REQUEST_THRESHOLD'],
+        max_entries=app.config['SLOW_REQUEST_LOG_SIZE'],
+        max_payload_size=app.config['SLOW_REQUEST_MAX_PAYLOAD_SIZE'],
+    )
+    slow_request_routes = set(app.config['SLOW_REQUEST_ROUTES'])
+
+    def _before_request():
+        if request.url_rule is not None and request.url_rule.rule in slow_request_routes:
+            g.slow_request_started_at = perf_counter()
+            if g.get('trace') is None:
+                # All their stages are timed (not only the sampled ones), in case they turn out to be slow
+                g.trace = Trace(sampled=False)
+
+    def _after_request(response):
+        if 'slow_request_started_at' in g:
+            slow_request_log.add(
+                request.method,
+                request.path,
+                response.status_code,
+                perf_counter() - g.slow_request_started_at,
+                g.trace,
+                request.get_data(),
+            )
+        return response
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    api = Api(app)
+    api.add_resource(ProfilesEndpoint, '/admin/profiles')
+    api.add_resource(ProfileEndpoint, '/admin/profiles/<string:profile_id>')
+    api.add_resource(SlowRequestsEndpoint, '/admin/slow_requests')
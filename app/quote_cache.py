@@ -0,0 +1,207 @@
+# coding=utf-8
+
+
+import json
+import math
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from time import monotonic, time
+
+from app.instrumentation import get_instrumentation
+from app.shared_store import connect_shared_store
+
+# Cached quote, along with when it stops being fresh (as a UNIX timestamp) and whether it was cached by the warming
+# worker (see QuoteWarmer) rather than by a request
+CachedQuote = namedtuple('CachedQuote', ('quote', 'fresh_until', 'warmed'))
+
+
+def normalize_shipment(shipment):
+    """
+    Returns a hashable version of the given shipment data, so equivalent shipments (e.g. addresses that only differ in
+    case or whitespace) are treated as the same one.
+    """
+    return (
+        ' '.join(shipment['address'].split()).lower(),
+        shipment['weight'],
+        shipment['priority'],
+        shipment['box_type'],
+    )
+
+
+class InProcessCacheBackend(object):
+    """
+    Cache backend that keeps entries in this process' memory, evicting the least recently used ones when full.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return dict(value)
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (dict(value), monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+
+class SharedCacheBackend(object):
+    """
+    Cache backend that keeps entries in a store shared by all processes (e.g. Redis).
+
+    The given client must have a Redis-like interface: `get(key)` and `set(key, value, ex=ttl_in_secs)`. Eviction is up
+    to the store itself (e.g. Redis' maxmemory-policy), so evictions aren't counted here.
+    """
+    evictions = 0
+
+    def __init__(self, client, key_prefix='shiphero:quotes:'):
+        self.client = client
+        self.key_prefix = key_prefix
+
+    def get(self, key):
+        raw_value = self.client.get(self._build_key(key))
+        return json.loads(raw_value) if raw_value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self._build_key(key), json.dumps(value), ex=max(1, int(math.ceil(ttl))))
+
+    def _build_key(self, key):
+        return self.key_prefix + json.dumps(key, separators=(',', ':'))
+
+
+class QuoteCache(object):
+    """
+    Cache of carrier quotes, keyed on the carrier (and its account, if any) and a normalized version of the shipment
+    data.
+
+    Successful quotes are kept for the carrier's TTL, while carrier errors (HTTP 5xx) are kept only for a short window
+    so a failing carrier isn't hit over and over again.
+
+    Successful quotes are also kept for `stale_ttl` secs past their TTL (stale-while-revalidate): stale quotes can still
+    be served right away, while they're refreshed in the background.
+    """
+
+    def __init__(self, backend, ttl, negative_ttl, carrier_ttls=None, stale_ttl=0):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.carrier_ttls = carrier_ttls or {}
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.warmed_hits = 0
+        self._lock = Lock()
+
+    def get(self, carrier_code, shipment, account_id=None):
+        """
+        Returns the cached quote for the given carrier and shipment (even if it's stale), or None if there's none.
+        """
+        cached_quote = self.get_cached_quote(carrier_code, shipment, account_id)
+        return cached_quote.quote if cached_quote is not None else None
+
+    def get_cached_quote(self, carrier_code, shipment, account_id=None):
+        """
+        Same as `get()`, but returns a CachedQuote instead, so callers can tell if it's stale.
+        """
+        cached_quote = self.peek(carrier_code, shipment, account_id)
+        with self._lock:
+            if cached_quote is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.stale_hits += cached_quote.fresh_until <= time()
+                self.warmed_hits += cached_quote.warmed
+        return cached_quote
+
+    def peek(self, carrier_code, shipment, account_id=None):
+        """
+        Same as `get_cached_quote()`, but it isn't counted as a cache lookup (e.g. to check what needs to be warmed).
+        """
+        entry = self.backend.get(self._build_key(carrier_code, shipment, account_id))
+        if entry is None:
+            return None
+        return CachedQuote(quote=dict(entry['quote']), fresh_until=entry['fresh_until'], warmed=entry['warmed'])
+
+    def set(self, carrier_code, shipment, quote, status_code, account_id=None, warmed=False):
+        """
+        Caches the given quote depending on the HTTP status code returned by the carrier.
+        """
+        stale_ttl = 0
+        if status_code == 200:
+            ttl = self.carrier_ttls.get(carrier_code, self.ttl)
+            stale_ttl = self.stale_ttl
+        elif status_code >= 500:
+            ttl = self.negative_ttl
+        else:
+            return  # Unexpected errors are never cached
+        if ttl > 0:
+            entry = {'quote': quote, 'fresh_until': time() + ttl, 'warmed': warmed}
+            self.backend.set(self._build_key(carrier_code, shipment, account_id), entry, ttl + stale_ttl)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'warmed_hits': self.warmed_hits,
+            'evictions': self.backend.evictions,
+        }
+
+    def _build_key(self, carrier_code, shipment, account_id):
+        key = (carrier_code,) + normalize_shipment(shipment)
+        # Accounts have their own credentials (thus their own rates) with carriers
+        return key if account_id is None else (account_id,) + key
+
+
+def _build_cache_backend(app):
+    """
+    Returns the cache backend set in the given Flask app's configuration.
+    """
+    shared_store_url = app.config['QUOTE_CACHE_SHARED_STORE_URL']
+    if not shared_store_url:
+        return InProcessCacheBackend(max_entries=app.config['QUOTE_CACHE_MAX_ENTRIES'])
+    return SharedCacheBackend(connect_shared_store(shared_store_url))
+
+
+def configure_quote_cache(app):
+    """
+    Attaches a quote cache to the given Flask app, along with its metrics, using its configuration.
+    """
+    quote_cache = None
+    if app.config['QUOTE_CACHE_ENABLED']:
+        quote_cache = QuoteCache(
+            backend=_build_cache_backend(app),
+            ttl=app.config['QUOTE_CACHE_TTL'],
+            negative_ttl=app.config['QUOTE_CACHE_NEGATIVE_TTL'],
+            carrier_ttls=app.config['QUOTE_CACHE_CARRIER_TTLS'],
+            stale_ttl=app.config['QUOTE_CACHE_STALE_TTL'],
+        )
+    app.extensions['quote_cache'] = quote_cache
+
+    instrumentation = get_instrumentation(app)
+    if quote_cache is not None and instrumentation is not None:
+        def _collect_quote_cache_metrics(metrics):
+            stats = quote_cache.stats()
+            for stat_name, value in stats.items():
+                metrics.set_gauge('quote_cache_lookups', value, kind=stat_name)
+            # Share of all lookups that were hits only thanks to the warming worker, to tune which lanes to warm
+            lookups = stats['hits'] + stats['misses']
+            metrics.set_gauge('quote_cache_warming_hit_rate_gain', stats['warmed_hits'] / lookups if lookups else 0)
+
+        instrumentation.metrics.add_collector(_collect_quote_cache_metrics)
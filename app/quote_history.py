@@ -0,0 +1,170 @@
+# coding=utf-8
+
+
+import atexit
+import os
+from collections import deque
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from sqlalchemy import text
+
+from app.instrumentation import get_instrumentation
+from app.models import QuoteRecord, db
+from app.quote_cache import normalize_shipment
+
+
+class QuoteHistory(object):
+    """
+    Write-behind buffer of served quotes: requests just append their quotes to it (never waiting for the DB), and a
+    background thread writes them in bulk (a single multi-row INSERT per batch) once `batch_size` quotes are pending or
+    every `flush_interval` secs, whichever comes first.
+
+    Up to `max_pending` quotes are kept while the DB is slow or down: beyond that, the oldest ones are dropped (and
+    counted) rather than letting the buffer grow forever. Batches that fail to be written are dropped too. Pending
+    quotes are written on exit.
+    """
+
+    def __init__(self, write, batch_size, flush_interval, max_pending):
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._pending = deque(maxlen=max_pending)
+        self._lock = Lock()
+        self._flush_needed = Event()
+        self._flusher_pid = None
+
+    def add(self, record):
+        """
+        Adds the given quote (a dict with QuoteRecord's columns) to be written.
+        """
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped += 1
+            self._pending.append(record)
+            pending_count = len(self._pending)
+            # Started lazily (and again after forking, e.g. in gunicorn workers): threads don't survive a fork
+            if self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                Thread(target=self._run_flusher, name='quote-history', daemon=True).start()
+                atexit.register(self.flush)
+        if pending_count >= self.batch_size:
+            self._flush_needed.set()
+
+    def flush(self):
+        """
+        Writes all pending quotes right away, in batches.
+        """
+        while True:
+            with self._lock:
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            if not batch:
+                return
+            try:
+                self.write(batch)
+            except Exception:
+                with self._lock:
+                    self.failed += len(batch)
+            else:
+                with self._lock:
+                    self.written += len(batch)
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _run_flusher(self):
+        while True:
+            self._flush_needed.wait(self.flush_interval)
+            self._flush_needed.clear()
+            self.flush()
+
+
+def build_quote_record(carrier, shipment, carrier_response, latency):
+    """
+    Returns the quote (as a dict with QuoteRecord's columns) of the given carrier response for the given shipment, that
+    took the given latency (secs).
+    """
+    address, weight, priority, box_type = normalize_shipment(shipment)
+    return {
+        'created': datetime.utcnow(),
+        'account_id': carrier.account_id,
+        'carrier_code': carrier.code,
+        'shipment': {'address': address, 'weight': weight, 'priority': priority, 'box_type': box_type},
+        'cost': carrier_response['cost'],
+        'costs': carrier_response['costs'],
+        'error': carrier_response['error'][:255],
+        'latency_ms': round(latency * 1000, 3),
+    }
+
+
+def create_daily_partitions(engine, days_ahead, start=None):
+    """
+    Creates the daily partitions of the quotes table (PostgreSQL only) from the given date (by default, tomorrow in UTC)
+    up to the given days ahead, if they don't exist yet. Returns a tuple with the names of the partitions ready and the
+    days skipped.
+
+    Partitions must be created before their day comes: quotes with no partition for their day are stored in the
+    default partition, and a day's partition can't be created once it has quotes in there, so those days are skipped
+    (their quotes stay in the default partition). Each partition is created in its own transaction, so a day that
+    can't be partitioned never holds back the others.
+    """
+    start = start or datetime.utcnow().date() + timedelta(days=1)
+    default_partition_name = '{}_default'.format(QuoteRecord.__tablename__)
+    partition_names = []
+    skipped_days = []
+    for day_offset in range(days_ahead + 1):
+        day = start + timedelta(days=day_offset)
+        partition_name = '{}_{}'.format(QuoteRecord.__tablename__, day.strftime('%Y%m%d'))
+        day_range = {'from': day.isoformat(), 'to': (day + timedelta(days=1)).isoformat()}
+        with engine.begin() as connection:
+            if connection.execute(text(
+                'SELECT EXISTS (SELECT 1 FROM {} WHERE created >= :from AND created < :to)'.format(
+                    default_partition_name
+                )
+            ), day_range).scalar():
+                skipped_days.append(day)
+                continue
+            connection.execute(text(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+                    partition_name, QuoteRecord.__tablename__, day_range['from'], day_range['to']
+                )
+            ))
+        partition_names.append(partition_name)
+    return partition_names, skipped_days
+
+
+def configure_quote_history(app):
+    """
+    Attaches the history of served quotes to the given Flask app, along with its metrics, using its configuration.
+    """
+    quote_history = None
+    if app.config['QUOTE_HISTORY_ENABLED']:
+        def _write(records):
+            with app.app_context():
+                # All records at once, in a single multi-row INSERT (always in the primary DB)
+                with db.engine.begin() as connection:
+                    connection.execute(QuoteRecord.__table__.insert().values(records))
+
+        quote_history = QuoteHistory(
+            write=_write,
+            batch_size=app.config['QUOTE_HISTORY_BATCH_SIZE'],
+            flush_interval=app.config['QUOTE_HISTORY_FLUSH_INTERVAL'],
+            max_pending=app.config['QUOTE_HISTORY_MAX_PENDING'],
+        )
+    app.extensions['quote_history'] = quote_history
+
+    instrumentation = get_instrumentation(app)
+    if quote_history is not None and instrumentation is not None:
+        def _collect_quote_history_metrics(metrics):
+            for stat_name, value in quote_history.stats().items():
+                metrics.set_gauge('quote_history_records', value, kind=stat_name)
+
+        instrumentation.metrics.add_collector(_collect_quote_history_metrics)
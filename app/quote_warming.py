@@ -0,0 +1,138 @@
+# coding=utf-8
+
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic, sleep, time
+
+from app.adapters import Quote
+from app.models import QuoteRecord
+from app.registry import get_carrier_registry
+
+
+class QuoteRevalidator(object):
+    """
+    Refreshes stale cached quotes in the background (stale-while-revalidate), using a bounded thread pool: each quote is
+    refreshed only once at a time, however many requests get it stale in the meantime.
+    """
+
+    def __init__(self, max_workers):
+        self.revalidations = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='quote-revalidation')
+        self._in_flight = set()
+        self._lock = Lock()
+
+    def revalidate(self, key, refresh):
+        """
+        Calls `refresh()` in the background, unless the quote with the given (hashable) key is already being refreshed.
+        Returns whether it was called.
+        """
+        with self._lock:
+            if key in self._in_flight:
+                return False
+            self._in_flight.add(key)
+            self.revalidations += 1
+
+        def _refresh():
+            try:
+                refresh()
+            finally:
+                with self._lock:
+                    self._in_flight.discard(key)
+
+        self._executor.submit(_refresh)
+        return True
+
+
+class QuoteWarmer(object):
+    """
+    Keeps the quotes of the most frequent shipments (lanes, as found in the quote history) cached, so the first request
+    for them doesn't pay the carriers' latency: quotes are refreshed when they're missing or about to go stale (within
+    `refresh_ahead` secs).
+
+    Carrier calls go through the usual rate limits and quotas (lanes of a carrier over them are just skipped until the
+    next round), and they're paced to `max_rate` calls per sec on top of that.
+    """
+
+    def __init__(self, app, endpoint, max_lanes, lookback, refresh_ahead, max_rate):
+        self.app = app
+        self.endpoint = endpoint
+        self.max_lanes = max_lanes
+        self.lookback = lookback
+        self.refresh_ahead = refresh_ahead
+        self.max_rate = max_rate
+
+    def get_lanes(self):
+        """
+        Returns a list of (account ID, shipment data) tuples with the lanes to warm, the most frequent ones first.
+        """
+        since = datetime.utcnow() - timedelta(seconds=self.lookback)
+        return QuoteRecord.get_top_shipments(since, self.max_lanes)
+
+    def warm(self, lanes):
+        """
+        Refreshes the quotes of the given lanes that need it, returning a dict with how many quotes were refreshed,
+        still fresh, or skipped (rate limited or failed).
+        """
+        quote_cache = self.app.extensions['quote_cache']
+        fanout = self.app.extensions['carrier_fanout']
+        results = {'refreshed': 0, 'fresh': 0, 'skipped': 0}
+        limited_carriers = set()
+        for account_id, shipment in lanes:
+            started_at = monotonic()
+            carriers = []
+            for carrier in get_carrier_registry().get_all_enabled(account_id):
+                if (account_id, carrier.code) in limited_carriers:
+                    results['skipped'] += 1
+                elif self._is_fresh(quote_cache.peek(carrier.code, shipment, account_id)):
+                    results['fresh'] += 1
+                else:
+                    carriers.append(carrier)
+
+            def _refresh(carrier):
+                return self.endpoint._fetch_carrier(self.app, carrier, shipment, cache_errors=False, warmed=True)
+
+            carrier_responses = fanout.run(
+                carriers,
+                _refresh,
+                lambda carrier: self.endpoint._handle_carrier_response(carrier, Quote(status_code=504, cost=-1)),
+            )
+            for carrier, carrier_response in zip(carriers, carrier_responses):
+                if carrier_response['error']:
+                    results['skipped'] += 1
+                    limited_carriers.add((account_id, carrier.code))  # Either rate limited or failing, for now
+                else:
+                    results['refreshed'] += 1
+            # Paced, so warming never takes over the carriers' rate limits
+            sleep(max(0, len(carriers) / self.max_rate - (monotonic() - started_at)))
+        return results
+
+    def run(self, interval, rounds=None):
+        """
+        Warms the lanes (reloaded every round) every given secs, forever or for the given number of rounds, yielding
+        the results of each round along with the number of lanes.
+        """
+        round_number = 0
+        while rounds is None or round_number < rounds:
+            started_at = monotonic()
+            with self.app.app_context():
+                lanes = self.get_lanes()
+                results = self.warm(lanes)
+            yield len(lanes), results
+            round_number += 1
+            if rounds is None or round_number < rounds:
+                sleep(max(0, interval - (monotonic() - started_at)))
+
+    def _is_fresh(self, cached_quote):
+        return cached_quote is not None and cached_quote.fresh_until - time() > self.refresh_ahead
+
+
+def configure_quote_revalidation(app):
+    """
+    Attaches a revalidator of stale cached quotes to the given Flask app, if they're to be served stale.
+    """
+    quote_revalidator = None
+    if app.extensions['quote_cache'] is not None and app.config['QUOTE_CACHE_STALE_TTL'] > 0:
+        quote_revalidator = QuoteRevalidator(max_workers=app.config['QUOTE_REVALIDATION_MAX_WORKERS'])
+    app.extensions['quote_revalidator'] = quote_revalidator
@@ -0,0 +1,235 @@
+# coding=utf-8
+
+
+from datetime import datetime, timedelta
+from threading import Lock
+from time import time
+
+from app.instrumentation import get_instrumentation
+from app.shared_store import LocalSharedStore, connect_shared_store
+
+
+def get_seconds_left_in_day(now=None):
+    """
+    Returns how many secs are left until the end of the current day (UTC), when daily quotas are reset.
+    """
+    now = now or datetime.utcnow()
+    return ((now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0) - now).total_seconds()
+
+
+class SharedTokenBuckets(object):
+    """
+    Token buckets (one per key) kept in a Redis-like store, each allowing a given rate of calls per sec on average with
+    bursts of up to a given number of calls. Unless the store is shared by all processes, calls are only limited for
+    this process.
+
+    Buckets follow GCRA (generic cell rate algorithm): each one is just the theoretical arrival time of its next call,
+    checked and moved forward (along with its expiration) in a single atomic operation of the store, i.e. a Lua script
+    in Redis or `update()` in its local stand-ins. So unlike fixed windows, no more than a burst gets through at any
+    moment, and concurrent calls (from any process) can never go over the limit.
+    """
+
+    _GCRA_SCRIPT = """
+        redis.replicate_commands()
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local interval, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local arrival = math.max(tonumber(redis.call('GET', KEYS[1])) or now, now)
+        if arrival - now > interval * (burst - 1) then
+            return 0
+        end
+        redis.call('SET', KEYS[1], string.format('%.6f', arrival + interval), 'PX',
+                   math.ceil((arrival + interval - now) * 1000) + 1000)
+        return 1
+    """
+
+    def __init__(self, store, key_prefix='shiphero:rate_limits:'):
+        self.store = store
+        self.key_prefix = key_prefix
+        self._gcra_script = None
+        if hasattr(store, 'register_script'):  # Redis, while local stand-ins take Python functions instead
+            self._gcra_script = store.register_script(self._GCRA_SCRIPT)
+
+    def try_acquire(self, bucket_key, rate, burst):
+        """
+        Takes a token from the given bucket, returning whether there was any (i.e. the call is within the given rate of
+        calls per sec and burst).
+        """
+        key = self.key_prefix + bucket_key
+        interval = 1 / rate
+        if self._gcra_script is not None:
+            return bool(self._gcra_script(keys=[key], args=[interval, burst]))
+
+        def _take_token(arrival):
+            now = time()
+            arrival = max(float(arrival or now), now)
+            if arrival - now > interval * (burst - 1):
+                return None, None, False
+            return arrival + interval, arrival + interval - now + 1, True
+
+        return self.store.update(key, _take_token)
+
+
+class QuotaTracker(object):
+    """
+    Tracks how many calls are made to each carrier per day (UTC), in a Redis-like store: `get(key)`, `incr(key)` and
+    `expire(key, secs)`. Unless the store is shared by all processes, usage is only tracked for this process.
+    """
+
+    def __init__(self, store, key_prefix='shiphero:quotas:'):
+        self.store = store
+        self.key_prefix = key_prefix
+
+    def get_usage(self, quota_key):
+        return int(self.store.get(self._build_key(quota_key)) or 0)
+
+    def record_call(self, quota_key):
+        """
+        Counts a call against the given quota, returning the usage (including it).
+        """
+        key = self._build_key(quota_key)
+        usage = self.store.incr(key)
+        if usage == 1:
+            self.store.expire(key, 2 * 24 * 3600)  # Only today's usage is needed, yesterday's is kept just in case
+        return usage
+
+    def cancel_call(self, quota_key):
+        """
+        Takes back a call counted against the given quota that wasn't made after all.
+        """
+        self.store.incr(self._build_key(quota_key), -1)
+
+    def get_paced_since(self, quota_key):
+        """
+        Returns when (a timestamp) calls against the given quota started being paced today, i.e. the first time it's
+        asked for.
+        """
+        key = self._build_key(quota_key) + ':paced_since'
+        self.store.set(key, time(), ex=2 * 24 * 3600, nx=True)
+        return float(self.store.get(key))
+
+    def _build_key(self, quota_key):
+        return '{}{}:{}'.format(self.key_prefix, quota_key, datetime.utcnow().strftime('%Y%m%d'))
+
+
+class CarrierRateLimiter(object):
+    """
+    Rate limiter of a single carrier, as configured on its row: its `rate_limit` (calls per sec, in bursts of up to
+    `rate_limit_burst` calls) and its `daily_quota` (e.g. API credits), if any of them is set.
+
+    Once the soft limit of the quota is used (e.g. 80% of it), calls are paced so the rest of it lasts until the end of
+    the day instead of being exhausted right away: from then on, usage can only grow linearly up to the quota. Any call
+    beyond the quota is rejected.
+
+    Calls are counted against the quota as soon as they're allowed (see `acquire()`), so the quota can't be exceeded
+    by concurrent calls either.
+    """
+
+    def __init__(self, carrier, quota_tracker, token_buckets, soft_limit):
+        self.quota_key = carrier.code
+        if carrier.account_id is not None:
+            self.quota_key = '{}:{}'.format(carrier.account_id, carrier.code)  # Accounts have their own credentials
+        self.settings = self.get_settings(carrier)
+        self.daily_quota = carrier.daily_quota
+        self.quota_tracker = quota_tracker
+        self.token_buckets = token_buckets
+        self.soft_limit = soft_limit
+        self._rate_limit, self._rate_limit_burst = carrier.rate_limit, None
+        if carrier.rate_limit:
+            self._rate_limit_burst = carrier.rate_limit_burst or max(1, int(carrier.rate_limit))
+
+    @staticmethod
+    def get_settings(carrier):
+        return carrier.rate_limit, carrier.rate_limit_burst, carrier.daily_quota
+
+    def acquire(self):
+        """
+        Returns None if the carrier can be called right now (the call being counted against its quota already), or the
+        reason why not otherwise: 'quota' or 'rate_limit'.
+        """
+        if self._rate_limit_burst is not None and not self.token_buckets.try_acquire(
+            self.quota_key, self._rate_limit, self._rate_limit_burst
+        ):
+            return 'rate_limit'
+        if self.daily_quota is not None:
+            usage = self.quota_tracker.record_call(self.quota_key)
+            if usage > self.daily_quota or (
+                usage > self.daily_quota * self.soft_limit and not self._is_within_pace(usage)
+            ):
+                self.quota_tracker.cancel_call(self.quota_key)
+                return 'quota'
+        return None
+
+    def _is_within_pace(self, usage):
+        """
+        Returns whether the given usage (past the soft limit) is on pace to last until the end of the day, i.e. the rest
+        of the quota is spent linearly from the moment the soft limit was reached.
+        """
+        soft_usage = int(self.daily_quota * self.soft_limit)
+        paced_since = self.quota_tracker.get_paced_since(self.quota_key)
+        paced_for = max(0.0, time() - paced_since)
+        pace = paced_for / (paced_for + get_seconds_left_in_day())
+        return usage <= soft_usage + 1 + (self.daily_quota - soft_usage) * pace
+
+    def record_call(self):
+        """
+        Records an extra call made to the carrier (i.e. hedged requests and retries) against its quota.
+        """
+        if self.daily_quota is not None:
+            self.quota_tracker.record_call(self.quota_key)
+
+    def get_stats(self):
+        return {
+            'rate_limit': self.settings[0],
+            'daily_quota': self.daily_quota,
+            'quota_usage': self.quota_tracker.get_usage(self.quota_key) if self.daily_quota is not None else None,
+        }
+
+
+class CarrierRateLimiters(object):
+    """
+    All carriers' rate limiters, created on demand (and recreated whenever their carrier's settings change).
+    """
+
+    def __init__(self, quota_tracker, token_buckets, soft_limit):
+        self.quota_tracker = quota_tracker
+        self.token_buckets = token_buckets
+        self.soft_limit = soft_limit
+        self._limiters = {}
+        self._lock = Lock()
+
+    def get(self, carrier):
+        key = (carrier.account_id, carrier.code)
+        limiter = self._limiters.get(key)
+        if limiter is None or limiter.settings != CarrierRateLimiter.get_settings(carrier):
+            with self._lock:
+                limiter = self._limiters[key] = CarrierRateLimiter(
+                    carrier, self.quota_tracker, self.token_buckets, self.soft_limit
+                )
+        return limiter
+
+
+def configure_rate_limiting(app):
+    """
+    Attaches carriers' rate limiters to the given Flask app, along with their metrics, using its configuration.
+    """
+    rate_limiters = None
+    if app.config['CARRIER_RATE_LIMITING_ENABLED']:
+        shared_store_url = app.config['CARRIER_QUOTA_SHARED_STORE_URL']
+        store = connect_shared_store(shared_store_url) if shared_store_url else LocalSharedStore()
+        rate_limiters = CarrierRateLimiters(
+            quota_tracker=QuotaTracker(store),
+            token_buckets=SharedTokenBuckets(store),
+            soft_limit=app.config['CARRIER_QUOTA_SOFT_LIMIT'],
+        )
+    app.extensions['carrier_rate_limiters'] = rate_limiters
+
+    instrumentation = get_instrumentation(app)
+    if rate_limiters is not None and instrumentation is not None:
+        def _collect_quota_metrics(metrics):
+            for limiter in list(rate_limiters._limiters.values()):
+                if limiter.daily_quota is not None:
+                    usage = limiter.quota_tracker.get_usage(limiter.quota_key)
+                    metrics.set_gauge('carrier_quota_usage_ratio', usage / limiter.daily_quota, quota=limiter.quota_key)
+
+        instrumentation.metrics.add_collector(_collect_quota_metrics)
@@ -0,0 +1,290 @@
+# coding=utf-8
+
+
+import json
+import os
+import re
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+from threading import Lock
+from time import monotonic, time
+
+from app.enums import BoxType, Priority
+
+_ZIP_CODE_REGEX = re.compile(r'\b(\d{5})(?:-\d{4})?\b')
+_NO_RATE = -1
+
+
+def find_zip_code(address):
+    """
+    Returns the (5-digit) ZIP code of the given address, i.e. the last one found in it, or None if there's none.
+    """
+    zip_codes = _ZIP_CODE_REGEX.findall(address or '')
+    return zip_codes[-1] if zip_codes else None
+
+
+class RateTable(object):
+    """
+    Carrier's rates, stored compactly as a flat array of costs indexed by (shipment method, zone, weight bracket, box
+    type, priority), so quotes are computed in microseconds without calling the carrier.
+
+    Tables are built from carriers' rate cards, given as dicts like:
+    {
+        "carrier": "fedex",
+        "expires": 1798675200,  // Optional, as a UNIX timestamp
+        "weight_brackets": [1, 5, 10, 50],  // Upper bounds (lb)
+        "default_zone": 8,
+        "zip_prefix_zones": {"100": 1, "9": 5},  // Longest matching prefix of the destination ZIP code wins
+        "rates": [
+            {"method": "cheap", "zone": 1, "box_type": "small", "priority": 1, "costs": [5, 7, 9, 12]},  // By bracket
+            ...
+        ]
+    }
+    """
+    _TYPECODE = 'l'
+
+    def __init__(self, carrier_code, methods, zones, weight_brackets, default_zone, zip_prefix_zones, costs,
+                 imported_at, expires=None):
+        self.carrier_code = carrier_code
+        self.methods = list(methods)
+        self.zones = list(zones)
+        self.weight_brackets = list(weight_brackets)
+        self.default_zone = default_zone
+        self.zip_prefix_zones = dict(zip_prefix_zones)
+        self.costs = costs
+        self.imported_at = imported_at
+        self.expires = expires
+        self._box_types = BoxType.choices()
+        self._priorities = Priority.choices()
+        self._method_indexes = {method: i for i, method in enumerate(self.methods)}
+        self._zone_indexes = {zone: i for i, zone in enumerate(self.zones)}
+        self._box_type_indexes = {box_type: i for i, box_type in enumerate(self._box_types)}
+        self._priority_indexes = {priority: i for i, priority in enumerate(self._priorities)}
+        self._zip_prefix_lengths = sorted({len(prefix) for prefix in self.zip_prefix_zones}, reverse=True)
+
+    @classmethod
+    def from_rate_card(cls, rate_card, carrier):
+        """
+        Returns a new table with the rates of the given rate card, raising ValueError if it's not valid for the given
+        carrier (e.g. unknown shipment methods).
+        """
+        if rate_card.get('carrier') != carrier.code:
+            raise ValueError('Rate card is not for carrier {}'.format(carrier.code))
+        if not carrier.shipment_methods:
+            raise ValueError('Carrier {} has no shipment methods'.format(carrier.code))
+        weight_brackets = sorted(rate_card['weight_brackets'])
+        rates = rate_card['rates']
+        unknown_methods = {rate['method'] for rate in rates} - set(carrier.shipment_methods)
+        if unknown_methods:
+            raise ValueError('Unknown shipment methods: {}'.format(', '.join(sorted(unknown_methods))))
+        zones = sorted({rate['zone'] for rate in rates} | {rate_card['default_zone']})
+
+        rate_table = cls(
+            carrier_code=carrier.code,
+            methods=sorted(carrier.shipment_methods),
+            zones=zones,
+            weight_brackets=weight_brackets,
+            default_zone=rate_card['default_zone'],
+            zip_prefix_zones=rate_card.get('zip_prefix_zones', {}),
+            costs=None,
+            imported_at=time(),
+            expires=rate_card.get('expires'),
+        )
+        rate_table.costs = array(cls._TYPECODE, [_NO_RATE]) * rate_table._get_size()
+        for rate in rates:
+            if len(rate['costs']) != len(weight_brackets):
+                raise ValueError('Rates must have one cost per weight bracket: {}'.format(rate))
+            for weight_bracket_index, cost in enumerate(rate['costs']):
+                index = rate_table._get_index(
+                    rate['method'], rate['zone'], weight_bracket_index, rate['box_type'], rate['priority']
+                )
+                if index is None:
+                    raise ValueError('Invalid rate: {}'.format(rate))
+                rate_table.costs[index] = cost
+        return rate_table
+
+    def quote(self, shipment):
+        """
+        Returns a dict with the costs of the given shipment (a dict, as validated by our API) by shipment method, or
+        None if any method has no rate for it.
+        """
+        return self.quote_many([shipment])[0]
+
+    def quote_many(self, shipments):
+        """
+        Same as `quote()`, but for many shipments at once: the costs of all shipments, for all methods, are gathered
+        from the table in a single C-level pass.
+        """
+        methods_count = len(self.methods)
+        method_stride = len(self.costs) // methods_count  # Methods are the outermost dimension
+        offsets = [self._get_shipment_index(self.methods[0], shipment) for shipment in shipments]
+        indexes = [
+            offset + method_index * method_stride
+            for offset in offsets if offset is not None for method_index in range(methods_count)
+        ]
+        found_costs = itemgetter(*indexes)(self.costs) if indexes else ()
+        if len(indexes) == 1:
+            found_costs = (found_costs,)
+
+        shipments_costs = []
+        position = 0
+        for offset in offsets:
+            if offset is None:
+                shipments_costs.append(None)
+                continue
+            shipment_costs = found_costs[position:position + methods_count]
+            position += methods_count
+            shipments_costs.append(dict(zip(self.methods, shipment_costs)) if _NO_RATE not in shipment_costs else None)
+        return shipments_costs
+
+    def get_zone(self, address):
+        zip_code = find_zip_code(address)
+        if zip_code is not None:
+            for prefix_length in self._zip_prefix_lengths:
+                zone = self.zip_prefix_zones.get(zip_code[:prefix_length])
+                if zone is not None:
+                    return zone
+        return self.default_zone
+
+    def is_stale(self, max_age):
+        now = time()
+        return now - self.imported_at > max_age or (self.expires is not None and now > self.expires)
+
+    def save(self, path):
+        """
+        Saves this table to the given path: a JSON header line, followed by the raw costs array. The file is replaced
+        atomically, so processes reading it never see a partial table.
+        """
+        header = {
+            'carrier_code': self.carrier_code,
+            'methods': self.methods,
+            'zones': self.zones,
+            'weight_brackets': self.weight_brackets,
+            'default_zone': self.default_zone,
+            'zip_prefix_zones': self.zip_prefix_zones,
+            'imported_at': self.imported_at,
+            'expires': self.expires,
+            'typecode': self.costs.typecode,
+            'itemsize': self.costs.itemsize,
+        }
+        temp_path = '{}.tmp'.format(path)
+        with open(temp_path, 'wb') as table_file:
+            table_file.write(json.dumps(header).encode('utf-8') + b'\n')
+            table_file.write(self.costs.tobytes())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as table_file:
+            header = json.loads(table_file.readline().decode('utf-8'))
+            costs = array(header.pop('typecode'))
+            if costs.itemsize != header.pop('itemsize'):
+                raise ValueError('Rate table {} was saved on an incompatible platform'.format(path))
+            costs.frombytes(table_file.read())
+        return cls(costs=costs, **header)
+
+    def _get_shipment_index(self, method, shipment):
+        weight = shipment['weight']
+        if weight is None or weight > self.weight_brackets[-1]:
+            return None
+        weight_bracket_index = bisect_left(self.weight_brackets, weight)
+        return self._get_index(
+            method, self.get_zone(shipment['address']), weight_bracket_index, shipment['box_type'], shipment['priority']
+        )
+
+    def _get_index(self, method, zone, weight_bracket_index, box_type, priority):
+        indexes_and_sizes = (
+            (self._method_indexes.get(method), len(self.methods)),
+            (self._zone_indexes.get(zone), len(self.zones)),
+            (weight_bracket_index, len(self.weight_brackets)),
+            (self._box_type_indexes.get(box_type), len(self._box_types)),
+            (self._priority_indexes.get(priority), len(self._priorities)),
+        )
+        index = 0
+        for dimension_index, dimension_size in indexes_and_sizes:
+            if dimension_index is None:
+                return None
+            index = index * dimension_size + dimension_index
+        return index
+
+    def _get_size(self):
+        return len(self.methods) * len(self.zones) * len(self.weight_brackets) * len(self._box_types) * \
+            len(self._priorities)
+
+
+class RateTables(object):
+    """
+    All carriers' rate tables (only for the master carriers list: accounts have their own rates), loaded lazily from
+    the given directory, one file per carrier.
+
+    Stale tables are not used, but they're reloaded whenever their file changes (i.e. a new rate card is imported):
+    missing or stale tables' files are checked at most once per `check_interval` (secs) per carrier.
+    """
+
+    def __init__(self, directory, max_age, check_interval=10):
+        self.directory = directory
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self._tables = {}  # Carrier code -> (table or None, file modification time, when it was checked last)
+        self._lock = Lock()
+
+    def get_path(self, carrier_code):
+        return os.path.join(self.directory, '{}.rates'.format(carrier_code))
+
+    def get(self, carrier_code):
+        """
+        Returns the (fresh) rate table of the given carrier, or None if there's none.
+        """
+        rate_table, modified_at, checked_at = self._tables.get(carrier_code, (None, None, None))
+        if rate_table is not None and not rate_table.is_stale(self.max_age):
+            return rate_table
+        now = monotonic()
+        if checked_at is not None and now - checked_at < self.check_interval:
+            return None
+
+        path = self.get_path(carrier_code)
+        try:
+            current_modified_at = os.path.getmtime(path)
+        except OSError:
+            current_modified_at = None
+        with self._lock:
+            if current_modified_at is not None and current_modified_at != modified_at:
+                rate_table, modified_at = RateTable.load(path), current_modified_at
+            self._tables[carrier_code] = (rate_table, modified_at, now)  # Even with no file, to check it later on
+        return rate_table if rate_table is not None and not rate_table.is_stale(self.max_age) else None
+
+    def quote_many(self, carrier, shipments):
+        """
+        Returns a list with the costs by shipment method of each one of the given shipments with the given carrier (None
+        if there are no rates for it), or None if the carrier has no usable rate table at all.
+        """
+        if carrier.account_id is not None:
+            return None
+        rate_table = self.get(carrier.code)
+        if rate_table is None:
+            return None
+        return rate_table.quote_many(shipments)
+
+    def save(self, rate_table):
+        os.makedirs(self.directory, exist_ok=True)
+        rate_table.save(self.get_path(rate_table.carrier_code))
+        self._tables.pop(rate_table.carrier_code, None)  # So it's used right away
+
+
+def build_rate_tables(config):
+    """
+    Returns carriers' rate tables set up from the given Flask app configuration.
+    """
+    return RateTables(
+        directory=config['RATE_TABLES_DIR'],
+        max_age=config['RATE_TABLES_MAX_AGE'],
+        check_interval=config['RATE_TABLES_CHECK_INTERVAL'],
+    )
+
+
+def configure_rate_tables(app):
+    """
+    Attaches carriers' rate tables to the given Flask app, using its configuration.
+    """
+    app.extensions['rate_tables'] = build_rate_tables(app.config)
@@ -0,0 +1,156 @@
+# coding=utf-8
+
+
+from collections import namedtuple
+from threading import Lock
+from time import monotonic
+
+from flask import current_app
+
+from app.models import Carrier, CarrierListVersion
+
+# Carriers of a single account (or of the master list)
+_CarrierList = namedtuple('_CarrierList', ('carriers', 'enabled_carriers', 'carriers_by_code'))
+# Carrier lists by account, all of them loaded for the same carriers list version
+_RegistryState = namedtuple(
+    '_RegistryState', ('carrier_lists', 'unknown_accounts', 'version', 'local_bumps', 'use_replica')
+)
+
+
+class CarrierSnapshot(object):
+    """
+    Immutable, read-only copy of a carrier, detached from any DB session (thus safe to share among threads).
+    """
+    __slots__ = (
+        'id', 'account_id', 'name', 'code', 'app_id', 'app_token', 'shipment_methods', 'enabled', 'api_endpoint_url',
+        'rate_limit', 'rate_limit_burst', 'daily_quota',
+    )
+
+    def __init__(self, carrier):
+        for attr_name, value in (
+            ('id', carrier.id),
+            ('account_id', carrier.account_id),
+            ('name', carrier.name),
+            ('code', carrier.code),
+            ('app_id', carrier.app_id),
+            ('app_token', carrier.app_token),
+            ('shipment_methods', dict(carrier.shipment_methods or {})),
+            ('enabled', carrier.enabled),
+            ('api_endpoint_url', carrier.api_endpoint_url),
+            ('rate_limit', carrier.rate_limit),
+            ('rate_limit_burst', carrier.rate_limit_burst),
+            ('daily_quota', carrier.daily_quota),
+        ):
+            object.__setattr__(self, attr_name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is read-only'.format(self))
+
+    def __delattr__(self, name):
+        raise AttributeError('{} is read-only'.format(self))
+
+    def __repr__(self):
+        return '<CarrierSnapshot: {}>'.format(self.name)
+
+
+class CarrierRegistry(object):
+    """
+    In-process cache of all carriers, so hot paths don't need to query the DB at all.
+
+    Each account's carrier list (the master list being the one with no account) is loaded lazily, with its own indexed
+    query, and then kept as an immutable snapshot: lookups stay O(1) however many accounts there are. Empty lists of
+    accounts are kept too, but only up to `max_unknown_accounts` of them, so unknown accounts (which come from URLs)
+    don't query the DB every time but can't make this cache grow unbounded either. All lists are dropped at once when
+    they may be outdated:
+    - Right away, if a carrier was saved or deleted by this very process
+    - Once the TTL expires, only if the carriers list version stored in the DB changed (i.e. another process changed it)
+    """
+
+    def __init__(self, ttl, max_unknown_accounts=10000):
+        self.ttl = ttl
+        self.max_unknown_accounts = max_unknown_accounts
+        self._lock = Lock()
+        self._state = None
+        self._expires_at = 0
+
+    def get_all(self, account_id=None):
+        return self._get_carrier_list(account_id).carriers
+
+    def get_all_enabled(self, account_id=None):
+        return self._get_carrier_list(account_id).enabled_carriers
+
+    def get_by_code(self, code, account_id=None):
+        return self._get_carrier_list(account_id).carriers_by_code.get(code)
+
+    @property
+    def version(self):
+        return self._get_state().version
+
+    def invalidate(self):
+        self._expires_at = 0
+        self._state = None
+
+    def _get_carrier_list(self, account_id):
+        state = self._get_state()
+        carrier_list = state.carrier_lists.get(account_id)
+        if carrier_list is None:
+            # Concurrent loads of the same list are harmless, the last one just wins
+            carriers = tuple(
+                CarrierSnapshot(carrier)
+                for carrier in Carrier.get_all(account_id=account_id, use_replica=state.use_replica)
+            )
+            carrier_list = _CarrierList(
+                carriers=carriers,
+                enabled_carriers=tuple(carrier for carrier in carriers if carrier.enabled),
+                carriers_by_code={carrier.code: carrier for carrier in carriers},
+            )
+            if not carriers and account_id is not None:
+                if len(state.unknown_accounts) >= self.max_unknown_accounts:
+                    return carrier_list
+                state.unknown_accounts.add(account_id)
+            state.carrier_lists[account_id] = carrier_list
+        return carrier_list
+
+    def _get_state(self):
+        state = self._state
+        if state is not None and state.local_bumps == CarrierListVersion.local_bumps and monotonic() < self._expires_at:
+            return state
+
+        with self._lock:
+            state = self._state
+            local_bumps = CarrierListVersion.local_bumps
+            # Replicas may lag behind: this process' own changes and the first load of carriers are not read from them
+            use_replica = state is not None and state.local_bumps == local_bumps
+            version = CarrierListVersion.get_current(use_replica=use_replica)
+            if use_replica and version != state.version:
+                # Either carriers changed or this replica lags behind: another replica (picked for the carriers) could
+                # then be behind this version, so both are read from the primary DB until a whole TTL later
+                use_replica = False
+                version = CarrierListVersion.get_current(use_replica=False)
+            if state is None or state.local_bumps != local_bumps or state.version != version:
+                state = _RegistryState(
+                    carrier_lists={}, unknown_accounts=set(), version=version, local_bumps=local_bumps,
+                    use_replica=use_replica,
+                )
+                self._state = state
+            elif use_replica and not state.use_replica:
+                # A whole TTL later, replicas are expected to have caught up
+                state = self._state = state._replace(use_replica=True)
+            self._expires_at = monotonic() + self.ttl
+        return state
+
+
+def get_carrier_registry():
+    """
+    Returns the carrier registry of the current Flask app.
+    """
+    return current_app.extensions['carrier_registry']
+
+
+def configure_registry(app):
+    """
+    Attaches a carrier registry to the given Flask app, using its configuration.
+    """
+    app.extensions['carrier_registry'] = CarrierRegistry(
+        ttl=app.config['CARRIER_REGISTRY_TTL'], max_unknown_accounts=app.config['CARRIER_REGISTRY_MAX_UNKNOWN_ACCOUNTS']
+    )
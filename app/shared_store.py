@@ -0,0 +1,232 @@
+# coding=utf-8
+
+
+import fcntl
+import hashlib
+import json
+import os
+import random
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+
+class LocalSharedStore(object):
+    """
+    Local stand-in for a key-value store shared by all processes (e.g. Redis), to be used in development and test cases.
+
+    It only implements the subset of Redis' interface used in this app.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self._get(key) is not None:
+                return None
+            self._entries[key] = (value, time() + ex if ex else None)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return 1 if self._entries.pop(key, None) is not None else 0
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value = int(self._get(key) or 0) + amount
+            _, expires_at = self._entries.get(key, (None, None))
+            self._entries[key] = (value, expires_at)
+            return value
+
+    def expire(self, key, time_to_live):
+        with self._lock:
+            if self._get(key) is None:
+                return False
+            self._entries[key] = (self._entries[key][0], time() + time_to_live)
+            return True
+
+    def update(self, key, func):
+        """
+        Atomically updates the given key with `func(value)` (None if there's none), which returns a tuple with its new
+        value (None to leave it as it is), its time to live (secs, None for none) and the result to return. It stands
+        in for Redis' Lua scripts.
+        """
+        with self._lock:
+            value, time_to_live, result = func(self._get(key))
+            if value is not None:
+                self._entries[key] = (value, time() + time_to_live if time_to_live else None)
+            return result
+
+    def _get(self, key):
+        value, expires_at = self._entries.get(key, (None, None))
+        if expires_at is not None and expires_at <= time():
+            del self._entries[key]
+            return None
+        return value
+
+
+class FileSharedStore(object):
+    """
+    Local stand-in for a key-value store shared by all processes (e.g. Redis) that, unlike LocalSharedStore, is really
+    shared by all processes running on this host (e.g. gunicorn workers): one file per key, under the given directory.
+
+    It only implements the subset of Redis' interface used in this app, with atomic writes (including `nx` ones, so it
+    can be used for locks too, although taking over an expired key is not atomic). Expired entries are deleted by a
+    sweep of the whole directory on a sample of writes (`sweep_probability`), since reads just treat them as missing.
+    """
+    _STALE_TEMP_FILE_AGE = 60  # Secs, temporary files older than that were left behind by dead processes
+
+    def __init__(self, directory, sweep_probability=0.01):
+        self.directory = directory
+        self.sweep_probability = sweep_probability
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        entry = self._read_entry(key)
+        return entry['value'] if entry is not None else None
+
+    def set(self, key, value, ex=None, nx=False):
+        self._sweep_sometimes()
+        path = self._get_path(key)
+        temp_path = self._write_temp_entry(path, value, time() + ex if ex else None)
+        try:
+            if not nx:
+                os.replace(temp_path, path)
+                return True
+            for _ in range(2):
+                try:
+                    os.link(temp_path, path)  # Fails if the key exists, unlike os.replace()
+                    return True
+                except FileExistsError:
+                    if self.get(key) is not None:
+                        return None
+                    self.delete(key)  # Expired, so it's just as if there was none
+            return None
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._get_path(key))
+        except FileNotFoundError:
+            return 0
+        return 1
+
+    def incr(self, key, amount=1):
+        self._sweep_sometimes()
+        with self._lock_key(key):
+            entry = self._read_entry(key) or {'value': 0, 'expires_at': None}
+            value = int(entry['value']) + amount
+            os.replace(self._write_temp_entry(self._get_path(key), value, entry['expires_at']), self._get_path(key))
+            return value
+
+    def expire(self, key, time_to_live):
+        with self._lock_key(key):
+            entry = self._read_entry(key)
+            if entry is None:
+                return False
+            os.replace(
+                self._write_temp_entry(self._get_path(key), entry['value'], time() + time_to_live), self._get_path(key)
+            )
+            return True
+
+    def update(self, key, func):
+        """
+        Atomically updates the given key, as LocalSharedStore.update() does.
+        """
+        self._sweep_sometimes()
+        with self._lock_key(key):
+            entry = self._read_entry(key)
+            value, time_to_live, result = func(entry['value'] if entry is not None else None)
+            if value is not None:
+                os.replace(
+                    self._write_temp_entry(self._get_path(key), value, time() + time_to_live if time_to_live else None),
+                    self._get_path(key),
+                )
+            return result
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _read_entry(self, key):
+        """
+        Returns the (unexpired) entry of the given key, as a dict with its value and expiration time, or None.
+        """
+        try:
+            with open(self._get_path(key)) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        if entry['expires_at'] is not None and entry['expires_at'] <= time():
+            return None
+        return entry
+
+    def _write_temp_entry(self, path, value, expires_at):
+        """
+        Writes an entry to a new temporary file next to the given path, returning its path.
+        """
+        temp_path = '{}.{}.tmp'.format(path, uuid4().hex)
+        with open(temp_path, 'w') as entry_file:
+            json.dump({'value': value, 'expires_at': expires_at}, entry_file)
+        return temp_path
+
+    def _sweep_sometimes(self):
+        """
+        Deletes all expired entries (and stale temporary files) of the directory, on a sample of writes.
+        """
+        if random.random() >= self.sweep_probability:
+            return
+        now = time()
+        for dir_entry in os.scandir(self.directory):
+            try:
+                if dir_entry.name.endswith('.tmp'):
+                    if dir_entry.stat().st_mtime < now - self._STALE_TEMP_FILE_AGE:
+                        os.remove(dir_entry.path)
+                elif not dir_entry.name.endswith('.lock'):
+                    self._delete_if_expired(dir_entry.path, now)
+            except (OSError, ValueError):
+                continue  # Deleted (or replaced) by another process in the meantime
+
+    def _delete_if_expired(self, path, now):
+        with open(path) as entry_file:
+            expires_at = json.load(entry_file)['expires_at']
+            # Writes replace entries' files, so the file being another one means it was just written
+            if expires_at is not None and expires_at <= now and (
+                os.fstat(entry_file.fileno()).st_ino == os.stat(path).st_ino
+            ):
+                os.remove(path)
+
+    @contextmanager
+    def _lock_key(self, key):
+        """
+        Context manager that holds an exclusive lock on the given key (across processes), for read-modify-write updates.
+        """
+        with open(self._get_path(key) + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def connect_shared_store(url):
+    """
+    Returns a client for the shared key-value store at the given URL: either a 'redis://' one, 'local://' to use a
+    LocalSharedStore, or 'file://<directory>' to use a FileSharedStore instead.
+    """
+    if url.startswith('local://'):
+        return LocalSharedStore()
+    if url.startswith('file://'):
+        return FileSharedStore(url[len('file://'):])
+
+    # Optional dependency, only needed when a real shared store is used
+    import redis
+    return redis.StrictRedis.from_url(url)
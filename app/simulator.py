@@ -0,0 +1,219 @@
+# coding=utf-8
+
+
+import json
+import random
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from app.quote_cache import normalize_shipment
+
+# Simulated answer of a carrier: the HTTP status code, cost (-1 if there's none) and costs by shipment method (if any)
+# it answers with, after waiting for its latency (secs) and then dripping its body over `drip` secs
+SimulatedQuote = namedtuple('SimulatedQuote', ('status_code', 'cost', 'costs', 'latency', 'drip'))
+
+
+def build_latency_sampler(spec, rng):
+    """
+    Returns a function that samples latencies (in secs) from the distribution described by the given spec:
+    - 'constant:<secs>'
+    - 'uniform:<min secs>,<max secs>'
+    - 'exponential:<mean secs>'
+    - 'lognormal:<mu>,<sigma>' (of the underlying normal distribution, in secs)
+    """
+    name, _, params = spec.partition(':')
+    params = [float(param) for param in params.split(',')] if params else []
+    if name == 'constant':
+        return lambda: params[0] if params else 0.0
+    if name == 'uniform':
+        return lambda: rng.uniform(params[0], params[1])
+    if name == 'exponential':
+        return lambda: rng.expovariate(1 / params[0])
+    if name == 'lognormal':
+        return lambda: rng.lognormvariate(params[0], params[1])
+    raise ValueError('Unknown latency distribution: {}'.format(spec))
+
+
+class CarrierProfile(object):
+    """
+    How a simulated carrier behaves: its latency distribution (see `build_latency_sampler()`), the rate (and HTTP
+    status code) of its errors, its daily quota of calls (answered with HTTP 429 once exhausted, None if unlimited), and
+    how long its responses' body takes to arrive once the response started (slow-drip, in secs).
+    """
+
+    def __init__(self, latency='constant:0', error_rate=0.0, error_status_code=500, daily_quota=None, drip=0.0):
+        build_latency_sampler(latency, random.Random())  # Invalid specs fail right away
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status_code = error_status_code
+        self.daily_quota = daily_quota
+        self.drip = drip
+
+
+class CarrierSimulator(object):
+    """
+    Simulates carriers by code, each one with its own profile (or the default one), so quotes can be load-tested and
+    latency incidents reproduced without depending on any external service.
+
+    It's deterministic: the answer to a call only depends on the seed, the carrier, the (normalized) shipment and how
+    many times that same shipment was quoted before with that carrier, so concurrent calls for different shipments
+    can't change each other's answers. The only exception are daily quotas, which are counted by carrier (in UTC days)
+    just like real ones: once a quota is exhausted, which calls get an HTTP 429 depends on the order of all calls to
+    that carrier.
+
+    Calls are counted for up to `max_shipments` (carrier, shipment) pairs, the oldest ones being forgotten first (their
+    next calls are answered as if they were the first ones again). Use `reset()` to start over between runs.
+    """
+
+    def __init__(self, profiles=None, default_profile=None, seed=0, default_shipment_method='regular',
+                 max_shipments=100000):
+        self.profiles = profiles or {}
+        self.default_profile = default_profile or CarrierProfile()
+        self.seed = seed
+        self.default_shipment_method = default_shipment_method
+        self.max_shipments = max_shipments
+        self._calls = OrderedDict()  # (Carrier code, normalized shipment) -> calls count, the oldest ones first
+        self._quota_usage = {}  # Carrier code -> (UTC day, calls count)
+        self._lock = threading.Lock()
+
+    def simulate(self, carrier_code, shipment, shipment_methods):
+        """
+        Returns the SimulatedQuote of the given carrier for the given shipment data (a dict), for all the given shipment
+        methods. It doesn't wait for it, see its latency and drip.
+        """
+        profile = self.profiles.get(carrier_code, self.default_profile)
+        call_key = (carrier_code,) + normalize_shipment(shipment)
+        today = datetime.utcnow().date()
+        with self._lock:
+            call_number = self._calls.get(call_key, 0)
+            self._calls[call_key] = call_number + 1
+            if len(self._calls) > self.max_shipments:
+                self._calls.popitem(last=False)
+            quota_day, quota_usage = self._quota_usage.get(carrier_code, (today, 0))
+            quota_usage = quota_usage + 1 if quota_day == today else 1
+            self._quota_usage[carrier_code] = (today, quota_usage)
+
+        # Seeded with a string, which is hashed the same way in every process (unlike tuples)
+        rng = random.Random('{}:{}:{}'.format(self.seed, json.dumps(call_key), call_number))
+        latency = max(0.0, build_latency_sampler(profile.latency, rng)())
+        is_error = rng.random() < profile.error_rate
+        costs = {shipment_method: rng.randint(1, 1000) for shipment_method in sorted(shipment_methods)}
+        if profile.daily_quota is not None and quota_usage > profile.daily_quota:
+            return SimulatedQuote(status_code=429, cost=-1, costs=None, latency=latency, drip=0.0)
+        if is_error:
+            return SimulatedQuote(
+                status_code=profile.error_status_code, cost=-1, costs=None, latency=latency, drip=0.0
+            )
+        return SimulatedQuote(
+            status_code=200,
+            cost=costs.get(self.default_shipment_method, -1),
+            costs=costs,
+            latency=latency,
+            drip=profile.drip,
+        )
+
+    def reset(self):
+        """
+        Forgets all calls made so far, so the same calls get the same answers again.
+        """
+        with self._lock:
+            self._calls.clear()
+            self._quota_usage.clear()
+
+
+class CarrierSimulatorServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server that serves the given carrier simulator as carriers' APIs (as expected by HTTPCarrierAdapter):
+    carriers are told apart by the first part of the path, e.g. `POST /fedex/shippingcosts`.
+
+    Responses are sent after the simulated latency, and successful ones (`{"cost": ..., "costs": {...}}`) have their
+    body dripped in small chunks over the simulated drip.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    DRIP_CHUNK_SIZE = 8  # Bytes
+
+    class _RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive
+
+        def do_POST(self):
+            request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                shipment = json.loads(request_body.decode('utf-8'))
+                carrier_code = self.path.lstrip('/').split('/', 1)[0].split('?', 1)[0]
+                simulated_quote = self.server.simulator.simulate(
+                    carrier_code, shipment, shipment.get('shipment_methods') or ()
+                )
+            except (ValueError, KeyError, AttributeError, TypeError):
+                self._send_json(400, {'message': 'Invalid shipment'})
+                return
+            time.sleep(simulated_quote.latency)
+            if simulated_quote.status_code != 200:
+                self._send_json(simulated_quote.status_code, {'message': 'Simulated carrier error'})
+                return
+            self._send_json(200, {'cost': simulated_quote.cost, 'costs': simulated_quote.costs}, simulated_quote.drip)
+
+        def _send_json(self, status_code, data, drip=0.0):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            chunk_size = self.server.DRIP_CHUNK_SIZE if drip > 0 else len(body)
+            chunks = [body[start:start + chunk_size] for start in range(0, len(body), chunk_size)]
+            for index, chunk in enumerate(chunks):
+                if index > 0:
+                    self.wfile.flush()
+                    time.sleep(drip / (len(chunks) - 1))
+                self.wfile.write(chunk)
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self, simulator, host='127.0.0.1', port=0):
+        super().__init__((host, port), self._RequestHandler)
+        self.simulator = simulator
+        self.url = 'http://{}:{}/'.format(host, self.server_address[1])
+
+    def start(self):
+        """
+        Starts serving in a background thread, returning the server itself.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        pass  # e.g. clients that timed out and closed the connection
+
+
+def build_carrier_simulator(config):
+    """
+    Returns a carrier simulator set up from the given Flask app configuration.
+    """
+    return CarrierSimulator(
+        profiles={
+            carrier_code: CarrierProfile(**profile)
+            for carrier_code, profile in config['CARRIER_SIMULATOR_PROFILES'].items()
+        },
+        default_profile=CarrierProfile(**config['CARRIER_SIMULATOR_DEFAULT_PROFILE']),
+        seed=config['CARRIER_SIMULATOR_SEED'],
+        default_shipment_method=config['DEFAULT_SHIPMENT_METHOD'],
+    )
+
+
+def configure_carrier_simulator(app):
+    """
+    Attaches a carrier simulator to the given Flask app if enabled, so mocked carriers are simulated in-process instead
+    of hitting fakeJSON.
+    """
+    app.extensions['carrier_simulator'] = (
+        build_carrier_simulator(app.config) if app.config['CARRIER_SIMULATOR_ENABLED'] else None
+    )
@@ -0,0 +1,142 @@
+# coding=utf-8
+
+
+import json
+from threading import Event, Lock
+from time import monotonic, sleep
+from uuid import uuid4
+
+from app.instrumentation import get_instrumentation
+from app.shared_store import connect_shared_store
+
+
+class _Flight(object):
+    """
+    A call in flight, that any number of callers can wait for.
+    """
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: only the first one (the leader) actually runs, and any identical call
+    made while it's in flight just waits for it and gets the very same result (or exception). Once it's done, the next
+    call with that key runs again (i.e. results are not cached).
+
+    Calls are coalesced within this process and, if a shared store is given (e.g. Redis), across processes too: only
+    one leader among all processes holds the key's lock, and it publishes its result (which must be JSON-serializable)
+    for the other processes' leaders, that poll for it. If the lock holder goes away without a result (e.g. its call
+    failed), the others just run the call themselves.
+    """
+
+    def __init__(self, shared_store=None, lock_ttl=10, poll_interval=0.01, result_ttl=1,
+                 key_prefix='shiphero:singleflight:'):
+        self.shared_store = shared_store
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self.key_prefix = key_prefix
+        self.calls = 0
+        self.coalesced_calls = 0
+        self._flights = {}
+        self._lock = Lock()
+
+    def do(self, key, func):
+        """
+        Returns the result of `func()`, or the one of the identical call (i.e. with the same hashable key) in flight.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced_calls += 1
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._do_shared(key, func) if self.shared_store is not None else self._call(func)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'coalesced_calls': self.coalesced_calls,
+        }
+
+    def _call(self, func):
+        with self._lock:
+            self.calls += 1
+        return func()
+
+    def _do_shared(self, key, func):
+        """
+        Returns the result of `func()`, or the one published by the process holding the key's lock.
+        """
+        raw_key = json.dumps(key, separators=(',', ':'))
+        lock_key = '{}lock:{}'.format(self.key_prefix, raw_key)
+        result_key = '{}result:{}'.format(self.key_prefix, raw_key)
+        token = uuid4().hex
+        if self.shared_store.set(lock_key, token, ex=self.lock_ttl, nx=True):
+            try:
+                result = self._call(func)
+                self.shared_store.set(result_key, json.dumps(result), ex=self.result_ttl)
+                return result
+            finally:
+                # Not atomic, but the lock's TTL covers the (unlikely) case of releasing someone else's lock
+                if self.shared_store.get(lock_key) in (token, token.encode()):
+                    self.shared_store.delete(lock_key)
+
+        give_up_at = monotonic() + self.lock_ttl
+        while monotonic() < give_up_at:
+            raw_result = self.shared_store.get(result_key)
+            if raw_result is not None:
+                with self._lock:
+                    self.coalesced_calls += 1
+                return json.loads(raw_result)
+            if self.shared_store.get(lock_key) is None:
+                break
+            sleep(self.poll_interval)
+        # The lock holder finished without a result (or is taking way too long): better to just call ourselves
+        raw_result = self.shared_store.get(result_key)
+        return json.loads(raw_result) if raw_result is not None else self._call(func)
+
+
+def configure_single_flight(app):
+    """
+    Attaches a single-flight group for carrier calls to the given Flask app, along with its metrics, using its
+    configuration.
+    """
+    single_flight = None
+    if app.config['SINGLE_FLIGHT_ENABLED']:
+        shared_store_url = app.config['SINGLE_FLIGHT_SHARED_STORE_URL']
+        single_flight = SingleFlight(
+            shared_store=connect_shared_store(shared_store_url) if shared_store_url else None,
+            lock_ttl=app.config['SINGLE_FLIGHT_LOCK_TTL'],
+            poll_interval=app.config['SINGLE_FLIGHT_POLL_INTERVAL'],
+        )
+    app.extensions['single_flight'] = single_flight
+
+    instrumentation = get_instrumentation(app)
+    if single_flight is not None and instrumentation is not None:
+        def _collect_single_flight_metrics(metrics):
+            for stat_name, value in single_flight.stats().items():
+                metrics.set_gauge('single_flight_calls', value, kind=stat_name)
+
+        instrumentation.metrics.add_collector(_collect_single_flight_metrics)
@@ -0,0 +1,66 @@
+# coding=utf-8
+
+
+import argparse
+import json
+import subprocess
+import sys
+from time import perf_counter
+
+from benchmarks.common import save_results, summarize_latencies
+
+
+def measure_boot(load_initial_data):
+    """
+    Boots the app in this (fresh) process, returning a dict with the time (in secs) spent importing it and creating it.
+    Loading initial data can be done on boot too, as the app used to do on every process start.
+    """
+    started_at = perf_counter()
+    from app import create_app
+    from app.models import db
+    from config import Env, load_initial_db_data
+    imported_at = perf_counter()
+    app = create_app(Env.TESTING)
+    if load_initial_data:
+        with app.app_context():
+            load_initial_db_data(app, db)
+    created_at = perf_counter()
+    return {'import': imported_at - started_at, 'create': created_at - imported_at, 'total': created_at - started_at}
+
+
+def run_boots(boots_count, load_initial_data):
+    """
+    Boots the app `boots_count` times, each one in a new process, returning the stats of each boot phase.
+    """
+    command = [sys.executable, '-m', 'benchmarks.boot', '--child']
+    if load_initial_data:
+        command.append('--load-initial-data')
+    durations = {'import': [], 'create': [], 'total': []}
+    for _ in range(boots_count):
+        boot_durations = json.loads(subprocess.check_output(command).decode().splitlines()[-1])
+        for phase, duration in boot_durations.items():
+            durations[phase].append(duration)
+    return {phase: summarize_latencies(phase_durations, sum(phase_durations))
+            for phase, phase_durations in durations.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures how long it takes to boot the app in a new process')
+    parser.add_argument('--boots', type=int, default=10)
+    parser.add_argument('--load-initial-data', action='store_true', help='Also load initial data, as on every boot')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='Path of the JSON results file (by default, under benchmarks/results/)')
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_boot(args.load_initial_data)))
+        return
+
+    results = run_boots(args.boots, args.load_initial_data)
+    for phase, phase_results in results.items():
+        print('{:<8} p50 {:>8.1f}ms  p95 {:>8.1f}ms'.format(phase, phase_results['p50_ms'], phase_results['p95_ms']))
+    print('Results saved to {}'.format(save_results('boot', results, args.output)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# coding=utf-8
+
+
+import json
+import math
+import os
+import platform
+import subprocess
+from datetime import datetime
+
+from app import create_app
+from app.models import db
+from config import Env, load_initial_db_data
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def get_percentile(sorted_values, percentile):
+    """
+    Returns the given percentile (e.g. 0.95) of the given, already sorted, values.
+    """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, int(math.ceil(percentile * len(sorted_values))) - 1)]
+
+
+def summarize_latencies(latencies, elapsed):
+    """
+    Returns a dict with the stats of the given latencies (in secs), observed over `elapsed` secs.
+    """
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50_ms': 1000 * get_percentile(latencies, 0.50),
+        'p95_ms': 1000 * get_percentile(latencies, 0.95),
+        'p99_ms': 1000 * get_percentile(latencies, 0.99),
+        'max_ms': 1000 * latencies[-1] if latencies else 0.0,
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(RESULTS_DIR), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(kind, results, output_path=None):
+    """
+    Saves the given benchmark results as JSON, along with some metadata to compare runs across commits. Returns the
+    path of the saved file.
+    """
+    commit = get_git_commit()
+    created = datetime.utcnow()
+    if output_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output_path = os.path.join(RESULTS_DIR, '{}-{}-{:%Y%m%d%H%M%S}.json'.format(kind, commit, created))
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            'kind': kind,
+            'commit': commit,
+            'created': created.isoformat(),
+            'python': platform.python_version(),
+            'results': results,
+        }, output_file, indent=2, sort_keys=True)
+    return output_path
+
+
+def create_benchmark_app(fakejson_api_endpoint):
+    """
+    Returns a new Flask app (testing env) with a ready-to-use DB, whose carriers hit the given fakeJSON stand-in.
+    """
+    app = create_app(Env.TESTING)
+    app.config['FAKEJSON_API_ENDPOINT'] = fakejson_api_endpoint
+    app.extensions['carrier_simulator'] = None  # Carriers are mocked through the stand-in, so its calls can be counted
+    with app.app_context():
+        db.create_all()
+        load_initial_db_data(app, db)
+    return app
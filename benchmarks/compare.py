@@ -0,0 +1,43 @@
+# coding=utf-8
+
+
+import argparse
+import json
+
+_COMPARED_STATS = ('per_second', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def _load_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def compare_results(baseline, candidate):
+    """
+    Returns a list of (benchmark name, stat name, baseline value, candidate value, change ratio) for all stats found in
+    both the given results.
+    """
+    comparison = []
+    for name, baseline_stats in sorted(baseline['results'].items()):
+        candidate_stats = candidate['results'].get(name)
+        if candidate_stats is None or 'count' not in baseline_stats:
+            continue
+        for stat_name in _COMPARED_STATS:
+            baseline_value, candidate_value = baseline_stats[stat_name], candidate_stats[stat_name]
+            change = (candidate_value - baseline_value) / baseline_value if baseline_value else 0.0
+            comparison.append((name, stat_name, baseline_value, candidate_value, change))
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares two benchmark results files (e.g. from different commits)')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args()
+
+    baseline, candidate = _load_results(args.baseline), _load_results(args.candidate)
+    print('{} ({}) -> {} ({})'.format(baseline['commit'], baseline['kind'], candidate['commit'], candidate['kind']))
+    for name, stat_name, baseline_value, candidate_value, change in compare_results(baseline, candidate):
+        print('{:<40} {:<12} {:>12.2f} {:>12.2f} {:>+8.1%}'.format(
+            name, stat_name, baseline_value, candidate_value, change
+        ))
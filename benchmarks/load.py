@@ -0,0 +1,133 @@
+# coding=utf-8
+
+
+import argparse
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from benchmarks.common import create_benchmark_app, save_results, summarize_latencies
+from benchmarks.stub_carrier_server import StubCarrierServer
+
+
+_RESULTS_FORMAT = (
+    '{scenario:<12} {per_second:>10.1f} req/s  p50 {p50_ms:>8.1f}ms  p95 {p95_ms:>8.1f}ms  p99 {p99_ms:>8.1f}ms  '
+    'errors {errors}  carrier calls {carrier_requests}'
+)
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass  # Logging every request would skew the results
+
+
+def _build_shipment_data(shipment_index):
+    return {
+        'address': '{} Main St, Springfield'.format(shipment_index),
+        'weight': 1 + shipment_index % 50,
+        'priority': 1 + shipment_index % 5,
+        'box_type': ('small', 'medium', 'big')[shipment_index % 3],
+        'test_mode': True,
+    }
+
+
+def run_load(base_url, scenario, requests_count, concurrency, distinct_shipments):
+    """
+    Hits the given scenario's endpoint `requests_count` times, from `concurrency` threads at once, returning the stats
+    of the observed latencies (and how many requests didn't get a HTTP 200).
+
+    For streamed shipping costs, latencies are the time to the first quote instead (the whole response is still read).
+    """
+    thread_data = threading.local()
+    latencies = []
+    errors_count = [0]
+    lock = threading.Lock()
+
+    def _send_request(request_index):
+        session = getattr(thread_data, 'session', None)
+        if session is None:
+            session = thread_data.session = requests.Session()
+        started_at = perf_counter()
+        if scenario == 'carriers':
+            response = session.get(base_url + '/api/shipping/carriers')
+            latency = perf_counter() - started_at
+        elif scenario == 'costs_stream':
+            shipment_data = _build_shipment_data(random.randrange(distinct_shipments))
+            response = session.post(
+                base_url + '/api/shipping/costs', json=shipment_data, headers={'Accept': 'application/x-ndjson'},
+                stream=True,
+            )
+            lines = response.iter_lines()
+            next(lines, None)
+            latency = perf_counter() - started_at
+            for _ in lines:
+                pass
+        else:
+            shipment_data = _build_shipment_data(random.randrange(distinct_shipments))
+            response = session.post(base_url + '/api/shipping/costs', json=shipment_data)
+            latency = perf_counter() - started_at
+        with lock:
+            latencies.append(latency)
+            errors_count[0] += 0 if response.status_code == 200 else 1
+
+    started_at = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(_send_request, range(requests_count)))
+    results = summarize_latencies(latencies, perf_counter() - started_at)
+    results['errors'] = errors_count[0]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs an end-to-end load test of the shipping API')
+    parser.add_argument('--url', help='Base URL of an already running app (by default, one is started locally)')
+    parser.add_argument(
+        '--scenario', action='append', choices=('costs', 'costs_stream', 'carriers'), help='Default: all of them'
+    )
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--distinct-shipments', type=int, default=100, help='To control quote cache hits')
+    parser.add_argument('--carrier-latency', default='lognormal:-3,0.5', help='Stub carrier latency distribution')
+    parser.add_argument('--carrier-error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='Path of the JSON results file (by default, under benchmarks/results/)')
+    args = parser.parse_args()
+
+    stub_server = app_server = None
+    base_url = args.url
+    if base_url is None:
+        stub_server = StubCarrierServer(latency=args.carrier_latency, error_rate=args.carrier_error_rate).start()
+        app_server = make_server('127.0.0.1', 0, create_benchmark_app(stub_server.url), threaded=True,
+                                 request_handler=_QuietRequestHandler)
+        threading.Thread(target=app_server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:{}'.format(app_server.server_port)
+
+    results = {'settings': {
+        'url': args.url, 'requests': args.requests, 'concurrency': args.concurrency,
+        'distinct_shipments': args.distinct_shipments, 'carrier_latency': args.carrier_latency,
+        'carrier_error_rate': args.carrier_error_rate,
+    }}
+    try:
+        for scenario in args.scenario or ('carriers', 'costs', 'costs_stream'):
+            carrier_requests_count = stub_server.requests_count if stub_server is not None else 0
+            results[scenario] = run_load(
+                base_url, scenario, args.requests, args.concurrency, args.distinct_shipments
+            )
+            # Outbound calls actually made (i.e. not answered by cached or coalesced quotes), if they can be counted
+            results[scenario]['carrier_requests'] = (
+                stub_server.requests_count - carrier_requests_count if stub_server is not None else None
+            )
+            print(_RESULTS_FORMAT.format(scenario=scenario, **results[scenario]))
+    finally:
+        if app_server is not None:
+            app_server.shutdown()
+            stub_server.stop()
+    print('Results saved to {}'.format(save_results('load', results, args.output)))
+
+
+if __name__ == '__main__':
+    main()
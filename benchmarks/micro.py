@@ -0,0 +1,114 @@
+# coding=utf-8
+
+
+import argparse
+import json
+from time import perf_counter
+
+from flask_restful import fields, marshal_with
+
+from app.adapters import Quote
+from app.api import SHIPMENT_REQUEST_PARSER, ShippingCostsEndpoint, get_rendered_carriers
+from app.enums import BoxType, Priority
+from app.models import Carrier
+from app.rate_tables import RateTable
+from app.registry import get_carrier_registry
+from app.serialization import CARRIER_SERIALIZER, get_json_backend
+from benchmarks.common import create_benchmark_app, save_results, summarize_latencies
+from benchmarks.stub_carrier_server import StubCarrierServer
+
+# What carriers were serialized with before CARRIER_SERIALIZER, as a baseline
+CARRIER_FIELDS = {
+    'code': fields.String(attribute='code'),
+    'name': fields.String,
+    'shipment_methods': fields.Raw,
+    'enabled': fields.Boolean,
+}
+SHIPMENT_DATA = {'address': '1600 Amphitheatre Pkwy, Mountain View, CA', 'weight': 10, 'priority': 3,
+                 'box_type': 'medium', 'test_mode': True}
+
+
+def run_benchmark(func, iterations, warmup_iterations=100):
+    """
+    Calls the given function `iterations` times (after some warm-up calls), returning the stats of its latencies.
+    """
+    for _ in range(warmup_iterations):
+        func()
+    latencies = []
+    started_at = perf_counter()
+    for _ in range(iterations):
+        call_started_at = perf_counter()
+        func()
+        latencies.append(perf_counter() - call_started_at)
+    return summarize_latencies(latencies, perf_counter() - started_at)
+
+
+def get_benchmarks(app):
+    """
+    Returns a dict with the functions to benchmark (to be called within the given app's context), by name.
+    """
+    endpoint = ShippingCostsEndpoint()
+    carrier = Carrier.get_all()[0]
+    request_body = json.dumps(SHIPMENT_DATA)
+    rate_table = RateTable.from_rate_card({
+        'carrier': carrier.code,
+        'weight_brackets': [1, 5, 10, 20, 50, 150],
+        'default_zone': 8,
+        'zip_prefix_zones': {str(prefix): 1 + prefix % 8 for prefix in range(100, 1000)},
+        'rates': [
+            {'method': method, 'zone': zone, 'box_type': box_type, 'priority': priority, 'costs': [1, 2, 3, 4, 5, 6]}
+            for method in carrier.shipment_methods for zone in range(1, 9)
+            for box_type in BoxType.choices() for priority in Priority.choices()
+        ],
+    }, carrier)
+    shipments = [dict(SHIPMENT_DATA, weight=weight) for weight in range(1, 101)]
+
+    def _parse_shipment_request():
+        with app.test_request_context('/api/shipping/costs', method='POST', data=request_body,
+                                      content_type='application/json'):
+            SHIPMENT_REQUEST_PARSER.parse_args()
+
+    return {
+        'request_parser.parse_args': _parse_shipment_request,
+        'marshal_with.carriers': marshal_with(CARRIER_FIELDS)(lambda: list(get_carrier_registry().get_all())),
+        'carrier_serializer.carriers': lambda: CARRIER_SERIALIZER.serialize_many(get_carrier_registry().get_all()),
+        'json_backend.carriers': lambda: get_json_backend().dumps(
+            CARRIER_SERIALIZER.serialize_many(get_carrier_registry().get_all())
+        ),
+        'rendered_carriers': get_rendered_carriers,
+        'carrier.get_all': Carrier.get_all,
+        'carrier.get_all_enabled': Carrier.get_all_enabled,
+        'carrier_registry.get_all_enabled': lambda: get_carrier_registry().get_all_enabled(),
+        'rate_table.quote': lambda: rate_table.quote(SHIPMENT_DATA),
+        'rate_table.quote_many.100': lambda: rate_table.quote_many(shipments),
+        'handle_carrier_response.success': lambda: endpoint._handle_carrier_response(carrier, Quote(200, 42)),
+        'handle_carrier_response.error': lambda: endpoint._handle_carrier_response(carrier, Quote(500, -1)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs micro-benchmarks of the quote path')
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--only', action='append', help='Name of a benchmark to run (can be given many times)')
+    parser.add_argument('--output', help='Path of the JSON results file (by default, under benchmarks/results/)')
+    args = parser.parse_args()
+
+    stub_server = StubCarrierServer().start()
+    app = create_benchmark_app(stub_server.url)
+    results = {}
+    try:
+        with app.app_context():
+            for name, func in sorted(get_benchmarks(app).items()):
+                if args.only and name not in args.only:
+                    continue
+                results[name] = run_benchmark(func, args.iterations)
+                print('{:<40} {:>12.1f} ops/s  p50 {:>8.1f}us  p99 {:>8.1f}us'.format(
+                    name, results[name]['per_second'], 1000 * results[name]['p50_ms'], 1000 * results[name]['p99_ms']
+                ))
+    finally:
+        stub_server.stop()
+    print('Results saved to {}'.format(save_results('micro', results, args.output)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# coding=utf-8
+
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from app.simulator import build_latency_sampler
+
+
+class StubCarrierServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server that stands in for fakeJSON (and for carriers' APIs) in benchmarks, so they don't depend on any
+    external service.
+
+    Every request waits for a latency sampled from the configured distribution, and then fails (HTTP 500) with the
+    configured error rate. Otherwise, it answers fakeJSON-style: the request's `data` with 'numberInt' values replaced
+    by random ints (or `{"cost": <int>}`, if there's no `data`).
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    class _RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive
+
+        def do_POST(self):
+            server = self.server
+            server.count_request()
+            request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(server.sample_latency())
+            if server.should_fail():
+                self._send_json(500, {'message': 'Stub carrier error'})
+                return
+            try:
+                response_data = json.loads(request_body.decode('utf-8')).get('data')
+            except (ValueError, AttributeError):
+                response_data = None
+            if not isinstance(response_data, dict):
+                response_data = {'cost': 'numberInt'}
+            self._send_json(200, {
+                key: server.random_int() if value == 'numberInt' else value for key, value in response_data.items()
+            })
+
+        def _send_json(self, status_code, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self, host='127.0.0.1', port=0, latency='constant:0', error_rate=0.0, seed=None):
+        super().__init__((host, port), self._RequestHandler)
+        self.url = 'http://{}:{}/'.format(host, self.server_address[1])
+        self.error_rate = error_rate
+        self.requests_count = 0
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._latency_sampler = build_latency_sampler(latency, self._rng)
+
+    def count_request(self):
+        with self._rng_lock:
+            self.requests_count += 1
+
+    def sample_latency(self):
+        with self._rng_lock:
+            return max(0.0, self._latency_sampler())
+
+    def should_fail(self):
+        with self._rng_lock:
+            return self._rng.random() < self.error_rate
+
+    def random_int(self):
+        with self._rng_lock:
+            return self._rng.randint(1, 1000)
+
+    def start(self):
+        """
+        Starts serving in a background thread, returning the server itself.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        pass  # e.g. clients that timed out and closed the connection
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a local stub carrier server (fakeJSON stand-in)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', default='constant:0', help='e.g. constant:0.05, lognormal:-3,0.5')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    server = StubCarrierServer(args.host, args.port, args.latency, args.error_rate, args.seed)
+    print('Stub carrier server running at {}'.format(server.url))
+    server.serve_forever()
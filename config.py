@@ -2,11 +2,13 @@
 
 
 import os
+import tempfile
 from enum import Enum
 
 from sqlalchemy.exc import ProgrammingError
 
-from app.models import Carrier
+from app.db_routing import build_engine_options
+from app.models import Carrier, CarrierListVersion
 
 CARRIERS_DATA = [
     {
@@ -35,6 +37,22 @@ class Env(Enum):
     PRODUCTION = 'production'
 
 
+class ServerMode(Enum):
+    """
+    Enum that stores all possible ways to serve the app.
+    """
+    WSGI = 'wsgi'  # Regular Flask app, e.g. `gunicorn run:app`
+    ASGI = 'asgi'  # asyncio-native app, e.g. `gunicorn -k uvicorn.workers.UvicornWorker run:app`
+
+
+class QuoteMode(Enum):
+    """
+    Enum that stores all possible ways to get carriers' quotes.
+    """
+    LIVE = 'live'  # Always calling carriers
+    TABLE_FIRST = 'table_first'  # Using carriers' rate tables, calling carriers only if their table is missing or stale
+
+
 class BaseConfig(object):
     """
     Default configurations for all envs.
@@ -43,8 +61,170 @@ class BaseConfig(object):
     TESTING = True
     SECRET_KEY = os.getenv('SECRET_KEY')
     CSRF_ENABLED = True
+    SERVER_MODE = os.getenv('SERVER_MODE', ServerMode.WSGI.value)
+    # Threads to offload carrier calls (and non-native requests) to, in ASGI mode: i.e. how many carrier calls can be in
+    # flight at the same time per process. Calls waiting for a thread don't count against their CARRIER_TIMEOUT
+    ASGI_MAX_WORKERS = 256
     SQLALCHEMY_DATABASE_URI = 'postgresql://localhost/shiphero'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # DB connection pools, per process and DB: connections are checked before being used (pre-ping) and recycled after a
+    # while (secs), and queries time out (ms, PostgreSQL only). Carriers are read from replicas if any (comma-separated
+    # URLs), while writes always go to the primary DB
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_RECYCLE = 1800
+    DB_POOL_PRE_PING = True
+    DB_STATEMENT_TIMEOUT = 5000
+    DB_REPLICA_URLS = [url for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url]
+    # Initial data is loaded by `python manage.py seed`, so booting a process doesn't touch the DB (unless enabled)
+    DB_SEED_ON_BOOT = False
+    # Carriers are cached per process, checking if they changed in the DB at most once per TTL (secs). Unknown accounts
+    # (with no carriers) are cached too, up to MAX_UNKNOWN_ACCOUNTS of them
+    CARRIER_REGISTRY_TTL = 30
+    CARRIER_REGISTRY_MAX_UNKNOWN_ACCOUNTS = 10000
+
+    # Carriers are quoted concurrently: each one has its own timeout and the whole quote has an overall deadline (secs)
+    CARRIER_FANOUT_MAX_WORKERS = 32
+    CARRIER_TIMEOUT = 5
+    SHIPPING_COSTS_DEADLINE = 8
+    # Batch quotes: shipments are validated and quoted in chunks, the deadline above applying to each chunk
+    SHIPPING_COSTS_BATCH_MAX_SHIPMENTS = 10000
+    SHIPPING_COSTS_BATCH_CHUNK_SIZE = 50
+
+    # Carriers' quotes are cached (in secs) by carrier and shipment data, carrier errors (HTTP 5xx) just for a short
+    # while. Quotes are kept in-process unless a shared store is given: 'local://' (dev only), 'file://<dir>' or a
+    # 'redis://' URL
+    QUOTE_CACHE_ENABLED = True
+    QUOTE_CACHE_SHARED_STORE_URL = os.getenv('QUOTE_CACHE_SHARED_STORE_URL')
+    QUOTE_CACHE_MAX_ENTRIES = 10000
+    QUOTE_CACHE_TTL = 300
+    QUOTE_CACHE_CARRIER_TTLS = {}  # Carrier code -> TTL, for carriers that need a different one
+    QUOTE_CACHE_NEGATIVE_TTL = 10
+    # Successful quotes can still be served for a while past their TTL (secs), while they're refreshed in the background
+    QUOTE_CACHE_STALE_TTL = 60
+    QUOTE_REVALIDATION_MAX_WORKERS = 8
+    # The warming worker (`python manage.py warm_quotes`, it needs a shared quote cache) keeps the quotes of the most
+    # quoted shipments (over the lookback, in secs) cached, refreshing them every interval if they'd go stale within
+    # REFRESH_AHEAD (secs). Its carrier calls are paced to MAX_RATE per sec
+    QUOTE_WARMING_MAX_LANES = 200
+    QUOTE_WARMING_LOOKBACK = 7 * 24 * 3600
+    QUOTE_WARMING_INTERVAL = 60
+    QUOTE_WARMING_REFRESH_AHEAD = 90
+    QUOTE_WARMING_MAX_RATE = 10
+
+    # Identical carrier calls (same carrier and shipment data) in flight at the same time share a single call. Calls are
+    # coalesced in-process, and across processes too if a shared store is given: 'file://<dir>' (processes on this
+    # host) or a 'redis://' URL. The lock TTL (secs) must be longer than any carrier call
+    SINGLE_FLIGHT_ENABLED = True
+    SINGLE_FLIGHT_SHARED_STORE_URL = os.getenv('SINGLE_FLIGHT_SHARED_STORE_URL')
+    SINGLE_FLIGHT_LOCK_TTL = 10
+    SINGLE_FLIGHT_POLL_INTERVAL = 0.01
+
+    # Carriers' own limits (see their `rate_limit`, `rate_limit_burst` and `daily_quota`) are enforced before calling
+    # them: calls over the limit get an HTTP 429 quote right away. Past the soft limit (ratio) of their daily quota,
+    # calls are paced so it lasts all day. Rate limits and quota usage are tracked in-process unless a shared store is
+    # given (same URLs as the quote cache), which all processes should use to share the limits
+    CARRIER_RATE_LIMITING_ENABLED = True
+    CARRIER_QUOTA_SHARED_STORE_URL = os.getenv('CARRIER_QUOTA_SHARED_STORE_URL')
+    CARRIER_QUOTA_SOFT_LIMIT = 0.8
+
+    # Shipping costs requests are handled up to MAX_CONCURRENCY at a time per process, with up to MAX_QUEUE more waiting
+    # for up to QUEUE_TIMEOUT (secs). Any other request gets an HTTP 503, with a Retry-After (secs). In ASGI mode,
+    # native requests are handled up to ASGI_MAX_CONCURRENCY at a time instead (never queued): they don't tie up threads
+    ADMISSION_CONTROL_ENABLED = True
+    ADMISSION_MAX_CONCURRENCY = 64
+    ADMISSION_ASGI_MAX_CONCURRENCY = 1024
+    ADMISSION_MAX_QUEUE = 128
+    ADMISSION_QUEUE_TIMEOUT = 1
+    ADMISSION_RETRY_AFTER = 1
+
+    # Carriers failing (or too slow) too often over a rolling window (secs) are not called for a while: their quotes
+    # fail fast instead. Circuits are tracked in-process unless a shared store is given (same URLs as the quote cache)
+    CIRCUIT_BREAKER_ENABLED = True
+    CIRCUIT_BREAKER_SHARED_STORE_URL = os.getenv('CIRCUIT_BREAKER_SHARED_STORE_URL')
+    CIRCUIT_BREAKER_WINDOW = 60
+    CIRCUIT_BREAKER_MIN_REQUESTS = 20
+    CIRCUIT_BREAKER_ERROR_RATE = 0.5
+    CIRCUIT_BREAKER_SLOW_CALL_DURATION = 3
+    CIRCUIT_BREAKER_SLOW_CALL_RATE = 0.8
+    CIRCUIT_BREAKER_OPEN_DURATION = 30
+    CIRCUIT_BREAKER_HALF_OPEN_PROBES = 3
+
+    # Carriers slower than their usual latency percentile get a duplicate (hedged) request, and failed quotes are
+    # retried after a jittered backoff (secs). Both are capped by a retry budget: a ratio of the regular requests
+    HEDGING_ENABLED = True
+    HEDGING_MAX_WORKERS = 64
+    HEDGING_PERCENTILE = 0.95
+    HEDGING_SAMPLE_SIZE = 200
+    HEDGING_MIN_SAMPLES = 20
+    QUOTE_MAX_RETRIES = 1
+    QUOTE_RETRY_BACKOFF = 0.1
+    RETRY_BUDGET_RATIO = 0.1
+    RETRY_BUDGET_MAX_TOKENS = 10
+
+    # Outbound HTTP calls (e.g. carriers' APIs) share keep-alive connections: up to POOL_MAXSIZE per host, for up to
+    # POOL_CONNECTIONS hosts. Timeouts are in secs, and HTTP/2 requires the optional httpx[http2] library
+    OUTBOUND_HTTP_POOL_CONNECTIONS = 10
+    OUTBOUND_HTTP_POOL_MAXSIZE = 32
+    OUTBOUND_HTTP_POOL_BLOCK = False
+    OUTBOUND_HTTP_CONNECT_TIMEOUT = 2
+    OUTBOUND_HTTP_READ_TIMEOUT = 4
+    OUTBOUND_HTTP2 = False
+
+    # All requests' (and carrier calls') latencies are tracked as Prometheus-style metrics (on /metrics, buckets in
+    # secs), while only a sample of them (ratio) is traced by stage and carrier and gets a Server-Timing header
+    INSTRUMENTATION_ENABLED = True
+    INSTRUMENTATION_SAMPLE_RATE = 0.01
+    INSTRUMENTATION_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    # Admin-only endpoints (with an `Authorization: Bearer <ADMIN_TOKEN>` header) to profile live workers: POST
+    # /admin/profiles?seconds=N samples the stacks of the worker serving it every SAMPLE_INTERVAL (secs), saving them
+    # in PROFILING_DIR as collapsed stacks (flamegraph.pl's input). /admin/slow_requests lists the latest requests to
+    # SLOW_REQUEST_ROUTES slower than the threshold (secs) served by the worker, with their stages and payload (bytes)
+    PROFILING_ENABLED = True
+    ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+    PROFILING_SAMPLE_INTERVAL = 0.01
+    PROFILING_MAX_SECONDS = 60
+    PROFILING_DIR = os.getenv('PROFILING_DIR', os.path.join(tempfile.gettempdir(), 'shiphero-profiles'))
+    PROFILING_MAX_PROFILES = 20
+    SLOW_REQUEST_ROUTES = ('/api/shipping/costs', '/api/accounts/<string:account_id>/shipping/costs')
+    SLOW_REQUEST_THRESHOLD = 2
+    SLOW_REQUEST_LOG_SIZE = 100
+    SLOW_REQUEST_MAX_PAYLOAD_SIZE = 64 * 1024
+
+    # Quotes can be computed from carriers' rate tables (see `python manage.py import_rate_card`) instead of calling
+    # carriers, depending on the quote mode (see QuoteMode). Tables older than MAX_AGE (secs) are stale, and missing or
+    # stale ones are checked for a newer file at most once per CHECK_INTERVAL (secs)
+    QUOTE_MODE = os.getenv('QUOTE_MODE', QuoteMode.LIVE.value)
+    RATE_TABLES_DIR = os.getenv(
+        'RATE_TABLES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rate_tables')
+    )
+    RATE_TABLES_MAX_AGE = 7 * 24 * 3600
+    RATE_TABLES_CHECK_INTERVAL = 10
+
+    # All quotes served are kept in the DB (see QuoteRecord), written in the background in batches of up to BATCH_SIZE,
+    # at least every FLUSH_INTERVAL (secs). Up to MAX_PENDING quotes are kept in memory while the DB can't keep up
+    QUOTE_HISTORY_ENABLED = True
+    QUOTE_HISTORY_BATCH_SIZE = 500
+    QUOTE_HISTORY_FLUSH_INTERVAL = 1
+    QUOTE_HISTORY_MAX_PENDING = 50000
+
+    # JSON responses are encoded with the given backend: 'stdlib', 'orjson' or 'ujson' (both optional libraries), or
+    # 'auto' to use the fastest one installed
+    JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+
+    # Carriers are quoted for all their shipment methods, the default one being their main cost. Fastest methods first
+    DEFAULT_SHIPMENT_METHOD = 'regular'
+    SHIPMENT_METHODS_BY_SPEED = ('express', 'regular', 'cheap')
+
+    # Mocked carriers (see CARRIERS_DATA) can be simulated in-process instead of hitting fakeJSON, deterministically for
+    # a given seed: profiles by carrier code (or the default one) set their latency, errors, quota and slow-drip (see
+    # CarrierProfile). `python manage.py simulate_carriers` serves the same simulation over HTTP
+    CARRIER_SIMULATOR_ENABLED = os.getenv('CARRIER_SIMULATOR_ENABLED') == 'true'
+    CARRIER_SIMULATOR_SEED = int(os.getenv('CARRIER_SIMULATOR_SEED', '0'))
+    CARRIER_SIMULATOR_PROFILES = {}
+    CARRIER_SIMULATOR_DEFAULT_PROFILE = {'latency': 'lognormal:-3,0.5', 'error_rate': 0.1}
 
     FAKEJSON_API_ENDPOINT = 'https://app.fakejson.com/q'
     FAKEJSON_API_TOKEN = '<EDITED>'
@@ -55,6 +235,7 @@ class DevelopmentConfig(BaseConfig):
     Development-only configurations.
     """
     ENV = Env.DEVELOPMENT
+    DB_SEED_ON_BOOT = True
 
 
 class TestingConfig(BaseConfig):
@@ -63,6 +244,10 @@ class TestingConfig(BaseConfig):
     """
     ENV = Env.TESTING
     SQLALCHEMY_DATABASE_URI = 'postgresql://localhost/shiphero_test'
+    QUOTE_HISTORY_ENABLED = False  # Tables are dropped after each test case, while quotes may still be written
+    # Repeatable and offline: carriers are simulated, always answering (quickly) unless a test case says otherwise
+    CARRIER_SIMULATOR_ENABLED = True
+    CARRIER_SIMULATOR_DEFAULT_PROFILE = {'latency': 'constant:0.01'}
 
 
 class ProductionConfig(BaseConfig):
@@ -94,15 +279,28 @@ def configure_app(app, target_env):
     config_obj = _CONFIG_ENV_MAPPING[target_env]
     app.config.from_object(config_obj)
 
+    try:
+        app.config['SERVER_MODE'] = ServerMode(app.config['SERVER_MODE'])
+    except ValueError:
+        app.config['SERVER_MODE'] = ServerMode.WSGI
+    try:
+        app.config['QUOTE_MODE'] = QuoteMode(app.config['QUOTE_MODE'])
+    except ValueError:
+        app.config['QUOTE_MODE'] = QuoteMode.LIVE
+
 
 def configure_db(app, db):
     """
     Links together the given Flask app and the SQLAlchemy instance.
-    It also loads some initial data.
+    The DB is only connected to on first use, unless initial data is to be loaded on boot.
     """
+    app.config.setdefault(
+        'SQLALCHEMY_ENGINE_OPTIONS', build_engine_options(app.config, app.config['SQLALCHEMY_DATABASE_URI'])
+    )
     db.init_app(app)
-    with app.app_context():
-        load_initial_db_data(app, db)
+    if app.config['DB_SEED_ON_BOOT']:
+        with app.app_context():
+            load_initial_db_data(app, db)
 
 
 def load_initial_db_data(app, db):
@@ -115,6 +313,7 @@ def load_initial_db_data(app, db):
             for carrier_data in CARRIERS_DATA:
                 carrier = Carrier(**carrier_data)
                 db.session.add(carrier)
+            CarrierListVersion.bump()
             db.session.commit()
     except ProgrammingError:
         pass  # DB is empty, no tables yet
@@ -0,0 +1,22 @@
+# coding=utf-8
+
+
+import os
+
+# The app is loaded once in the master process, so workers are forked ready to serve (sharing its memory
+# copy-on-write) instead of each one booting it on its own
+preload_app = True
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+
+
+def post_fork(server, worker):
+    """
+    Makes sure workers don't share any DB connection opened by the master process (the app doesn't open any on boot,
+    unless it's set to load initial data).
+    """
+    from app.models import db
+    from run import app
+
+    flask_app = getattr(app, 'flask_app', app)  # ASGI mode wraps the Flask app
+    with flask_app.app_context():
+        db.get_engine(flask_app).dispose()
@@ -1,12 +1,17 @@
 # coding=utf-8
 
 
+import json
 import os
+from datetime import datetime, timedelta
 
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import create_app, db, models
+from app.api import ShippingCostsEndpoint
+from app.registry import get_carrier_registry
+from config import load_initial_db_data
 
 app = create_app(os.getenv('FLASK_ENV'))
 
@@ -14,5 +19,105 @@ migrate = Migrate(app, db)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def seed():
+    """
+    Loads all required initial data to the DB (e.g. carriers), unless it's already there.
+    """
+    load_initial_db_data(app, db)
+
+
+@manager.command
+def import_rate_card(path):
+    """
+    Imports a carrier's rate card (a JSON file, see RateTable) as its rate table, replacing the previous one.
+    """
+    # Optional subsystems are only imported by the commands using them, so any other command doesn't load them
+    from app.rate_tables import RateTable, build_rate_tables
+
+    with open(path) as rate_card_file:
+        rate_card = json.load(rate_card_file)
+    carrier = get_carrier_registry().get_by_code(rate_card.get('carrier'))
+    if carrier is None:
+        print('Unknown carrier: {}'.format(rate_card.get('carrier')))
+        return
+    try:
+        rate_table = RateTable.from_rate_card(rate_card, carrier)
+    except (KeyError, ValueError) as e:
+        print('Invalid rate card: {}'.format(e))
+        return
+    build_rate_tables(app.config).save(rate_table)  # Whatever the quote mode, to be used once it's table-first
+    print('Rate table of {} imported: {} rates'.format(carrier.name, len(rate_card['rates'])))
+
+
+@manager.command
+def create_quote_partitions(days_ahead=7):
+    """
+    Creates the daily partitions of the quotes history from tomorrow up to the given days ahead (meant to be run on
+    every release and daily, e.g. from a scheduler).
+    """
+    from app.quote_history import create_daily_partitions
+
+    partition_names, skipped_days = create_daily_partitions(db.engine, int(days_ahead))
+    print('Quote partitions ready: {}'.format(', '.join(partition_names)))
+    if skipped_days:
+        print('Days already in the default partition (not partitioned): {}'.format(
+            ', '.join(day.isoformat() for day in skipped_days)
+        ))
+
+
+@manager.command
+def quote_latency_report(hours=24, percentile=0.95):
+    """
+    Prints the latency percentile (and quotes and errors) of each carrier per hour, over the given last hours.
+    """
+    since = datetime.utcnow() - timedelta(hours=int(hours))
+    print('{:<16} {:<20} {:>12} {:>8} {:>8}'.format('carrier', 'hour', 'latency (ms)', 'quotes', 'errors'))
+    for carrier_code, hour, latency, quotes_count, errors_count in models.QuoteRecord.get_latency_percentiles(
+        since, percentile=float(percentile)
+    ):
+        print('{:<16} {:<20} {:>12.1f} {:>8} {:>8}'.format(
+            carrier_code, hour.strftime('%Y-%m-%d %H:00'), latency, quotes_count, errors_count
+        ))
+
+
+@manager.command
+def warm_quotes(rounds=None):
+    """
+    Runs the warming worker, that keeps the quotes of the most quoted shipments cached (forever, by default).
+    """
+    from app.quote_warming import QuoteWarmer
+
+    if not app.config['QUOTE_CACHE_ENABLED'] or not app.config['QUOTE_CACHE_SHARED_STORE_URL']:
+        print('Quotes can only be warmed for other processes in a shared quote cache (QUOTE_CACHE_SHARED_STORE_URL)')
+        return
+    quote_warmer = QuoteWarmer(
+        app,
+        ShippingCostsEndpoint(),
+        max_lanes=app.config['QUOTE_WARMING_MAX_LANES'],
+        lookback=app.config['QUOTE_WARMING_LOOKBACK'],
+        refresh_ahead=app.config['QUOTE_WARMING_REFRESH_AHEAD'],
+        max_rate=app.config['QUOTE_WARMING_MAX_RATE'],
+    )
+    rounds = int(rounds) if rounds is not None else None
+    for lanes_count, results in quote_warmer.run(app.config['QUOTE_WARMING_INTERVAL'], rounds):
+        print('{} lanes: {} quotes refreshed, {} still fresh, {} skipped'.format(
+            lanes_count, results['refreshed'], results['fresh'], results['skipped']
+        ))
+
+
+@manager.command
+def simulate_carriers(host='127.0.0.1', port=8002):
+    """
+    Serves the carrier simulator (set up by the CARRIER_SIMULATOR_* settings) as carriers' APIs, at `/<carrier code>/`.
+    """
+    from app.simulator import CarrierSimulatorServer, build_carrier_simulator
+
+    server = CarrierSimulatorServer(build_carrier_simulator(app.config), host, int(port))
+    print('Carrier simulator running at {} (seed {})'.format(server.url, app.config['CARRIER_SIMULATOR_SEED']))
+    server.serve_forever()
+
+
 if __name__ == '__main__':
     manager.run()
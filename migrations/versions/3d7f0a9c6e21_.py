@@ -0,0 +1,28 @@
+"""Adds rate limits and daily quotas to carriers
+
+Revision ID: 3d7f0a9c6e21
+Revises: 8c1e5b7d2a34
+Create Date: 2026-10-18 16:05:12.730441
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d7f0a9c6e21'
+down_revision = '8c1e5b7d2a34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('carriers', sa.Column('rate_limit', sa.Float(), nullable=True))
+    op.add_column('carriers', sa.Column('rate_limit_burst', sa.Integer(), nullable=True))
+    op.add_column('carriers', sa.Column('daily_quota', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('carriers', 'daily_quota')
+    op.drop_column('carriers', 'rate_limit_burst')
+    op.drop_column('carriers', 'rate_limit')
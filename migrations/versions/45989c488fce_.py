@@ -0,0 +1,29 @@
+"""Adds carrier_list_versions to invalidate carrier caches
+
+Revision ID: 45989c488fce
+Revises: 2f94dec12b7a
+Create Date: 2026-10-18 10:12:41.207154
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '45989c488fce'
+down_revision = '2f94dec12b7a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    carrier_list_versions = op.create_table('carrier_list_versions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(carrier_list_versions, [{'id': 1, 'version': 1}])
+
+
+def downgrade():
+    op.drop_table('carrier_list_versions')
@@ -0,0 +1,41 @@
+"""Adds quotes (the history of all quotes served), partitioned by day
+
+Revision ID: 6a2e4c8b1f57
+Revises: 3d7f0a9c6e21
+Create Date: 2026-10-18 17:42:08.915237
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '6a2e4c8b1f57'
+down_revision = '3d7f0a9c6e21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Declarative partitioning is not supported by Alembic's operations. Daily partitions are created ahead of time by
+    # `python manage.py create_quote_partitions`, and any quote with no partition for its day lands in the default one
+    op.execute("""
+        CREATE TABLE quotes (
+            id BIGSERIAL NOT NULL,
+            created TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            account_id VARCHAR(64),
+            carrier_code VARCHAR(255) NOT NULL,
+            shipment JSON,
+            cost INTEGER NOT NULL,
+            costs JSON,
+            error VARCHAR(255) NOT NULL DEFAULT '',
+            latency_ms DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (id, created)
+        ) PARTITION BY RANGE (created)
+    """)
+    op.execute('CREATE TABLE quotes_default PARTITION OF quotes DEFAULT')
+    op.create_index('ix_quotes_carrier_code_created', 'quotes', ['carrier_code', 'created'], unique=False)
+    op.create_index('ix_quotes_account_id_created', 'quotes', ['account_id', 'created'], unique=False)
+
+
+def downgrade():
+    op.execute('DROP TABLE quotes')  # Along with all its partitions and indexes
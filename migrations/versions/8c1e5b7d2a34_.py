@@ -0,0 +1,26 @@
+"""Adds accounts to carriers, so each merchant account can have its own carrier list
+
+Revision ID: 8c1e5b7d2a34
+Revises: 45989c488fce
+Create Date: 2026-10-18 14:20:37.518304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1e5b7d2a34'
+down_revision = '45989c488fce'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('carriers', sa.Column('account_id', sa.String(length=64), nullable=True))
+    op.create_index('ix_carriers_account_id_enabled', 'carriers', ['account_id', 'enabled'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_carriers_account_id_enabled', table_name='carriers')
+    op.drop_column('carriers', 'account_id')
@@ -3,9 +3,10 @@
 
 import os
 
-from app import create_app
+from app import create_server_app
 
-app = create_app(os.getenv('FLASK_ENV'))
+# Either a WSGI or an ASGI app, depending on the SERVER_MODE env var (see config.ServerMode)
+app = create_server_app(os.getenv('FLASK_ENV'))
 
 if __name__ == '__main__':
     app.run()
@@ -1,15 +1,44 @@
 # coding=utf-8
 
 
+import asyncio
 import json
 import os
-import random
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from sqlalchemy import event
 
 from app import create_app
-from app.enums import BoxType, Priority
-from app.models import db
-from config import Env, load_initial_db_data
+from app.adapters import (
+    HTTPCarrierAdapter, MockCarrierAdapter, Shipment, SimulatorCarrierAdapter, get_carrier_adapter,
+)
+from app.admission import AdmissionController
+from app.api import ShippingCostsEndpoint
+from app.asgi import ShippingASGIApp
+from app.db_routing import ReadReplicas, build_engine_options
+from app.circuit_breaker import CircuitBreaker, LocalCircuitStateStore, SharedCircuitStateStore
+from app.enums import BoxType, CircuitState, Priority
+from app.fanout import CarrierFanout
+from app.hedging import LatencyTracker, QuoteHedger, RetryBudget
+from app.http_client import OutboundHTTPClient, OutboundRequestError
+from app.instrumentation import Metrics, Trace, span
+from app.models import Carrier, CarrierListVersion, QuoteRecord, db
+from app.quote_cache import InProcessCacheBackend, QuoteCache, SharedCacheBackend
+from app.quote_history import QuoteHistory, configure_quote_history
+from app.quote_warming import QuoteRevalidator, QuoteWarmer
+from app.rate_limiting import CarrierRateLimiter, QuotaTracker, SharedTokenBuckets
+from app.rate_tables import RateTable, RateTables, configure_rate_tables, find_zip_code
+from app.registry import get_carrier_registry
+from app.serialization import CARRIER_SERIALIZER, build_json_backend
+from app.shared_store import FileSharedStore, LocalSharedStore
+from app.simulator import CarrierProfile, CarrierSimulator, CarrierSimulatorServer
+from app.singleflight import SingleFlight
+from config import Env, QuoteMode, load_initial_db_data
 
 
 class _CommonLogicTestCase(unittest.TestCase):
@@ -56,6 +85,53 @@ class CarriersEndpointTestCase(_CommonLogicTestCase):
         for expected_attr in ('code', 'name', 'shipment_methods', 'enabled'):
             self.assertIn(expected_attr, response_json[0])
 
+    def test_etag(self):
+        response = self.client.get(self.carrier_endpoint)
+        etag = response.headers['ETag']
+        self.assertEqual(self.client.get(self.carrier_endpoint, headers={'If-None-Match': etag}).status_code, 304)
+        with self.app.app_context():
+            carrier = Carrier.query.filter_by(name='UPS').one()
+            carrier.enabled = False
+            carrier.save()
+        # Carriers changed, so does the response
+        response = self.client.get(self.carrier_endpoint, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertFalse({carrier['code']: carrier for carrier in response.get_json()}['ups']['enabled'])
+
+    def test_json_backends(self):
+        with self.app.app_context():
+            carriers = get_carrier_registry().get_all()
+        self.assertEqual(CARRIER_SERIALIZER.serialize(carriers[0]), {
+            'code': 'fedex',
+            'name': 'Fedex',
+            'shipment_methods': {'cheap': 'fdxchp', 'regular': 'fdxreg', 'express': 'fdxexp'},
+            'enabled': True,
+        })
+        for backend_name in ('auto', 'stdlib'):
+            json_backend = build_json_backend(backend_name)
+            self.assertEqual(json.loads(json_backend.dumps({'cost': [1, None]}).decode()), {'cost': [1, None]})
+        self.assertRaises(ValueError, build_json_backend, 'simplejson')
+
+    def test_health(self):
+        response = self.client.get(self.carrier_endpoint + '/health')
+        response_json = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response_json), 2)  # We have 2 carriers in DB
+        self.assertEqual(response_json[0]['state'], CircuitState.CLOSED.value)
+
+        # Open circuits fail fast, with the usual error
+        circuit_breaker = self.app.extensions['circuit_breakers'].get('fedex')
+        for _ in range(self.app.config['CIRCUIT_BREAKER_MIN_REQUESTS']):
+            circuit_breaker.record(False, 0.1)
+        response = self.client.post('/api/shipping/costs', json={
+            'address': '123 Fake St, Springfield', 'weight': 33, 'priority': 1, 'box_type': 'medium', 'test_mode': True,
+        })
+        response_by_carrier = {quote['carrier']: quote for quote in response.get_json()}
+        self.assertTrue(response_by_carrier['fedex']['error'].startswith('Blame Fedex!'))
+        response_json = self.client.get(self.carrier_endpoint + '/health').get_json()
+        self.assertIn(CircuitState.OPEN.value, [carrier_health['state'] for carrier_health in response_json])
+
 
 class ShippingCostsEndpointTestCase(_CommonLogicTestCase):
     """
@@ -122,6 +198,1511 @@ class ShippingCostsEndpointTestCase(_CommonLogicTestCase):
         (self.assertIn(x, response_with_error_2.get_json()) for x in ('weight'))
         (self.assertIn(x, response_with_error_1.get_json()) for x in ('priority'))
 
+    def test_costs_by_shipment_method(self):
+        request_data = {
+            'address': '123 Fake St, Springfield',
+            'weight': 33,
+            'priority': Priority.ONE.value,
+            'box_type': BoxType.MEDIUM.value,
+            'test_mode': True,
+        }
+        response_json = self.client.post(self.shipping_cost_endpoint, json=request_data).get_json()
+        for carrier_response in response_json:
+            self.assertEqual(set(carrier_response['costs']), {'cheap', 'express', 'regular'})
+            self.assertEqual(carrier_response['cost'], carrier_response['costs']['regular'])
+
+        cheapest_json = self.client.post(
+            self.shipping_cost_endpoint, json=dict(request_data, select='cheapest')
+        ).get_json()
+        self.assertEqual(len(cheapest_json), 1)
+        self.assertEqual(cheapest_json[0]['cost'], min(
+            cost for carrier_response in response_json for cost in carrier_response['costs'].values()
+        ))
+        fastest_json = self.client.post(
+            self.shipping_cost_endpoint, json=dict(request_data, select='fastest')
+        ).get_json()
+        self.assertEqual(list(fastest_json[0]['costs']), ['express'])
+        self.assertEqual(
+            self.client.post(self.shipping_cost_endpoint, json=dict(request_data, select='slowest')).status_code, 400
+        )
+
+    def test_select_carrier_responses(self):
+        carrier_responses = [
+            {'carrier': 'fedex', 'error': '', 'cost': 20, 'costs': {'cheap': 10, 'regular': 20, 'express': 40}},
+            {'carrier': 'ups', 'error': '', 'cost': 15, 'costs': {'cheap': 12, 'regular': 15, 'express': 30}},
+            {'carrier': 'dhl', 'error': 'Blame DHL!', 'cost': -1, 'costs': {'cheap': -1, 'express': -1}},
+        ]
+        with self.app.app_context():
+            endpoint = ShippingCostsEndpoint()
+            self.assertIs(endpoint._select_carrier_responses(carrier_responses, None), carrier_responses)
+            self.assertEqual(
+                endpoint._select_carrier_responses(carrier_responses, 'cheapest'),
+                [{'carrier': 'fedex', 'error': '', 'cost': 10, 'costs': {'cheap': 10}}],
+            )
+            self.assertEqual(
+                endpoint._select_carrier_responses(carrier_responses, 'fastest'),
+                [{'carrier': 'ups', 'error': '', 'cost': 30, 'costs': {'express': 30}}],
+            )
+            self.assertEqual(endpoint._select_carrier_responses(carrier_responses[2:], 'cheapest'), [])
+
+    def test_streaming(self):
+        request_data = {
+            'address': '123 Fake St, Springfield',
+            'weight': 33,
+            'priority': Priority.ONE.value,
+            'box_type': BoxType.MEDIUM.value,
+            'select': 'cheapest',
+            'test_mode': True,
+        }
+        response = self.client.post(
+            self.shipping_cost_endpoint, json=request_data, headers={'Accept': 'application/x-ndjson'}
+        )
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual({record['carrier'] for record in records[:-1]}, {'fedex', 'ups'})  # In no particular order
+        summary = records[-1]['summary']
+        self.assertEqual((summary['carriers'], summary['errors']), (2, 0))
+        self.assertEqual(summary['selected'][0]['cost'], min(
+            cost for record in records[:-1] for cost in record['costs'].values()
+        ))
+
+        response = self.client.post(
+            self.shipping_cost_endpoint, json=request_data, headers={'Accept': 'text/event-stream'}
+        )
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = response.get_data(as_text=True).split('\n\n')
+        self.assertEqual([event.split('\n')[0] for event in events if event], ['event: quote'] * 2 + ['event: summary'])
+        self.assertIn('"selected"', events[2])
+
+        # Streaming is only used when explicitly asked for
+        for accept_header in ('*/*', 'application/json, text/event-stream;q=0.5'):
+            response = self.client.post(
+                self.shipping_cost_endpoint, json=request_data, headers={'Accept': accept_header}
+            )
+            self.assertEqual(response.mimetype, 'application/json')
+
+    def test_cached_quotes(self):
+        request_data = {
+            'address': '123 Fake St, Springfield',
+            'weight': 33,
+            'priority': Priority.ONE.value,
+            'box_type': BoxType.MEDIUM.value,
+            'test_mode': True,
+        }
+        quote_cache = self.app.extensions['quote_cache']
+        response_json = self.client.post(self.shipping_cost_endpoint, json=request_data).get_json()
+        self.assertEqual(quote_cache.stats()['hits'], 0)
+        self.assertEqual(self.client.post(self.shipping_cost_endpoint, json=request_data).get_json(), response_json)
+        self.assertEqual(quote_cache.stats()['hits'], len(response_json))
+
+    def test_request_parser_does_not_grow(self):
+        request_data = {
+            'address': '123 Fake St, Springfield',
+            'weight': 33,
+            'priority': Priority.ONE.value,
+            'box_type': BoxType.MEDIUM.value,
+            'test_mode': True,
+        }
+
+        def _time_parsing():
+            with self.app.test_request_context(self.shipping_cost_endpoint, method='POST', json=request_data):
+                started = time.perf_counter()
+                for _ in range(200):
+                    ShippingCostsEndpoint.request_parser.parse_args()
+                return time.perf_counter() - started
+
+        initial_args_count = len(ShippingCostsEndpoint.request_parser.args)
+        initial_parsing_time = min(_time_parsing() for _ in range(3))
+        for _ in range(100000):  # Flask-RESTful creates one resource instance per request
+            ShippingCostsEndpoint()
+        self.assertEqual(len(ShippingCostsEndpoint.request_parser.args), initial_args_count)
+        # Generous margin to avoid flakiness, a growing parser would be orders of magnitude slower
+        self.assertLess(min(_time_parsing() for _ in range(3)), initial_parsing_time * 3)
+
+
+class BatchShippingCostsEndpointTestCase(_CommonLogicTestCase):
+    """
+    Test cases for the batch shipping cost API endpoint.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.batch_endpoint = '/api/shipping/costs/batch'
+        self.shipment = {
+            'address': '123 Fake St, Springfield',
+            'weight': 33,
+            'priority': Priority.ONE.value,
+            'box_type': BoxType.MEDIUM.value,
+            'test_mode': True,
+        }
+
+    def test_json_array(self):
+        shipments = [self.shipment, dict(self.shipment, weight='ASD'), dict(self.shipment, weight=10), self.shipment]
+        response = self.client.post(self.batch_endpoint, json=shipments)
+        response_json = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([record['index'] for record in response_json], [0, 1, 2, 3])
+        self.assertIn('weight', response_json[1]['message'])
+        for record in (response_json[0], response_json[2], response_json[3]):
+            self.assertEqual(len(record['quotes']), 2)  # We have 2 carriers in DB
+            for expected_attr in ('carrier', 'error', 'cost'):
+                self.assertIn(expected_attr, record['quotes'][0])
+        self.assertEqual(response_json[0]['quotes'], response_json[3]['quotes'])  # Deduplicated
+        # Only 2 distinct valid shipments were quoted
+        self.assertEqual(self.app.extensions['quote_cache'].stats()['misses'], 4)
+
+    def test_ndjson(self):
+        body = '\n'.join([json.dumps(self.shipment), 'not JSON', json.dumps(dict(self.shipment, priority=7))])
+        response = self.client.post(self.batch_endpoint, data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(records), 3)
+        self.assertEqual(len(records[0]['quotes']), 2)
+        self.assertIn('message', records[1])
+        self.assertIn('priority', records[2]['message'])
+
+    def test_bad_input(self):
+        self.assertEqual(self.client.post(self.batch_endpoint, json=self.shipment).status_code, 400)
+        self.app.config['SHIPPING_COSTS_BATCH_MAX_SHIPMENTS'] = 1
+        self.assertEqual(self.client.post(self.batch_endpoint, json=[self.shipment] * 2).status_code, 413)
+
+
+class InstrumentationTestCase(_CommonLogicTestCase):
+    """
+    Test cases for the requests' instrumentation (tracing and metrics).
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.request_data = {
+            'address': '123 Fake St, Springfield',
+            'weight': 33,
+            'priority': Priority.ONE.value,
+            'box_type': BoxType.MEDIUM.value,
+            'test_mode': True,
+        }
+
+    def test_server_timing(self):
+        instrumentation = self.app.extensions['instrumentation']
+        instrumentation.sample_rate = 0
+        self.assertNotIn('Server-Timing', self.client.post(self.shipping_cost_endpoint, json=self.request_data).headers)
+        instrumentation.sample_rate = 1
+        self.request_data['weight'] += 1  # Not cached, so carriers are actually called
+        server_timing = self.client.post(self.shipping_cost_endpoint, json=self.request_data).headers['Server-Timing']
+        span_names = [span_timing.split(';')[0] for span_timing in server_timing.split(', ')]
+        self.assertEqual(span_names[:3], ['parse', 'verify', 'carriers'])
+        self.assertIn('carrier.fedex', span_names)
+        self.assertEqual(span_names[-1], 'total')
+
+    def test_metrics(self):
+        self.client.get(self.carrier_endpoint)
+        self.client.post(self.shipping_cost_endpoint, json=self.request_data)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        metrics = response.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="GET",route="/api/shipping/carriers",status="200"} 1', metrics)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', metrics)
+        self.assertIn('carrier_request_duration_seconds_count{carrier="fedex"} 1', metrics)
+
+    def test_histograms_and_spans(self):
+        metrics = Metrics(latency_buckets=(0.1, 1))
+        for latency in (0.05, 0.5, 5):
+            metrics.observe('latency', latency, stage='x')
+        self.assertIn('latency_bucket{stage="x",le="0.1"} 1', metrics.render())
+        self.assertIn('latency_bucket{stage="x",le="1"} 2', metrics.render())
+        self.assertIn('latency_bucket{stage="x",le="+Inf"} 3', metrics.render())
+        self.assertIn('latency_count{stage="x"} 3', metrics.render())
+
+        trace = Trace()
+        for _ in range(2):
+            with span('stage', trace):
+                time.sleep(0.01)
+        with span('ignored'):  # No trace at all
+            pass
+        self.assertEqual([name for name, _ in trace.get_spans()], ['stage'])
+        self.assertGreaterEqual(trace.get_spans()[0][1], 0.02)
+
+
+class ShippingASGIAppTestCase(_CommonLogicTestCase):
+    """
+    Test cases for the asyncio-native (ASGI) app.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.asgi_app = ShippingASGIApp(self.app)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def _request(self, method, path, json_data=None):
+        """
+        Sends a request to the ASGI app, returning its status code and its JSON response.
+        """
+        messages = self._send_request(method, path, json_data)
+        response_body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], json.loads(response_body.decode())
+
+    def _send_request(self, method, path, json_data=None, headers=()):
+        """
+        Sends a request to the ASGI app, returning all the messages it sent back.
+        """
+        return self.loop.run_until_complete(self._send_request_async(method, path, json_data, headers))
+
+    async def _send_request_async(self, method, path, json_data=None, headers=()):
+        body = json.dumps(json_data).encode() if json_data is not None else b''
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': b'',
+            'headers': [(b'content-type', b'application/json')] + list(headers),
+        }
+        messages = []
+
+        async def _receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def _send(message):
+            messages.append(message)
+
+        await self.asgi_app(scope, _receive, _send)
+        return messages
+
+    def test_carriers(self):
+        status, response_json = self._request('GET', self.carrier_endpoint)
+        self.assertEqual(status, 200)
+        self.assertEqual(response_json, self.client.get(self.carrier_endpoint).get_json())
+        self.assertEqual(self._request('POST', self.carrier_endpoint)[0], 405)
+        etag = dict(self._send_request('GET', self.carrier_endpoint)[0]['headers'])[b'etag']
+        messages = self._send_request('GET', self.carrier_endpoint, headers=[(b'if-none-match', etag)])
+        self.assertEqual(messages[0]['status'], 304)
+
+    def test_shipping_costs(self):
+        request_data = {
+            'address': '123 Fake St, Springfield',
+            'weight': 33,
+            'priority': Priority.ONE.value,
+            'box_type': BoxType.MEDIUM.value,
+            'test_mode': True,
+        }
+        status, response_json = self._request('POST', self.shipping_cost_endpoint, request_data)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(response_json), 2)  # We have 2 carriers in DB
+        for expected_attr in ('carrier', 'error', 'cost'):
+            self.assertIn(expected_attr, response_json[0])
+        self.assertEqual(response_json[0]['error'], '')
+
+        status, response_json = self._request('POST', self.shipping_cost_endpoint, {})
+        self.assertEqual(status, 400)
+        self.assertEqual(len(response_json['message']), 4)  # 4 missing params
+        self.assertEqual(self._request('GET', self.shipping_cost_endpoint)[0], 405)
+
+    def test_streamed_shipping_costs(self):
+        request_data = {
+            'address': '123 Fake St, Springfield',
+            'weight': 33,
+            'priority': Priority.ONE.value,
+            'box_type': BoxType.MEDIUM.value,
+            'test_mode': True,
+        }
+        messages = self._send_request(
+            'POST', self.shipping_cost_endpoint, request_data, [(b'accept', b'application/x-ndjson')]
+        )
+        self.assertIn((b'content-type', b'application/x-ndjson'), messages[0]['headers'])
+        self.assertEqual(len(messages), 4)  # Response start, 1 message per carrier and the summary
+        self.assertTrue(all(message['more_body'] for message in messages[1:-1]))
+        records = [json.loads(message['body'].decode()) for message in messages[1:]]
+        self.assertEqual({record['carrier'] for record in records[:-1]}, {'fedex', 'ups'})
+        self.assertEqual(records[-1]['summary']['carriers'], 2)
+
+    def test_instrumentation(self):
+        request_data = {
+            'address': '123 Fake St, Springfield',
+            'weight': 33,
+            'priority': Priority.ONE.value,
+            'box_type': BoxType.MEDIUM.value,
+            'test_mode': True,
+        }
+        self.app.extensions['instrumentation'].sample_rate = 1
+        slow_request_log = self.app.extensions['slow_request_log']
+        slow_request_log.threshold = 0
+        messages = self._send_request('POST', self.shipping_cost_endpoint, request_data)
+        server_timing = dict(messages[0]['headers'])[b'server-timing'].decode()
+        for stage in ('parse', 'verify', 'carriers', 'fanout', 'carrier.fedex', 'total'):
+            self.assertIn(stage + ';dur=', server_timing)
+        self.assertEqual(self._request('GET', self.carrier_endpoint)[0], 200)
+
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('http_requests_total{method="POST",route="/api/shipping/costs",status="200"} 1', metrics)
+        self.assertIn('http_requests_total{method="GET",route="/api/shipping/carriers",status="200"} 1', metrics)
+        self.assertIn(
+            'http_request_stage_duration_seconds_count{route="/api/shipping/costs",stage="fanout"} 1', metrics
+        )
+        # Only shipping costs requests are logged when slow
+        slow_requests = slow_request_log.get_entries()
+        self.assertEqual([entry['path'] for entry in slow_requests], [self.shipping_cost_endpoint])
+        self.assertEqual(json.loads(slow_requests[0]['payload']), request_data)
+        self.assertIn('fanout', slow_requests[0]['stages_ms'])
+
+    def test_carrier_timeouts_start_with_calls(self):
+        self.app.config.update(ASGI_MAX_WORKERS=1, CARRIER_TIMEOUT=0.3, QUOTE_CACHE_ENABLED=False)
+        self.app.extensions['quote_cache'] = None
+        self.app.extensions['carrier_simulator'].default_profile = CarrierProfile(latency='constant:0.2')
+        asgi_app = self.asgi_app = ShippingASGIApp(self.app)
+        try:
+            status, response_json = self._request('POST', self.shipping_cost_endpoint, {
+                'address': '123 Fake St, Springfield',
+                'weight': 33,
+                'priority': Priority.ONE.value,
+                'box_type': BoxType.MEDIUM.value,
+                'test_mode': True,
+            })
+        finally:
+            asgi_app._executor.shutdown()
+        # The 2nd carrier waited for the only thread for longer than its timeout, but only its call is timed
+        self.assertEqual(status, 200)
+        self.assertEqual([carrier_response['error'] for carrier_response in response_json], ['', ''])
+
+    def test_admission_control(self):
+        self.app.config.update(QUOTE_CACHE_ENABLED=False)
+        self.app.extensions['quote_cache'] = None
+        self.app.extensions['carrier_simulator'].default_profile = CarrierProfile(latency='constant:0.2')
+        request_data = {
+            'address': '123 Fake St, Springfield', 'weight': 33, 'priority': 1, 'box_type': 'medium', 'test_mode': True,
+        }
+        # Way more requests at the same time than Flask's concurrency limit (64) are admitted, up to the ASGI one
+        self.app.extensions['asgi_admission_controller'].max_concurrency = 100
+
+        async def _send_requests():
+            return await asyncio.gather(*[
+                self._send_request_async('POST', self.shipping_cost_endpoint, request_data) for _ in range(110)
+            ])
+
+        all_messages = self.loop.run_until_complete(_send_requests())
+        statuses = [messages[0]['status'] for messages in all_messages]
+        self.assertEqual((statuses.count(200), statuses.count(503)), (100, 10))
+        self.assertEqual(self.app.extensions['asgi_admission_controller'].stats()['active'], 0)
+
+    def test_other_requests_are_served_by_flask(self):
+        status, response_json = self._request('POST', '/mock/fedex/shippingcosts', {
+            'address': '123 Fake St, Springfield', 'weight': 33, 'priority': 1, 'box_type': 'medium', 'test_mode': True,
+        })
+        self.assertEqual(status, 200)
+        self.assertIn('cost', response_json)
+
+
+class CarrierRegistryTestCase(_CommonLogicTestCase):
+    """
+    Test cases for the in-process carrier registry.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.registry = get_carrier_registry()
+
+    def tearDown(self):
+        self.app_context.pop()
+        super().tearDown()
+
+    def _count_queries(self, func):
+        queries = []
+
+        def listener(*args):
+            queries.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return len(queries)
+
+    def test_hot_path_does_not_query_db(self):
+        self.assertEqual(len(self.registry.get_all_enabled()), 2)
+        self.assertEqual(self._count_queries(self.registry.get_all_enabled), 0)
+        self.assertEqual(self._count_queries(lambda: self.client.get(self.carrier_endpoint)), 0)
+
+    def test_save_and_delete_invalidate(self):
+        self.assertEqual(len(self.registry.get_all()), 2)
+        carrier = Carrier('DHL', 'DHLID', 'DHLTKN', {'cheap': 'dhlchp'}, '/mock/dhl/shippingcosts')
+        carrier.save()
+        self.assertIn('dhl', [c.code for c in self.registry.get_all()])
+        carrier.delete()
+        self.assertNotIn('dhl', [c.code for c in self.registry.get_all()])
+
+    def test_reloads_when_another_process_bumps_version(self):
+        self.assertEqual(len(self.registry.get_all()), 2)
+        # Simulating another process: changes in the DB without touching this process' local bumps
+        Carrier.query.update({Carrier.enabled: False})
+        CarrierListVersion.query.update({CarrierListVersion.version: CarrierListVersion.version + 1})
+        db.session.commit()
+        self.assertEqual(len(self.registry.get_all_enabled()), 2)  # Still within TTL
+        self.registry._expires_at = 0  # TTL expired
+        self.assertEqual(len(self.registry.get_all_enabled()), 0)
+
+    def test_account_carrier_lists(self):
+        for carrier_name, enabled in (('DHL', True), ('UPS', False)):
+            carrier = Carrier(carrier_name, 'ACMEID', 'ACMETKN', {}, '/mock/dhl/shippingcosts', account_id='acme')
+            carrier.enabled = enabled
+            carrier.save()
+        self.assertEqual([c.code for c in self.registry.get_all_enabled()], ['fedex', 'ups'])
+        self.assertEqual([c.code for c in self.registry.get_all_enabled('acme')], ['dhl'])
+        self.assertEqual(self.registry.get_by_code('ups', 'acme').app_id, 'ACMEID')
+        self.assertEqual(self.registry.get_all('unknown'), ())
+        # Once loaded, each account's list is looked up without querying the DB
+        self.assertEqual(self._count_queries(lambda: self.registry.get_all_enabled('acme')), 0)
+        self.assertEqual(self._count_queries(lambda: self.registry.get_all_enabled('unknown')), 0)
+        # Only up to a given number of unknown accounts are kept, so they can't make the registry grow unbounded
+        self.registry.max_unknown_accounts = 1
+        self.assertEqual(self.registry.get_all('other_unknown'), ())
+        self.assertEqual(self._count_queries(lambda: self.registry.get_all_enabled('other_unknown')), 1)
+        self.assertNotIn('other_unknown', self.registry._get_state().carrier_lists)
+        # Unknown accounts are found as soon as they get carriers
+        Carrier('DHL', 'ACMEID', 'ACMETKN', {}, '/mock/dhl/shippingcosts', account_id='unknown').save()
+        self.assertEqual([c.code for c in self.registry.get_all_enabled('unknown')], ['dhl'])
+
+    def test_account_endpoints(self):
+        Carrier('DHL', 'ACMEID', 'ACMETKN', {}, '/mock/dhl/shippingcosts', account_id='acme').save()
+        response = self.client.get('/api/accounts/acme/shipping/carriers')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([carrier['code'] for carrier in response.get_json()], ['dhl'])
+        request_data = {
+            'address': '123 Fake St, Springfield',
+            'weight': 33,
+            'priority': Priority.ONE.value,
+            'box_type': BoxType.MEDIUM.value,
+            'test_mode': True,
+        }
+        response = self.client.post('/api/accounts/acme/shipping/costs', json=request_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([quote['carrier'] for quote in response.get_json()], ['dhl'])
+        self.assertEqual(len(self.client.post(self.shipping_cost_endpoint, json=request_data).get_json()), 2)
+        # Accounts with no carriers are unknown
+        for response in (
+            self.client.get('/api/accounts/unknown/shipping/carriers'),
+            self.client.post('/api/accounts/unknown/shipping/costs', json=request_data),
+            self.client.post('/api/accounts/unknown/shipping/costs/batch', json=[request_data]),
+        ):
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get('/api/accounts/unknown/shipping/carriers').status_code, 404)  # Cached
+        self.assertNotIn(('carriers', 'unknown'), self.app.extensions['prerendered_responses']._responses)
+
+
+class DBRoutingTestCase(_CommonLogicTestCase):
+    """
+    Test cases for the DB connection pools and the routing of reads to replicas.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        # The test DB itself stands in for a replica
+        self.replicas = ReadReplicas([self.app.config['SQLALCHEMY_DATABASE_URI']], {})
+        self.app.extensions['db_replicas'] = self.replicas
+
+    def tearDown(self):
+        self.replicas.engines[0].dispose()
+        self.app_context.pop()
+        super().tearDown()
+
+    def _count_queries(self, engine, func):
+        queries = []
+
+        def listener(*args):
+            queries.append(args[2])
+
+        event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            func()
+        finally:
+            event.remove(engine, 'before_cursor_execute', listener)
+        return len(queries)
+
+    def test_reads_go_to_replicas(self):
+        replica_engine = self.replicas.engines[0]
+        self.assertEqual(self._count_queries(db.engine, Carrier.get_all_enabled), 0)
+        self.assertGreater(self._count_queries(replica_engine, Carrier.get_all_enabled), 0)
+        self.assertGreater(self._count_queries(db.engine, lambda: Carrier.get_all(use_replica=False)), 0)
+
+        # Carriers read from replicas can still be saved, always in the primary DB
+        carrier = Carrier.get_all()[0]
+        carrier.enabled = False
+        self.assertEqual(self._count_queries(replica_engine, carrier.save), 0)
+        self.assertEqual(len(Carrier.get_all_enabled()), 1)
+        # This process' own changes are never read from replicas, which may lag behind
+        self.assertEqual(self._count_queries(replica_engine, get_carrier_registry().get_all), 0)
+
+    def test_registry_reads_after_changes(self):
+        replica_engine = self.replicas.engines[0]
+        registry = get_carrier_registry()
+        registry.ttl = 0
+        registry.get_all()  # First load, from the primary DB
+        registry.get_all()  # Carriers didn't change, replicas are used from now on
+        self.assertEqual(self._count_queries(replica_engine, lambda: registry.get_all('acme')), 2)
+
+        # Once another process changed carriers, they're read from the primary DB (like the version), not from a
+        # replica that could still be behind it
+        CarrierListVersion.query.filter_by(id=CarrierListVersion._ROW_ID).update(
+            {CarrierListVersion.version: CarrierListVersion.version + 1}
+        )
+        db.session.commit()
+        registry.ttl = 60
+        self.assertEqual(self._count_queries(replica_engine, registry.get_all), 1)  # Just the version
+        self.assertEqual(self._count_queries(db.engine, lambda: registry.get_all('acme')), 1)
+        self.assertEqual(registry.version, CarrierListVersion.get_current())
+
+    def test_engine_options(self):
+        postgresql_options = build_engine_options(self.app.config, 'postgresql://localhost/shiphero')
+        self.assertTrue(postgresql_options['pool_pre_ping'])
+        self.assertEqual(postgresql_options['pool_size'], self.app.config['DB_POOL_SIZE'])
+        self.assertIn('statement_timeout', postgresql_options['connect_args']['options'])
+        self.assertEqual(build_engine_options(self.app.config, 'sqlite://'), {'pool_pre_ping': True})
+
+    def test_pool_metrics(self):
+        Carrier.get_all()
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE db_pool_connections gauge', metrics)
+        self.assertIn('db_pool_connections{db="replica_0"', metrics)
+
+
+class RateTablesTestCase(_CommonLogicTestCase):
+    """
+    Test cases for carriers' rate tables.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.carrier = get_carrier_registry().get_by_code('fedex')
+        self.rate_card = {
+            'carrier': 'fedex',
+            'weight_brackets': [10, 50],
+            'default_zone': 2,
+            'zip_prefix_zones': {'9': 1, '100': 3},
+            'rates': [
+                {'method': method, 'zone': zone, 'box_type': box_type, 'priority': priority,
+                 'costs': [factor * (100 * zone + priority), factor * (1000 * zone + priority)]}
+                for method, factor in (('cheap', 1), ('regular', 2), ('express', 3))
+                for zone in (1, 2, 3) for box_type in BoxType.choices() for priority in Priority.choices()
+            ],
+        }
+        self.shipment = {'address': '123 Fake St, New York, NY 10001', 'weight': 33, 'priority': 2, 'box_type': 'big'}
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        self.app_context.pop()
+        super().tearDown()
+
+    def test_quote(self):
+        rate_table = RateTable.from_rate_card(self.rate_card, self.carrier)
+        self.assertEqual(find_zip_code('1 Main St, Beverly Hills, CA 90210-1234'), '90210')
+        self.assertEqual(rate_table.get_zone('1 Main St, Beverly Hills, CA 90210'), 1)
+        self.assertEqual(rate_table.get_zone('123 Fake St, Springfield'), 2)  # No ZIP code
+        self.assertEqual(rate_table.quote(self.shipment), {'cheap': 3002, 'regular': 6004, 'express': 9006})
+        self.assertEqual(
+            rate_table.quote(dict(self.shipment, weight=10)), {'cheap': 302, 'regular': 604, 'express': 906}
+        )
+        self.assertIsNone(rate_table.quote(dict(self.shipment, weight=51)))  # No weight bracket for it
+        shipments = [self.shipment, dict(self.shipment, weight=51), dict(self.shipment, address='Springfield')]
+        self.assertEqual(
+            [costs and costs['cheap'] for costs in rate_table.quote_many(shipments)], [3002, None, 2002]
+        )
+        self.assertEqual(rate_table.quote_many(shipments[:1]), [rate_table.quote(self.shipment)])
+        self.assertEqual(rate_table.quote_many([]), [])
+
+        regular_rates = [rate for rate in self.rate_card['rates'] if rate['method'] == 'regular']
+        rate_table = RateTable.from_rate_card(dict(self.rate_card, rates=regular_rates), self.carrier)
+        self.assertIsNone(rate_table.quote(self.shipment))  # No rates for some methods
+
+        with self.assertRaises(ValueError):
+            RateTable.from_rate_card(dict(self.rate_card, rates=[dict(self.rate_card['rates'][0], method='x')]),
+                                     self.carrier)
+
+    def test_save_and_load(self):
+        rate_tables = RateTables(self.temp_dir.name, max_age=60)
+        self.assertIsNone(rate_tables.get('fedex'))
+        rate_tables.save(RateTable.from_rate_card(self.rate_card, self.carrier))
+        costs = {'cheap': 3002, 'regular': 6004, 'express': 9006}
+        self.assertEqual(rate_tables.get('fedex').quote(self.shipment), costs)
+        self.assertEqual(rate_tables.quote_many(self.carrier, [self.shipment]), [costs])
+
+        rate_tables.max_age = 0  # Now stale
+        self.assertIsNone(rate_tables.get('fedex'))
+        self.assertIsNone(rate_tables.quote_many(self.carrier, [self.shipment]))
+
+        # Missing (or stale) tables' files are only checked once in a while, e.g. for tables imported by other processes
+        rate_tables = RateTables(os.path.join(self.temp_dir.name, 'other'), max_age=60)
+        self.assertIsNone(rate_tables.get('fedex'))
+        RateTables(rate_tables.directory, max_age=60).save(RateTable.from_rate_card(self.rate_card, self.carrier))
+        self.assertIsNone(rate_tables.get('fedex'))
+        rate_tables.check_interval = 0
+        self.assertEqual(rate_tables.get('fedex').quote(self.shipment), costs)
+
+    def test_table_first_quotes(self):
+        self.assertIsNone(self.app.extensions['rate_tables'])  # Only set up in table-first mode
+        self.app.config.update(QUOTE_MODE=QuoteMode.TABLE_FIRST, RATE_TABLES_DIR=self.temp_dir.name)
+        configure_rate_tables(self.app)
+        self.app.extensions['rate_tables'].save(RateTable.from_rate_card(self.rate_card, self.carrier))
+        request_data = dict(self.shipment, test_mode=True)
+        response_json = self.client.post(self.shipping_cost_endpoint, json=request_data).get_json()
+        self.assertEqual(response_json[0], {
+            'carrier': 'fedex', 'error': '', 'cost': 6004, 'costs': {'cheap': 3002, 'regular': 6004, 'express': 9006},
+        })
+        self.assertEqual(response_json[1]['carrier'], 'ups')  # No rate table, quoted live
+        self.assertEqual(self.app.extensions['quote_cache'].stats()['misses'], 1)
+
+
+class QuoteCacheTestCase(unittest.TestCase):
+    """
+    Test cases for the quote cache.
+    """
+
+    def setUp(self):
+        self.shipment = {'address': '123 Fake St, Springfield', 'weight': 33, 'priority': 1, 'box_type': 'medium'}
+        self.quote = {'carrier': 'fedex', 'error': '', 'cost': 647}
+
+    def test_normalized_shipments_share_entries(self):
+        quote_cache = QuoteCache(InProcessCacheBackend(max_entries=10), ttl=60, negative_ttl=1)
+        quote_cache.set('fedex', self.shipment, self.quote, 200)
+        same_shipment = dict(self.shipment, address='  123 FAKE St,   Springfield ', test_mode=True)
+        self.assertEqual(quote_cache.get('fedex', same_shipment), self.quote)
+        self.assertIsNone(quote_cache.get('ups', same_shipment))
+        self.assertEqual(
+            quote_cache.stats(), {'hits': 1, 'misses': 1, 'stale_hits': 0, 'warmed_hits': 0, 'evictions': 0}
+        )
+
+    def test_lru_eviction(self):
+        quote_cache = QuoteCache(InProcessCacheBackend(max_entries=2), ttl=60, negative_ttl=1)
+        for weight in (1, 2):
+            quote_cache.set('fedex', dict(self.shipment, weight=weight), self.quote, 200)
+        quote_cache.get('fedex', dict(self.shipment, weight=1))  # Weight 2 is now the least recently used one
+        quote_cache.set('fedex', dict(self.shipment, weight=3), self.quote, 200)
+        self.assertIsNotNone(quote_cache.get('fedex', dict(self.shipment, weight=1)))
+        self.assertIsNone(quote_cache.get('fedex', dict(self.shipment, weight=2)))
+        self.assertEqual(quote_cache.stats()['evictions'], 1)
+
+    def test_ttls(self):
+        quote_cache = QuoteCache(
+            InProcessCacheBackend(max_entries=10), ttl=60, negative_ttl=0.05, carrier_ttls={'ups': 0.05}
+        )
+        quote_cache.set('fedex', self.shipment, self.quote, 200)
+        quote_cache.set('ups', self.shipment, self.quote, 200)
+        quote_cache.set('dhl', self.shipment, self.quote, 503)  # Negative caching
+        quote_cache.set('usps', self.shipment, self.quote, 400)  # Never cached
+        self.assertIsNotNone(quote_cache.get('dhl', self.shipment))
+        self.assertIsNone(quote_cache.get('usps', self.shipment))
+        time.sleep(0.1)
+        self.assertIsNotNone(quote_cache.get('fedex', self.shipment))
+        self.assertIsNone(quote_cache.get('ups', self.shipment))
+        self.assertIsNone(quote_cache.get('dhl', self.shipment))
+
+    def test_stale_quotes(self):
+        quote_cache = QuoteCache(InProcessCacheBackend(max_entries=10), ttl=0.05, negative_ttl=0.05, stale_ttl=60)
+        quote_cache.set('fedex', self.shipment, self.quote, 200, warmed=True)
+        quote_cache.set('dhl', self.shipment, self.quote, 503)  # Errors are never served stale
+        time.sleep(0.1)
+        cached_quote = quote_cache.get_cached_quote('fedex', self.shipment)
+        self.assertEqual(cached_quote.quote, self.quote)
+        self.assertLess(cached_quote.fresh_until, time.time())
+        self.assertIsNone(quote_cache.get('dhl', self.shipment))
+        self.assertEqual(quote_cache.peek('fedex', self.shipment), cached_quote)
+        self.assertEqual(
+            quote_cache.stats(), {'hits': 1, 'misses': 1, 'stale_hits': 1, 'warmed_hits': 1, 'evictions': 0}
+        )
+
+    def test_shared_backend(self):
+        shared_store = LocalSharedStore()
+        quote_cache_1 = QuoteCache(SharedCacheBackend(shared_store), ttl=60, negative_ttl=1)
+        quote_cache_2 = QuoteCache(SharedCacheBackend(shared_store), ttl=60, negative_ttl=1)
+        quote_cache_1.set('fedex', self.shipment, self.quote, 200)
+        self.assertEqual(quote_cache_2.get('fedex', self.shipment), self.quote)
+
+
+class _StubServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server to stub external APIs in test cases. It answers `{"cost": 123}` to any request (or an HTML page,
+    if its path has `malformed`), sleeping first as many secs as given in the `sleep` query param (if any).
+    """
+    daemon_threads = True
+
+    class _RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if 'sleep=' in self.path:
+                time.sleep(float(self.path.split('sleep=')[1]))
+            is_malformed = 'malformed' in self.path
+            body = b'<html>Oops</html>' if is_malformed else json.dumps({'cost': 123}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html' if is_malformed else 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), self._RequestHandler)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server_address[1])
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def handle_error(self, request, client_address):
+        pass  # e.g. clients that timed out and closed the connection
+
+
+class OutboundHTTPClientTestCase(unittest.TestCase):
+    """
+    Test cases for the shared outbound HTTP client.
+    """
+
+    def setUp(self):
+        self.server = _StubServer()
+        self.client = OutboundHTTPClient(
+            pool_connections=2, pool_maxsize=2, pool_block=False, connect_timeout=1, read_timeout=0.2
+        )
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        for _ in range(5):
+            response = self.client.post(self.server.url, json={})
+            self.assertEqual(response.json(), {'cost': 123})
+        metrics = self.client.get_metrics()
+        self.assertEqual(metrics['requests'], 5)
+        self.assertEqual(metrics['connections'], 1)
+        self.assertEqual(metrics['in_use'], 0)
+        self.assertAlmostEqual(metrics['reuse_ratio'], 0.8)
+
+    def test_timeouts(self):
+        with self.assertRaises(OutboundRequestError) as context:
+            self.client.post(self.server.url + '?sleep=1', json={})
+        self.assertTrue(context.exception.timed_out)
+
+
+class CarrierAdaptersTestCase(_CommonLogicTestCase):
+    """
+    Test cases for carrier adapters.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.shipment = Shipment(
+            address='123 Fake St, Springfield', weight=33, priority=1, box_type='medium', test_mode=True
+        )
+
+    def test_adapter_resolution(self):
+        with self.app.app_context():
+            carrier = get_carrier_registry().get_by_code('fedex')
+            self.assertIsInstance(get_carrier_adapter(carrier), SimulatorCarrierAdapter)  # Enabled in testing
+            http_carrier = Carrier('DHL', 'DHLID', 'DHLTKN', {}, 'https://api.dhl.com/shippingcosts')
+            self.assertIsInstance(get_carrier_adapter(http_carrier), HTTPCarrierAdapter)
+        self.app.extensions['carrier_simulator'] = None
+        self.assertIsInstance(get_carrier_adapter(carrier, self.app), MockCarrierAdapter)
+
+    def test_http_adapter(self):
+        server = _StubServer()
+        try:
+            http_carrier = Carrier('DHL', 'DHLID', 'DHLTKN', {'regular': 'dhlreg', 'express': 'dhlexp'}, server.url)
+            endpoint = ShippingCostsEndpoint()
+            with self.app.app_context():
+                quote = HTTPCarrierAdapter(http_carrier).quote(self.shipment)
+                # With no costs by shipment method, its cost is the one of the default shipment method
+                carrier_response = endpoint._handle_carrier_response(http_carrier, quote)
+                selected_responses = endpoint._select_carrier_responses([carrier_response], 'cheapest')
+            self.assertEqual((quote.status_code, quote.cost), (200, 123))
+            self.assertEqual(carrier_response['costs'], {'regular': 123, 'express': -1})
+            self.assertEqual(
+                selected_responses, [{'carrier': 'dhl', 'error': '', 'cost': 123, 'costs': {'regular': 123}}]
+            )
+
+            # Malformed responses only fail their own carrier
+            http_carrier.api_endpoint_url = server.url + 'malformed'
+            with self.app.app_context():
+                quote = HTTPCarrierAdapter(http_carrier).quote(self.shipment)
+                fedex = Carrier.query.filter_by(name='Fedex').one()
+                fedex.api_endpoint_url = http_carrier.api_endpoint_url
+                fedex.save()
+            self.assertEqual((quote.status_code, quote.cost), (502, -1))
+            response = self.client.post(self.shipping_cost_endpoint, json=self.shipment._asdict())
+            self.assertEqual(response.status_code, 200)
+            response_by_carrier = {quote['carrier']: quote for quote in response.get_json()}
+            self.assertNotEqual(response_by_carrier['fedex']['error'], '')
+            self.assertEqual(response_by_carrier['ups']['error'], '')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_failing_adapter(self):
+        class _FailingSimulator(object):
+            def simulate(self, *args):
+                raise RuntimeError('Adapter bug')
+
+        self.app.extensions['carrier_simulator'] = _FailingSimulator()
+        response = self.client.post(self.shipping_cost_endpoint, json=self.shipment._asdict())
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(carrier_response['error'] for carrier_response in response.get_json()))
+        # Recorded as a failure, so a half-open circuit isn't stuck waiting for it
+        health = self.app.extensions['circuit_breakers'].get('fedex').get_health()
+        self.assertEqual((health['requests'], health['error_rate']), (1, 1))
+
+    def test_mock_endpoint(self):
+        response = self.client.post('/mock/fedex/shippingcosts', json=self.shipment._asdict())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(type(response.get_json()['cost']), int)
+        self.assertEqual(set(response.get_json()['costs']), {'cheap', 'express', 'regular'})
+        self.assertEqual(self.client.post('/mock/acme/shippingcosts', json=self.shipment._asdict()).status_code, 404)
+
+
+class CarrierSimulatorTestCase(_CommonLogicTestCase):
+    """
+    Test cases for the carrier simulator.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.shipment = {'address': '123 Fake St, Springfield', 'weight': 33, 'priority': 1, 'box_type': 'medium'}
+        self.shipment_methods = ('cheap', 'regular', 'express')
+
+    def _simulate_all(self, simulator, carrier_codes):
+        return [
+            simulator.simulate(carrier_code, dict(self.shipment, weight=weight), self.shipment_methods)
+            for carrier_code in carrier_codes for weight in range(1, 21)
+        ]
+
+    def test_deterministic(self):
+        profiles = {'fedex': CarrierProfile(latency='lognormal:-3,0.5', error_rate=0.3)}
+        simulated_quotes = self._simulate_all(CarrierSimulator(profiles, seed=1), ('fedex', 'ups'))
+        # Same answers whatever the order of the calls, but not with another seed
+        self.assertEqual(
+            self._simulate_all(CarrierSimulator(profiles, seed=1), ('ups', 'fedex')),
+            simulated_quotes[20:] + simulated_quotes[:20],
+        )
+        self.assertNotEqual(self._simulate_all(CarrierSimulator(profiles, seed=2), ('fedex', 'ups')), simulated_quotes)
+
+        fedex_quotes, ups_quotes = simulated_quotes[:20], simulated_quotes[20:]
+        self.assertTrue(any(simulated_quote.status_code == 500 for simulated_quote in fedex_quotes))
+        self.assertEqual({simulated_quote.status_code for simulated_quote in ups_quotes}, {200})  # Default profile
+        self.assertEqual(ups_quotes[0].cost, ups_quotes[0].costs['regular'])
+        self.assertEqual(set(ups_quotes[0].costs), set(self.shipment_methods))
+
+    def test_quotas(self):
+        simulator = CarrierSimulator({'fedex': CarrierProfile(daily_quota=2)})
+        status_codes = [simulator.simulate('fedex', self.shipment, ()).status_code for _ in range(3)]
+        self.assertEqual(status_codes, [200, 200, 429])
+        simulator.reset()
+        self.assertEqual(simulator.simulate('fedex', self.shipment, ()).status_code, 200)
+
+    def test_tracked_shipments(self):
+        simulator = CarrierSimulator({'fedex': CarrierProfile(latency='uniform:0,1')}, max_shipments=2)
+        first_quote = simulator.simulate('fedex', self.shipment, self.shipment_methods)
+        self.assertNotEqual(simulator.simulate('fedex', self.shipment, self.shipment_methods), first_quote)
+        for weight in (1, 2):
+            simulator.simulate('fedex', dict(self.shipment, weight=weight), self.shipment_methods)
+        # Only the latest shipments are tracked, the oldest ones are answered as if they were never quoted
+        self.assertEqual(len(simulator._calls), 2)
+        self.assertEqual(simulator.simulate('fedex', self.shipment, self.shipment_methods), first_quote)
+
+    def test_in_process(self):
+        self.app.config['OUTBOUND_HTTP_READ_TIMEOUT'] = 0.05
+        self.app.extensions['carrier_simulator'] = CarrierSimulator({
+            'fedex': CarrierProfile(error_rate=1, error_status_code=503),
+            'ups': CarrierProfile(latency='constant:1'),  # Over the outbound read timeout
+        })
+        response = self.client.post(self.shipping_cost_endpoint, json=dict(self.shipment, test_mode=True))
+        self.assertEqual([carrier_response['cost'] for carrier_response in response.get_json()], [-1, -1])
+
+    def test_http_server(self):
+        simulator = CarrierSimulator({'fedex': CarrierProfile(drip=0.1)}, seed=1)
+        server = CarrierSimulatorServer(simulator).start()
+        try:
+            http_carrier = Carrier('Fedex', 'FEDEXID', 'FEDEXTKN', {'regular': 'fdxreg'}, server.url + 'fedex/rates')
+            started_at = time.monotonic()
+            with self.app.app_context():
+                quote = HTTPCarrierAdapter(http_carrier).quote(Shipment.from_data(self.shipment))
+            self.assertGreaterEqual(time.monotonic() - started_at, 0.1)  # Slow-drip
+            simulator.reset()
+            simulated_quote = simulator.simulate('fedex', self.shipment, ('regular',))
+            self.assertEqual((quote.status_code, quote.cost, quote.costs), simulated_quote[:3])
+        finally:
+            server.stop()
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """
+    Test cases for the coalescing of identical in-flight calls.
+    """
+
+    def setUp(self):
+        self.calls = []
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _slow_call(self, result='quote'):
+        self.calls.append(result)
+        time.sleep(0.2)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _run_concurrently(self, funcs):
+        """
+        Runs all given functions at the same time, returning their results (or exceptions) in the same order.
+        """
+        results = [None] * len(funcs)
+
+        def _run(index):
+            try:
+                results[index] = funcs[index]()
+            except Exception as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=_run, args=(index,)) for index in range(len(funcs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_calls_are_coalesced(self):
+        single_flight = SingleFlight()
+        results = self._run_concurrently(
+            [lambda: single_flight.do(('fedex', 33), self._slow_call)] * 10 +
+            [lambda: single_flight.do(('ups', 33), lambda: self._slow_call('other quote'))]
+        )
+        self.assertEqual(results, ['quote'] * 10 + ['other quote'])
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(single_flight.stats(), {'calls': 2, 'coalesced_calls': 9})
+        # Results are not kept once calls are done
+        self.assertEqual(single_flight.do(('fedex', 33), lambda: 'new quote'), 'new quote')
+
+    def test_errors_are_shared(self):
+        single_flight = SingleFlight()
+        error = ValueError('Carrier is down')
+        results = self._run_concurrently([lambda: single_flight.do('fedex', lambda: self._slow_call(error))] * 5)
+        self.assertEqual(results, [error] * 5)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_coalesced_across_processes(self):
+        # Each SingleFlight stands for a different process (e.g. a gunicorn worker)
+        single_flights = [
+            SingleFlight(shared_store=FileSharedStore(self.temp_dir.name), lock_ttl=2, poll_interval=0.01)
+            for _ in range(3)
+        ]
+        results = self._run_concurrently([
+            lambda single_flight=single_flight: single_flight.do(('fedex', 33), lambda: self._slow_call({'cost': 1}))
+            for single_flight in single_flights
+        ])
+        self.assertEqual(results, [{'cost': 1}] * 3)
+        self.assertEqual(len(self.calls), 1)
+
+        # Nobody waits for a lock holder that's done without a result
+        single_flight = single_flights[0]
+        results = self._run_concurrently([
+            lambda: single_flight.do('ups', lambda: self._slow_call(ValueError())),
+            lambda: time.sleep(0.05) or single_flights[1].do('ups', lambda: 'quote'),
+        ])
+        self.assertEqual(results[1], 'quote')
+
+    def test_file_shared_store(self):
+        store = FileSharedStore(self.temp_dir.name)
+        self.assertIsNone(store.get('lock'))
+        self.assertTrue(store.set('lock', 'a', ex=1, nx=True))
+        self.assertIsNone(store.set('lock', 'b', ex=1, nx=True))
+        self.assertEqual(FileSharedStore(self.temp_dir.name).get('lock'), 'a')
+        self.assertEqual(store.delete('lock'), 1)
+        self.assertTrue(store.set('lock', 'b', ex=0.01, nx=True))
+        time.sleep(0.02)
+        self.assertIsNone(store.get('lock'))
+        self.assertTrue(store.set('lock', 'c', nx=True))  # Expired keys can be taken over
+
+        # Expired entries are swept away on writes (sampled, but always in here)
+        store = FileSharedStore(self.temp_dir.name, sweep_probability=1)
+        store.set('quote', 1, ex=0.01)
+        store.incr('counter')
+        time.sleep(0.02)
+        store.set('other_quote', 2, ex=60)
+        self.assertEqual(len(os.listdir(self.temp_dir.name)), 4)  # lock, counter (and its .lock) and other_quote
+        self.assertEqual((store.get('lock'), store.get('counter'), store.get('other_quote')), ('c', 1, 2))
+
+
+class RateLimitingTestCase(_CommonLogicTestCase):
+    """
+    Test cases for carriers' rate limits and quotas, and for admission control.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.request_data = {
+            'address': '123 Fake St, Springfield', 'weight': 33, 'priority': 1, 'box_type': 'medium', 'test_mode': True,
+        }
+
+    def test_token_buckets(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for store in (LocalSharedStore(), FileSharedStore(temp_dir)):
+                # Buckets of different processes sharing the same store limit calls as a whole
+                token_buckets = [SharedTokenBuckets(store), SharedTokenBuckets(store)]
+                self.assertEqual(
+                    [buckets.try_acquire('dhl', 1 / 3600, 2) for buckets in token_buckets * 2],
+                    [True, True, False, False],
+                )
+                self.assertTrue(token_buckets[0].try_acquire('ups', 1 / 3600, 2))
+                # Tokens are refilled at the given rate, so there's never more than a burst at once
+                self.assertTrue(token_buckets[0].try_acquire('fedex', 20, 1))
+                self.assertFalse(token_buckets[1].try_acquire('fedex', 20, 1))
+                time.sleep(0.06)
+                self.assertTrue(token_buckets[1].try_acquire('fedex', 20, 1))
+                self.assertFalse(token_buckets[0].try_acquire('fedex', 20, 1))
+
+    def test_rate_limits(self):
+        carrier = Carrier('DHL', 'DHLID', 'DHLTKN', {}, '/mock/dhl/shippingcosts', rate_limit=20, rate_limit_burst=2)
+        store = LocalSharedStore()
+        rate_limiter = CarrierRateLimiter(carrier, QuotaTracker(store), SharedTokenBuckets(store), soft_limit=1)
+        self.assertEqual([rate_limiter.acquire() for _ in range(3)], [None, None, 'rate_limit'])
+        time.sleep(0.06)
+        self.assertEqual([rate_limiter.acquire() for _ in range(2)], [None, 'rate_limit'])
+
+    def test_quotas(self):
+        carrier = Carrier('DHL', 'DHLID', 'DHLTKN', {}, '/mock/dhl/shippingcosts', daily_quota=10)
+        store = LocalSharedStore()
+        rate_limiter = CarrierRateLimiter(carrier, QuotaTracker(store), SharedTokenBuckets(store), soft_limit=0.5)
+        for _ in range(5):
+            self.assertIsNone(rate_limiter.acquire())  # Counted against the quota right away
+        # Past the soft limit, calls are paced so the rest of the quota lasts all day
+        self.assertIsNone(rate_limiter.acquire())
+        self.assertEqual(rate_limiter.acquire(), 'quota')
+        self.assertEqual(rate_limiter.get_stats()['quota_usage'], 6)  # Rejected calls are not counted
+        for _ in range(4):
+            rate_limiter.record_call()
+        self.assertEqual(rate_limiter.get_stats()['quota_usage'], 10)
+        self.assertEqual(rate_limiter.acquire(), 'quota')
+        self.assertEqual(rate_limiter.get_stats()['quota_usage'], 10)
+
+    def test_quotas_under_concurrency(self):
+        carrier = Carrier('DHL', 'DHLID', 'DHLTKN', {}, '/mock/dhl/shippingcosts', daily_quota=20)
+        store = LocalSharedStore()
+        rate_limiter = CarrierRateLimiter(carrier, QuotaTracker(store), SharedTokenBuckets(store), soft_limit=1)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(rate_limiter.acquire())) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(None), 20)
+        self.assertEqual(rate_limiter.get_stats()['quota_usage'], 20)
+
+    def test_open_circuits_do_not_spend_quotas(self):
+        with self.app.app_context():
+            carrier = Carrier.query.filter_by(name='Fedex').one()
+            carrier.daily_quota = 100
+            carrier.save()
+        self.app.config['QUOTE_CACHE_ENABLED'] = False
+        self.app.extensions['quote_cache'] = None
+        circuit_breaker = self.app.extensions['circuit_breakers'].get('fedex')
+        for _ in range(circuit_breaker.min_requests):
+            circuit_breaker.record(False, 0)
+        response_by_carrier = {
+            quote['carrier']: quote
+            for quote in self.client.post(self.shipping_cost_endpoint, json=self.request_data).get_json()
+        }
+        self.assertNotEqual(response_by_carrier['fedex']['error'], '')
+        response_json = self.client.get(self.carrier_endpoint + '/health').get_json()
+        self.assertEqual({carrier_health['carrier']: carrier_health for carrier_health in response_json}['fedex'][
+            'quota_usage'
+        ], 0)
+
+    def test_rate_limited_carriers(self):
+        with self.app.app_context():
+            carrier = Carrier.query.filter_by(name='Fedex').one()
+            carrier.rate_limit = 0.001
+            carrier.rate_limit_burst = 1
+            carrier.save()
+        self.app.config['QUOTE_CACHE_ENABLED'] = False
+        self.app.extensions['quote_cache'] = None
+
+        for expected_error in ('', 'Fedex is busy right now, try again later'):
+            response = self.client.post(self.shipping_cost_endpoint, json=self.request_data)
+            response_by_carrier = {quote['carrier']: quote for quote in response.get_json()}
+            self.assertEqual(response_by_carrier['fedex']['error'], expected_error)
+            self.assertEqual(response_by_carrier['ups']['error'], '')
+        response_json = self.client.get(self.carrier_endpoint + '/health').get_json()
+        self.assertEqual(response_json[0]['rate_limit'], 0.001)
+        self.assertIn('carrier_requests_rejected_total{carrier="fedex",reason="rate_limit"} 1', self.client.get(
+            '/metrics'
+        ).get_data(as_text=True))
+
+    def test_admission_control(self):
+        admission_controller = AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=0.05)
+        self.assertTrue(admission_controller.acquire())
+        self.assertFalse(admission_controller.acquire())  # Timed out in the queue
+        threading.Timer(0.01, admission_controller.release).start()
+        self.assertTrue(admission_controller.acquire())
+        self.assertEqual(admission_controller.stats(), {'active': 1, 'queued': 0, 'rejected': 1})
+
+        # Requests over the limit are shed right away
+        self.app.extensions['admission_controller'] = admission_controller
+        response = self.client.post(self.shipping_cost_endpoint, json=self.request_data)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        admission_controller.release()
+        response = self.client.post(self.shipping_cost_endpoint, json=self.request_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(admission_controller.active, 0)
+
+    def test_shared_store_counters(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for store in (LocalSharedStore(), FileSharedStore(temp_dir)):
+                self.assertEqual([store.incr('usage'), store.incr('usage', 2)], [1, 3])
+                self.assertTrue(store.expire('usage', 0.01))
+                time.sleep(0.02)
+                self.assertIsNone(store.get('usage'))
+
+
+class QuoteHistoryTestCase(_CommonLogicTestCase):
+    """
+    Test cases for the history of served quotes.
+    """
+
+    def test_batches(self):
+        batches = []
+        quote_history = QuoteHistory(batches.append, batch_size=10, flush_interval=10, max_pending=5)
+        for cost in range(7):
+            quote_history.add({'cost': cost})
+        self.assertEqual(quote_history.stats()['dropped'], 2)  # The oldest ones
+        quote_history.flush()
+        self.assertEqual(batches, [[{'cost': cost} for cost in range(2, 7)]])
+
+        # Flushed as soon as a batch is full, or on time
+        for batch_size, flush_interval in ((2, 10), (10, 0.05)):
+            quote_history = QuoteHistory(batches.append, batch_size, flush_interval, max_pending=5)
+            for cost in range(2):
+                quote_history.add({'cost': cost})
+            time.sleep(0.1)
+            self.assertEqual(batches[-1], [{'cost': 0}, {'cost': 1}])
+
+        quote_history.write = lambda batch: 1 / 0
+        quote_history.add({'cost': 2})
+        quote_history.flush()
+        self.assertEqual(quote_history.stats()['failed'], 1)
+
+    def test_quotes_are_recorded(self):
+        self.app.config['QUOTE_HISTORY_ENABLED'] = True
+        configure_quote_history(self.app)
+        response = self.client.post(self.shipping_cost_endpoint, json={
+            'address': '123 Fake St, Springfield', 'weight': 33, 'priority': 1, 'box_type': 'medium', 'test_mode': True,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.app.extensions['quote_history'].flush()
+        with self.app.app_context():
+            quote_records = QuoteRecord.query.order_by(QuoteRecord.carrier_code).all()
+        self.assertEqual([quote_record.carrier_code for quote_record in quote_records], ['fedex', 'ups'])
+        self.assertEqual(quote_records[0].shipment['weight'], 33)
+        self.assertGreater(quote_records[0].latency_ms, 0)
+
+
+class QuoteWarmingTestCase(_CommonLogicTestCase):
+    """
+    Test cases for the refresh of stale quotes and the warming of frequent ones.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.shipment = {'address': '123 Fake St, Springfield', 'weight': 33, 'priority': 1, 'box_type': 'medium'}
+
+    def test_revalidations_are_deduplicated(self):
+        quote_revalidator = QuoteRevalidator(max_workers=2)
+        refreshes = []
+        release = threading.Event()
+
+        def _refresh():
+            release.wait(1)
+            refreshes.append(1)
+
+        self.assertTrue(quote_revalidator.revalidate('fedex', _refresh))
+        self.assertFalse(quote_revalidator.revalidate('fedex', _refresh))  # Already being refreshed
+        self.assertTrue(quote_revalidator.revalidate('ups', _refresh))
+        release.set()
+        time.sleep(0.1)
+        self.assertEqual(len(refreshes), 2)
+        self.assertTrue(quote_revalidator.revalidate('fedex', _refresh))
+
+    def test_stale_quotes_are_refreshed(self):
+        quote_cache = QuoteCache(InProcessCacheBackend(max_entries=10), ttl=0.05, negative_ttl=1, stale_ttl=60)
+        self.app.extensions['quote_cache'] = quote_cache
+        request_data = dict(self.shipment, test_mode=True)
+        first_response_json = self.client.post(self.shipping_cost_endpoint, json=request_data).get_json()
+        time.sleep(0.1)
+        response_json = self.client.post(self.shipping_cost_endpoint, json=request_data).get_json()
+        self.assertEqual(response_json, first_response_json)  # Served stale right away
+        self.assertEqual(quote_cache.stats()['stale_hits'], 2)
+        self.assertEqual(self.app.extensions['quote_revalidator'].revalidations, 2)  # One per carrier
+
+    def test_warming(self):
+        with self.app.app_context():
+            for carrier_code in ('fedex', 'ups'):
+                db.session.add(QuoteRecord(
+                    carrier_code=carrier_code, shipment=self.shipment, cost=123, costs={}, latency_ms=100
+                ))
+            db.session.commit()
+        quote_warmer = QuoteWarmer(
+            self.app, ShippingCostsEndpoint(), max_lanes=10, lookback=60, refresh_ahead=1, max_rate=100
+        )
+        lanes, results = next(quote_warmer.run(interval=0, rounds=1))
+        self.assertEqual(lanes, 1)
+        self.assertEqual(results['refreshed'] + results['skipped'], 2)  # Mocked carriers may fail
+
+        quote_cache = self.app.extensions['quote_cache']
+        cached_quotes = [quote_cache.peek(carrier_code, self.shipment) for carrier_code in ('fedex', 'ups')]
+        self.assertEqual(sum(cached_quote is not None and cached_quote.warmed for cached_quote in cached_quotes),
+                         results['refreshed'])
+        self.assertEqual(next(quote_warmer.run(interval=0, rounds=1))[1]['fresh'], results['refreshed'])
+        self.client.post(self.shipping_cost_endpoint, json=dict(self.shipment, test_mode=True))
+        self.assertEqual(quote_cache.stats()['warmed_hits'], results['refreshed'])
+        self.assertIn('quote_cache_warming_hit_rate_gain', self.client.get('/metrics').get_data(as_text=True))
+
+
+class ProfilingTestCase(_CommonLogicTestCase):
+    """
+    Test cases for the profiling endpoints and the capture of slow requests.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['ADMIN_TOKEN'] = 'secret'
+        self.admin_headers = {'Authorization': 'Bearer secret'}
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.app.extensions['profile_store'].directory = self.temp_dir.name
+
+    def tearDown(self):
+        super().tearDown()
+        self.temp_dir.cleanup()
+
+    def test_admins_only(self):
+        self.assertEqual(self.client.get('/admin/slow_requests').status_code, 403)
+        self.assertEqual(
+            self.client.get('/admin/slow_requests', headers={'Authorization': 'Bearer wrong'}).status_code, 403
+        )
+        self.assertEqual(self.client.get('/admin/slow_requests', headers=self.admin_headers).status_code, 200)
+        self.app.config['ADMIN_TOKEN'] = None
+        self.assertEqual(self.client.post('/admin/profiles', headers={'Authorization': 'Bearer None'}).status_code, 403)
+
+    def test_profiles(self):
+        self.assertEqual(self.client.post('/admin/profiles?seconds=1000', headers=self.admin_headers).status_code, 400)
+        response = self.client.post('/admin/profiles?seconds=0.2', headers=self.admin_headers)
+        self.assertEqual(response.status_code, 202)
+        profile_url = '/admin/profiles/' + response.get_json()['id']
+        self.assertEqual(self.client.post('/admin/profiles', headers=self.admin_headers).status_code, 409)
+        self.assertEqual(self.client.get(profile_url, headers=self.admin_headers).status_code, 404)  # Not finished yet
+        time.sleep(0.4)
+
+        response = self.client.get(profile_url, headers=self.admin_headers)
+        self.assertEqual(response.status_code, 200)
+        stacks = dict(line.rsplit(' ', 1) for line in response.get_data(as_text=True).splitlines())
+        self.assertTrue(any(stack.startswith('MainThread;') and 'test_profiles' in stack for stack in stacks))
+        self.assertTrue(all(int(count) > 0 for count in stacks.values()))
+        self.assertEqual(self.client.get('/admin/profiles/..', headers=self.admin_headers).status_code, 404)
+
+    def test_slow_requests(self):
+        self.app.extensions['instrumentation'].sample_rate = 0
+        slow_request_log = self.app.extensions['slow_request_log']
+        request_data = {
+            'address': '123 Fake St, Springfield', 'weight': 33, 'priority': 1, 'box_type': 'medium', 'test_mode': True,
+        }
+        self.client.post(self.shipping_cost_endpoint, json=request_data)
+        self.client.get(self.carrier_endpoint)  # Not captured, whatever its latency
+        self.assertEqual(slow_request_log.get_entries(), [])
+
+        slow_request_log.threshold = 0
+        response = self.client.post(self.shipping_cost_endpoint, json=request_data)
+        self.assertNotIn('Server-Timing', response.headers)  # Traced, but not sampled
+        self.client.get(self.carrier_endpoint)
+        slow_requests = self.client.get('/admin/slow_requests', headers=self.admin_headers).get_json()
+        self.assertEqual(len(slow_requests), 1)
+        self.assertEqual((slow_requests[0]['path'], slow_requests[0]['status']), (self.shipping_cost_endpoint, 200))
+        self.assertEqual(json.loads(slow_requests[0]['payload']), request_data)
+        self.assertIn('fanout', slow_requests[0]['stages_ms'])
+
+        slow_request_log.max_payload_size = 10
+        self.client.post(self.shipping_cost_endpoint, json=request_data)
+        self.assertTrue(slow_request_log.get_entries()[0]['payload_truncated'])
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    """
+    Test cases for carriers' circuit breakers.
+    """
+
+    def _build_circuit_breaker(self, store=None):
+        return CircuitBreaker(
+            'fedex', store or LocalCircuitStateStore(), window=60, min_requests=4, error_rate_threshold=0.5,
+            slow_call_duration=1, slow_call_rate_threshold=0.5, open_duration=0.1, half_open_probes=1,
+        )
+
+    def test_opens_on_errors_and_recovers(self):
+        circuit_breaker = self._build_circuit_breaker()
+        for success in (True, True, False):
+            circuit_breaker.record(success, 0.1)
+        self.assertTrue(circuit_breaker.allow_request())  # Not enough requests yet
+        circuit_breaker.record(False, 0.1)
+        self.assertEqual(circuit_breaker.get_health()['state'], CircuitState.OPEN.value)
+        self.assertFalse(circuit_breaker.allow_request())
+
+        time.sleep(0.1)
+        self.assertTrue(circuit_breaker.allow_request())  # Probe request
+        self.assertFalse(circuit_breaker.allow_request())  # Only 1 probe at a time
+        circuit_breaker.record(True, 0.1)
+        self.assertEqual(circuit_breaker.get_health()['state'], CircuitState.CLOSED.value)
+        self.assertTrue(circuit_breaker.allow_request())
+
+    def test_opens_on_slow_calls(self):
+        circuit_breaker = self._build_circuit_breaker()
+        for _ in range(4):
+            circuit_breaker.record(True, 2)
+        health = circuit_breaker.get_health()
+        self.assertEqual(health['state'], CircuitState.OPEN.value)
+        self.assertEqual(health['slow_call_rate'], 1)
+        self.assertEqual(health['average_latency'], 2)
+
+    def test_lost_probes_are_given_up(self):
+        circuit_breaker = self._build_circuit_breaker()
+        for _ in range(4):
+            circuit_breaker.record(False, 0.1)
+        time.sleep(0.1)
+        self.assertTrue(circuit_breaker.allow_request())  # Probe request, whose outcome never gets recorded
+        self.assertFalse(circuit_breaker.allow_request())
+        time.sleep(0.1)
+        self.assertTrue(circuit_breaker.allow_request())  # Not locked out forever
+        circuit_breaker.cancel_request()  # e.g. rate limited, the next request is the probe then
+        self.assertTrue(circuit_breaker.allow_request())
+        self.assertFalse(circuit_breaker.allow_request())
+
+    def test_shared_state(self):
+        store = LocalSharedStore()
+        circuit_breaker_1 = self._build_circuit_breaker(SharedCircuitStateStore(store))
+        circuit_breaker_2 = self._build_circuit_breaker(SharedCircuitStateStore(store))
+        for _ in range(4):
+            circuit_breaker_1.record(False, 0.1)
+        self.assertFalse(circuit_breaker_2.allow_request())
+
+
+class QuoteHedgerTestCase(unittest.TestCase):
+    """
+    Test cases for hedged requests and retries.
+    """
+
+    def _build_quote_hedger(self, budget=None, max_retries=0):
+        return QuoteHedger(
+            max_workers=4, percentile=0.95, sample_size=100, min_samples=5, max_retries=max_retries, retry_backoff=0.01,
+            budget=budget or RetryBudget(ratio=0.1, max_tokens=10),
+        )
+
+    def test_latency_percentile(self):
+        latency_tracker = LatencyTracker(sample_size=100, min_samples=5)
+        for latency in range(4):
+            latency_tracker.record(latency)
+        self.assertIsNone(latency_tracker.get_percentile(0.95))  # Not enough samples yet
+        for latency in range(4, 100):
+            latency_tracker.record(latency)
+        self.assertEqual(latency_tracker.get_percentile(0.95), 94)
+
+    def test_retry_budget(self):
+        budget = RetryBudget(ratio=0.5, max_tokens=1)
+        self.assertTrue(budget.try_withdraw())
+        self.assertFalse(budget.try_withdraw())
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.try_withdraw())
+
+    def test_hedged_requests(self):
+        quote_hedger = self._build_quote_hedger()
+        for _ in range(5):
+            quote_hedger.call('fedex', lambda: 'fast', lambda result: False)
+        calls = []
+
+        def _quote_func():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(0.3)  # Slow primary request, the hedged one wins
+                return 'slow'
+            return 'fast'
+
+        self.assertEqual(quote_hedger.call('fedex', _quote_func, lambda result: False), 'fast')
+        stats = quote_hedger.get_stats('fedex')
+        self.assertEqual((stats['hedges'], stats['hedge_wins']), (1, 1))
+
+    def test_retries(self):
+        quote_hedger = self._build_quote_hedger(RetryBudget(ratio=0.1, max_tokens=1), max_retries=3)
+        results = iter(['error', 'error', 'ok'])
+        self.assertEqual(quote_hedger.call('ups', lambda: next(results), lambda result: result == 'error'), 'error')
+        stats = quote_hedger.get_stats('ups')
+        self.assertEqual((stats['retries'], stats['budget_denials']), (1, 1))  # Only 1 retry allowed by the budget
+
+
+class CarrierFanoutTestCase(unittest.TestCase):
+    """
+    Test cases for the concurrent carrier fan-out engine.
+    """
+
+    def setUp(self):
+        self.fanout = CarrierFanout(max_workers=4, carrier_timeout=0.5, deadline=1)
+
+    def tearDown(self):
+        self.fanout.shutdown()
+
+    def test_results_keep_carriers_order(self):
+        delays = {'fedex': 0.2, 'ups': 0.05, 'dhl': 0.1}
+        results = self.fanout.run(
+            list(delays), lambda carrier: time.sleep(delays[carrier]) or carrier, lambda carrier: 'timeout'
+        )
+        self.assertEqual(results, ['fedex', 'ups', 'dhl'])
+
+    def test_carriers_are_called_concurrently(self):
+        started = time.monotonic()
+        self.fanout.run(['fedex', 'ups', 'dhl'], lambda carrier: time.sleep(0.2), lambda carrier: None)
+        self.assertLess(time.monotonic() - started, 0.5)  # Sequential calls would take 0.6 secs
+
+    def test_slow_carriers_time_out(self):
+        delays = {'fedex': 0.05, 'ups': 2}
+        started = time.monotonic()
+        results = self.fanout.run(
+            list(delays), lambda carrier: time.sleep(delays[carrier]) or carrier, lambda carrier: 'timeout'
+        )
+        self.assertEqual(results, ['fedex', 'timeout'])
+        self.assertLess(time.monotonic() - started, 1)  # The slow carrier didn't block the whole fan-out
+
+    def test_failing_carriers(self):
+        results = self.fanout.run(
+            ['fedex', 'ups'], lambda carrier: 1 / 0 if carrier == 'fedex' else carrier, lambda carrier: 'timeout',
+            lambda carrier: 'error',
+        )
+        self.assertEqual(results, ['error', 'ups'])
+
+    def test_results_as_completed(self):
+        delays = {'fedex': 0.2, 'ups': 0.05, 'dhl': 2}
+        started = time.monotonic()
+        results = self.fanout.iter_completed(
+            list(delays), lambda carrier: time.sleep(delays[carrier]) or carrier, lambda carrier: 'timeout'
+        )
+        self.assertEqual(next(results), (1, 'ups'))
+        self.assertLess(time.monotonic() - started, 0.15)  # No need to wait for slower carriers
+        self.assertEqual(list(results), [(0, 'fedex'), (2, 'timeout')])
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()